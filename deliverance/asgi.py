@@ -0,0 +1,433 @@
+"""
+An asyncio (ASGI) version of the Deliverance middleware.
+
+The wrapped application, the theme and the resources of ``href``
+actions are all fetched without blocking the event loop: internal
+subrequests call the wrapped ASGI application, and external ones are
+made with `httpx <https://www.python-httpx.org/>`_ (which must be
+installed to use them).  Parsing and applying the rules is CPU-bound
+work, and is done on an executor, once the resources the rules need
+have been fetched on the event loop.
+"""
+
+import asyncio
+import functools
+import io
+import sys
+from webob import Request, Response
+from deliverance.middleware import DeliveranceMiddleware
+from deliverance.security import SecurityContext
+
+__all__ = ['AsyncDeliveranceMiddleware']
+
+class AsyncDeliveranceMiddleware(DeliveranceMiddleware):
+    """
+    The ASGI counterpart of
+    :class:`deliverance.middleware.DeliveranceMiddleware`, wrapping an
+    ASGI application.
+
+    `rule_getter` and `default_theme` work the same way as they do
+    for the WSGI middleware (the rule getter is called on the
+    executor, and the ``get_resource`` it is given returns
+    ``webob.Response`` objects).  Clientside theming isn't supported.
+
+    `executor` is the :class:`concurrent.futures.Executor` the rules
+    are applied on (the event loop's default executor if not given).
+    `client` is an ``httpx.AsyncClient`` for external subrequests; one
+    is created when first needed if not given.  `security` is a
+    dictionary of :class:`deliverance.security.SecurityContext`
+    settings for every request.
+    """
+
+    def __init__(self, app, rule_getter, executor=None, client=None,
+                 security=None, **kw):
+        DeliveranceMiddleware.__init__(self, app, rule_getter, **kw)
+        self.executor = executor
+        self.client = client
+        self.security = security or {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        # (The body of the request is passed on to the application as
+        # it is received, and only read here for internal requests)
+        environ = scope_to_environ(scope, b'')
+        req = Request(environ)
+        if self.notheme_request(req):
+            await self.app(scope, receive, send)
+            return
+
+        SecurityContext.install(environ, **self.security)
+        environ['deliverance.asgi_loop'] = asyncio.get_running_loop()
+        req.environ['deliverance.base_url'] = req.application_url
+        orig_req = Request(environ.copy())
+        # The responses fetched by prefetch(), see get_resource():
+        orig_req.environ['deliverance.asgi_fetched'] = {}
+        if 'deliverance.log' in req.environ:
+            log = req.environ['deliverance.log']
+        else:
+            log = self.log_factory(req, self, **self.log_factory_kw)
+            req.environ['deliverance.log'] = log
+        def resource_fetcher(url, retry_inner_if_not_200=False, extra_headers=None):
+            """
+            Return the Response object for the given URL (this must be
+            called from the executor, not the event loop)
+            """
+            return self.get_resource(url, orig_req, log, retry_inner_if_not_200,
+                                     extra_headers=extra_headers)
+        head = req.method == 'HEAD'
+        if req.path_info_peek() == '.deliverance':
+            req.path_info_pop()
+            req.environ['wsgi.input'] = io.BytesIO(await read_body(receive))
+            resp = await self.run_sync(self.internal_app, req, resource_fetcher)
+            await send_response(resp, send, head=head)
+            return
+        if self.non_html_paths is not None and self.non_html_paths.is_known(req):
+            await self.app(scope, receive, send)
+            return
+        rule_set = await self.run_sync(
+            self.rule_getter, resource_fetcher, self.app, orig_req)
+
+        if head:
+            # Get the whole page, so the headers are those of the themed page:
+            resp = await call_app(self.app, dict(scope, method='GET'),
+                                  receive=receive)
+        else:
+            def passthrough(status, headers):
+                if self.passthrough(status, headers):
+                    if self.non_html_paths is not None:
+                        self.non_html_paths.learn(req, str(status), headers)
+                    return True
+                # An HTML page that a <match abort> applies to:
+                return rule_set.aborts_before_body(
+                    req, Response(status=status, headerlist=headers), log)
+            resp = await call_app(self.app, scope, receive=receive,
+                                  passthrough=passthrough, send=send)
+            if resp is None:
+                # Sent on as it was received
+                return
+        if not self.themeable(resp):
+            await send_response(resp, send, head=head)
+            return
+        output = await self.run_sync(self.cached_output, req, resp, rule_set)
+        selection = None
+        if output[1] is None:
+            selection = await self.run_sync(
+                rule_set.select_rules, req, resp, log,
+                self.default_theme(req.environ))
+        if selection is not None:
+            requests = rule_set.resource_requests(
+                selection, log, theme_cache=self.theme_cache,
+                fragment_cache=self.fragment_cache)
+            await self.prefetch(requests, orig_req, log)
+        resp = await self.run_sync(
+            self.theme_response, req, resp, rule_set, resource_fetcher, log,
+            False, output, selection)
+        await send_response(resp, send, head=head)
+
+    def passthrough(self, status, headers):
+        """
+        True if a response with this status and headers (a list of
+        ``(name, value)`` strings) won't be themed, and can be sent on
+        as it is received (see :meth:`will_theme`).
+        """
+        return not self.will_theme(status, headers)
+
+    async def run_sync(self, func, *args):
+        """Calls ``func(*args)`` on the executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args))
+
+    async def prefetch(self, requests, orig_req, log):
+        """
+        Fetches the resources the rules will need (``(url, kw)``
+        requests, see
+        :meth:`deliverance.ruleset.RuleSet.resource_requests`) at the
+        same time on the event loop, for :meth:`get_resource` to hand
+        out as the rules are applied.  ``file:`` URLs are left to be
+        read then.
+        """
+        fetched = orig_req.environ['deliverance.asgi_fetched']
+        requests = [(url, kw) for url, kw in requests
+                    if not url.lower().startswith('file:')]
+        responses = await asyncio.gather(*[
+            self.fetch_resource(url, orig_req, log, **kw)
+            for url, kw in requests])
+        for (url, kw), resp in zip(requests, responses):
+            fetched[fetch_key(url, **kw)] = resp
+
+    async def fetch_resource(self, url, orig_req, log,
+                             retry_inner_if_not_200=False, redirections=5,
+                             extra_headers=None):
+        """
+        The asynchronous version of :meth:`get_resource`: fetches the
+        resource with :meth:`fetch`, following redirects.
+        """
+        resp = await self.fetch(url, orig_req, log, retry_inner_if_not_200,
+                                extra_headers=extra_headers)
+        max_redirections = redirections
+        while resp.status.startswith("3") and resp.location:
+            if redirections <= 0:
+                log.debug(self, "Max redirects (%s) reached; returning response %s from %s" % (
+                        max_redirections, url, resp.status))
+                break
+            redirections = redirections - 1
+            log.debug(self, "Request for %s returned %s; following redirect Location: %s" % (
+                    url, resp.status, resp.location))
+            url = resp.location
+            if url.lower().startswith('file:'):
+                resp = await self.run_sync(
+                    DeliveranceMiddleware._get_resource, self, url, orig_req,
+                    log, retry_inner_if_not_200, extra_headers)
+            else:
+                resp = await self.fetch(url, orig_req, log,
+                                        retry_inner_if_not_200,
+                                        extra_headers=extra_headers)
+        return resp
+
+    def get_resource(self, url, orig_req, log,
+                     retry_inner_if_not_200=False,
+                     redirections=5, extra_headers=None):
+        """
+        Returns the response fetched for this request by
+        :meth:`prefetch`, or else gets the resource as the WSGI
+        middleware does.
+        """
+        fetched = orig_req.environ.get('deliverance.asgi_fetched')
+        if fetched:
+            resp = fetched.pop(
+                fetch_key(url, retry_inner_if_not_200, extra_headers), None)
+            if resp is not None:
+                return resp
+        return DeliveranceMiddleware.get_resource(
+            self, url, orig_req, log, retry_inner_if_not_200,
+            redirections=redirections, extra_headers=extra_headers)
+
+    def _get_resource(self, url, orig_req, log,
+                      retry_inner_if_not_200=False, extra_headers=None):
+        """
+        Gets a resource that :meth:`prefetch` didn't (because the rules
+        fetch it in a way that can't be told in advance) with
+        :meth:`fetch` on the event loop of the request, waiting for it
+        on the calling (executor) thread.  ``file:`` URLs are read as
+        they are by the WSGI middleware.
+        """
+        if url.lower().startswith('file:'):
+            return DeliveranceMiddleware._get_resource(
+                self, url, orig_req, log, retry_inner_if_not_200,
+                extra_headers=extra_headers)
+        loop = orig_req.environ['deliverance.asgi_loop']
+        future = asyncio.run_coroutine_threadsafe(
+            self.fetch(url, orig_req, log, retry_inner_if_not_200,
+                       extra_headers=extra_headers), loop)
+        return future.result()
+
+    async def fetch(self, url, orig_req, log,
+                    retry_inner_if_not_200=False, extra_headers=None):
+        """
+        The asynchronous version of
+        :meth:`deliverance.middleware.DeliveranceMiddleware._get_resource`
+        for ``http:`` and ``https:`` URLs.
+        """
+        if self.use_internal_subrequest(url, orig_req, log):
+            subreq = self.build_internal_subrequest(url, orig_req, log,
+                                                    extra_headers=extra_headers)
+            subresp = await call_app(self.app, environ_to_scope(subreq.environ))
+            log.debug(self, 'Internal request for %s: %s content-type: %s',
+                      url, subresp.status, subresp.content_type)
+            if not retry_inner_if_not_200:
+                return subresp
+            if subresp.status_int == 200 or subresp.status.startswith("3"):
+                return subresp
+            elif 'x-deliverance-theme-subrequest' in orig_req.headers:
+                log.debug(self,
+                          'Internal request for %s was not 200 OK; '
+                          'returning it anyway.' % url)
+                return subresp
+            else:
+                log.debug(self,
+                          'Internal request for %s was not 200 OK; retrying as external request.' % url)
+        subreq = self.build_external_subrequest(url, orig_req, log)
+        if extra_headers:
+            subreq.headers.update(extra_headers)
+        subresp = await self.external_request(subreq)
+        log.debug(self, 'External request for %s: %s content-type: %s',
+                  url, subresp.status, subresp.content_type)
+        return subresp
+
+    async def external_request(self, subreq):
+        """
+        Makes the request (a ``webob.Request``) with the HTTP client,
+        returning a ``webob.Response``.  Redirects aren't followed
+        here (see :meth:`get_resource`).
+        """
+        if self.client is None:
+            try:
+                import httpx
+            except ImportError:
+                raise ImportError(
+                    'You must install httpx to make external subrequests '
+                    'with AsyncDeliveranceMiddleware')
+            self.client = httpx.AsyncClient()
+        headers = [(name, value) for name, value in subreq.headers.items()
+                   if name.lower() != 'host']
+        resp = await self.client.request(
+            subreq.method, subreq.url, headers=headers,
+            content=subreq.body or None, follow_redirects=False)
+        # The client has already decoded the body:
+        headerlist = [(name, value) for name, value in resp.headers.multi_items()
+                      if name.lower() not in ('content-encoding', 'content-length',
+                                              'transfer-encoding')]
+        return Response(body=resp.content, status=resp.status_code,
+                        headerlist=headerlist)
+
+def fetch_key(url, retry_inner_if_not_200=False, extra_headers=None):
+    """The key of a response fetched by `AsyncDeliveranceMiddleware.prefetch`"""
+    return (url, bool(retry_inner_if_not_200),
+            tuple(sorted((extra_headers or {}).items())))
+
+async def read_body(receive):
+    """Reads the whole body of an ASGI request"""
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+async def call_app(app, scope, body=b'', passthrough=None, send=None,
+                   receive=None):
+    """
+    Calls an ASGI application, returning its response as a
+    ``webob.Response``.  The request body is `body`, or what the
+    ASGI `receive` gives if that is given.
+
+    If `passthrough` is given it is called with the status and
+    headers of the response; if it returns true the response is sent
+    on to `send` as it comes, and None is returned.
+    """
+    done = asyncio.Event()
+    if receive is None:
+        pending = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        async def receive():
+            if pending:
+                return pending.pop()
+            await done.wait()
+            return {'type': 'http.disconnect'}
+    start = {}
+    chunks = []
+    passing = []
+    async def collect(message):
+        if message['type'] == 'http.response.start':
+            start.update(message)
+            if passthrough is not None and passthrough(
+                message['status'],
+                [(name.decode('latin1'), value.decode('latin1'))
+                 for name, value in message.get('headers', [])]):
+                passing.append(True)
+                await send(message)
+        elif message['type'] == 'http.response.body':
+            if passing:
+                await send(message)
+            else:
+                chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                done.set()
+    try:
+        await app(scope, receive, collect)
+    finally:
+        done.set()
+    if passing:
+        return None
+    headerlist = [(name.decode('latin1'), value.decode('latin1'))
+                  for name, value in start.get('headers', [])]
+    return Response(body=b''.join(chunks), status=start.get('status', 500),
+                    headerlist=headerlist)
+
+async def send_response(resp, send, head=False):
+    """Sends a ``webob.Response`` with an ASGI ``send``"""
+    await send({
+        'type': 'http.response.start',
+        'status': resp.status_int,
+        'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                    for name, value in resp.headerlist]})
+    if head:
+        body = b''
+    else:
+        body = resp.body
+    await send({'type': 'http.response.body', 'body': body})
+
+def scope_to_environ(scope, body):
+    """
+    Makes a WSGI environ from an ASGI HTTP scope and the request body
+    """
+    scheme = scope.get('scheme', 'http')
+    server = scope.get('server') or ('localhost', None)
+    port = server[1]
+    if port is None:
+        port = {'https': 443}.get(scheme, 80)
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf8').decode('latin1'),
+        'PATH_INFO': path.encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(port),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'asgi.scope': scope,
+        }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            if name == 'HTTP_COOKIE':
+                value = environ[name] + '; ' + value
+            else:
+                value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+def environ_to_scope(environ):
+    """
+    Makes an ASGI HTTP scope from a WSGI environ (of a subrequest,
+    made from a request that came in through
+    :func:`scope_to_environ`)
+    """
+    scope = dict(environ.get('asgi.scope', {}))
+    root_path = environ.get('SCRIPT_NAME', '').encode('latin1').decode('utf8')
+    path_info = environ.get('PATH_INFO', '').encode('latin1').decode('utf8')
+    scope.update({
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': environ.get('SERVER_PROTOCOL', 'HTTP/1.1').split('/')[-1],
+        'method': environ['REQUEST_METHOD'],
+        'scheme': environ['wsgi.url_scheme'],
+        'root_path': root_path,
+        'path': root_path + path_info,
+        'query_string': environ.get('QUERY_STRING', '').encode('latin1'),
+        'headers': [(name.lower().encode('latin1'), value.encode('latin1'))
+                    for name, value in Request(environ).headers.items()],
+        'server': (environ['SERVER_NAME'], int(environ['SERVER_PORT'])),
+        })
+    scope.pop('raw_path', None)
+    return scope
@@ -0,0 +1,546 @@
+"""
+Caches that let Deliverance avoid fetching and parsing the same
+documents over and over.
+
+The parsed documents are shared between requests (and threads), so
+they are never handed out directly; callers always get a copy that
+they are free to modify.
+"""
+
+import copy
+import hashlib
+import os
+import threading
+import time
+from deliverance.util.filetourl import url_to_filename
+from deliverance.util.lrucache import LRUCache
+from deliverance.util.proxiedbody import attached_body
+
+__all__ = ['CachedDocument', 'Skeleton', 'ThemeCache', 'FragmentCache',
+           'OutputCache', 'NonHTMLPaths', 'FileContents']
+
+def body_hash(body):
+    """A fingerprint of a response body"""
+    if isinstance(body, str):
+        body = body.encode('utf8')
+    return hashlib.sha1(body).hexdigest()
+
+def file_mtime(url):
+    """
+    The modification time of the file a ``file:`` URL points to, or
+    None (for other URLs, or if the file can't be looked at).
+    """
+    if not url.lower().startswith('file:'):
+        return None
+    try:
+        return os.path.getmtime(url_to_filename(url))
+    except OSError:
+        return None
+
+def file_etag(stat):
+    """A (strong) ETag for a file, from the result of ``os.stat``"""
+    return '"%x-%x"' % (int(stat.st_mtime * 1000000), stat.st_size)
+
+def copy_document(doc):
+    """
+    A private copy of a parsed document.  The tree is copied (rather
+    than the root element) so the doctype and base URL are kept.
+    """
+    return copy.deepcopy(doc.getroottree()).getroot()
+
+def is_shareable(response):
+    """
+    True if a successful response may be kept and reused for other
+    requests (and users): it isn't ``no-store`` or ``private``,
+    doesn't set a cookie and doesn't have ``Vary: *``.
+    """
+    if response.status_int != 200:
+        return False
+    if 'Set-Cookie' in response.headers:
+        return False
+    cache_control = response.cache_control
+    if cache_control.no_store or cache_control.private:
+        return False
+    return response.headers.get('Vary', '').strip() != '*'
+
+def freshness_lifetime(response):
+    """
+    The number of seconds a response may be reused without
+    revalidating it, from its ``Cache-Control`` (``s-maxage`` or
+    ``max-age``) or ``Expires`` headers, less its ``Age``.
+
+    Responses that are ``no-cache``, private, set a cookie or vary on
+    anything but ``Accept-Encoding`` (the resources are fetched with
+    the user's headers) are always revalidated.
+    """
+    cache_control = response.cache_control
+    if (cache_control.no_store or cache_control.no_cache
+        or cache_control.private or 'Set-Cookie' in response.headers):
+        return 0
+    for name in response.headers.get('Vary', '').split(','):
+        if name.strip() and name.strip().lower() != 'accept-encoding':
+            return 0
+    if cache_control.s_maxage is not None:
+        lifetime = cache_control.s_maxage
+    elif cache_control.max_age is not None:
+        lifetime = cache_control.max_age
+    elif response.expires is not None:
+        date = response.date
+        if date is None:
+            return 0
+        lifetime = (response.expires - date).total_seconds()
+    else:
+        return 0
+    try:
+        age = int(response.headers.get('Age') or 0)
+    except ValueError:
+        age = 0
+    return max(0, lifetime - age)
+
+class CachedDocument(object):
+    """
+    A parsed document, along with the response it was parsed from and
+    that response's validators (``ETag``, ``Last-Modified`` and a hash
+    of the body).
+
+    `fresh_until` is the time until which the response may be used
+    without revalidating it (see `freshness_lifetime`).
+    """
+
+    # The number of skeletons (see `Skeleton`) kept per document:
+    max_skeletons = 10
+
+    def __init__(self, url, response, doc):
+        self.url = url
+        self.response = response
+        self.doc = doc
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        self.body_hash = body_hash(response.body)
+        self.mtime = file_mtime(url)
+        self.checked = time.time()
+        self.fresh_until = self.checked + freshness_lifetime(response)
+        self.skeletons = LRUCache(self.max_skeletons)
+
+    def conditional_headers(self):
+        """
+        The headers to send to revalidate this document (an empty
+        dictionary if the response had no validators).
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def is_current(self, response):
+        """
+        True if `response` (the result of a revalidation) shows that
+        this document has not changed.
+        """
+        if response.status_int == 304:
+            return True
+        if response.status_int != 200:
+            return False
+        etag = response.headers.get('ETag')
+        if etag and etag == self.etag and not etag.startswith('W/'):
+            return True
+        # Without validators we can still avoid re-parsing an
+        # identical body (hashing is much cheaper than parsing):
+        return body_hash(response.body) == self.body_hash
+
+    def is_fresh(self):
+        """True if the document can be used without revalidating it"""
+        return time.time() < self.fresh_until
+
+    def touch(self, response=None):
+        """
+        Mark the document as just revalidated.  If the revalidation
+        `response` has caching headers of its own, they replace those
+        of the original response.
+        """
+        self.checked = time.time()
+        if response is not None:
+            if ('Cache-Control' not in response.headers
+                and 'Expires' not in response.headers):
+                response = self.response
+            self.fresh_until = self.checked + freshness_lifetime(response)
+
+    def copy_doc(self):
+        """A private copy of the document, see `copy_document`"""
+        return copy_document(self.doc)
+
+class Skeleton(object):
+    """
+    A copy of a theme with the static actions of some rules (see
+    :meth:`deliverance.rules.Rule.static_prefix`) already applied.
+
+    `fragments` is a list of `CachedDocument` objects (without a
+    parsed document) for the resources those actions fetched; the
+    skeleton is only used while none of them have changed.
+
+    `content_roots` are the elements of `doc` that those actions
+    brought in from other documents (see
+    :class:`deliverance.rules.TransformState`).
+
+    `plans` holds the :class:`deliverance.rules.ThemePlan` objects
+    made for this skeleton, keyed by the rules they are for.
+    """
+
+    # The number of plans kept per skeleton:
+    max_plans = 10
+
+    def __init__(self, doc, fragments, content_roots=()):
+        self.doc = doc
+        self.fragments = fragments
+        self.content_roots = list(content_roots)
+        self.plans = LRUCache(self.max_plans)
+
+    def is_current(self, resource_fetcher):
+        """
+        Checks that none of the fragments have changed, using the
+        modification time of ``file:`` resources and conditional
+        requests for everything else.  Fragments whose responses are
+        still fresh (see `freshness_lifetime`) aren't checked.
+        """
+        for fragment in self.fragments:
+            if fragment.is_fresh():
+                continue
+            if fragment.mtime is not None:
+                if file_mtime(fragment.url) == fragment.mtime:
+                    continue
+                return False
+            resp = resource_fetcher(
+                fragment.url, extra_headers=fragment.conditional_headers())
+            if not fragment.is_current(resp):
+                return False
+            if resp.status_int == 200 and not is_shareable(resp):
+                # (No longer to be shared with other requests)
+                return False
+            fragment.touch(resp)
+        return True
+
+    def copy_doc(self):
+        """A private copy of the skeleton, see `copy_document`"""
+        return copy_document(self.doc)
+
+class ThemeCache(object):
+    """
+    A bounded cache of parsed theme documents, keyed by the resolved
+    theme URL.
+
+    Themes fetched over HTTP (or through the wrapped application) are
+    revalidated on every use, with ``If-None-Match`` /
+    ``If-Modified-Since`` when the theme response had validators; only
+    a changed theme is parsed again.  ``file:`` themes are reused for
+    `file_ttl` seconds without being looked at (by requests allowed
+    to read local files).  Theme responses that may not be shared
+    (see `is_shareable`) aren't kept.
+
+    A `max_size` of 0 disables the cache.
+    """
+
+    def __init__(self, max_size=20, file_ttl=1):
+        self.documents = LRUCache(max_size)
+        self.file_ttl = file_ttl
+        # Increased whenever a (new or changed) theme is stored:
+        self.version = 0
+
+    def lookup(self, key):
+        """Returns the `CachedDocument` for the key, or None"""
+        return self.documents.get(key)
+
+    def store(self, key, entry):
+        """Stores a `CachedDocument`"""
+        self.documents.set(key, entry)
+        self.version += 1
+
+    def is_fresh(self, entry):
+        """
+        True if the entry can be used without revalidating it.
+        """
+        if not entry.url.lower().startswith('file:'):
+            return False
+        return time.time() - entry.checked < self.file_ttl
+
+    def clear(self):
+        """Forget all the cached themes"""
+        self.documents.clear()
+
+    def stats(self):
+        """Hit/miss counters and size, see `LRUCache.stats`"""
+        return self.documents.stats()
+
+class FragmentCache(object):
+    """
+    A bounded cache of the parsed resources fetched by ``href``
+    actions, keyed by the resolved URL.
+
+    The caching headers of each response are followed: responses
+    that are ``no-store``, ``private`` or set a cookie are not kept,
+    and a kept resource is used without fetching it again until it
+    is no longer fresh (see `freshness_lifetime`).  After that it is
+    revalidated with ``If-None-Match`` / ``If-Modified-Since``, and
+    only parsed again if it has changed.
+
+    A `max_size` of 0 disables the cache.
+    """
+
+    def __init__(self, max_size=50):
+        self.documents = LRUCache(max_size)
+
+    def fetch(self, url, resource_fetcher, parse):
+        """
+        Fetches the resource at `url` (or uses the cached copy),
+        returning ``(response, doc)``.  `parse` is called with a
+        response to get its document; `doc` is None if the response
+        isn't 200 OK.
+
+        The returned document is shared, and must be copied (see
+        `copy_document`) before it is changed.
+        """
+        entry = self.documents.get(url)
+        if entry is not None and entry.is_fresh():
+            return entry.response, entry.doc
+        if entry is not None and entry.conditional_headers():
+            resp = resource_fetcher(
+                url, extra_headers=entry.conditional_headers())
+        else:
+            resp = resource_fetcher(url)
+        if entry is not None and entry.is_current(resp):
+            entry.touch(resp)
+            return entry.response, entry.doc
+        if resp.status_int != 200:
+            return resp, None
+        doc = parse(resp)
+        if is_shareable(resp):
+            self.documents.set(url, CachedDocument(url, resp, doc))
+        return resp, doc
+
+    def clear(self):
+        """Forget all the cached resources"""
+        self.documents.clear()
+
+    def stats(self):
+        """Hit/miss counters and size, see `LRUCache.stats`"""
+        return self.documents.stats()
+
+class OutputCache(object):
+    """
+    A bounded cache of complete themed pages, so that a page whose
+    unthemed response is byte-for-byte the same as before is served
+    without parsing anything.
+
+    The key combines the request URL and method, the upstream status,
+    content type, page class and a hash of its body, the values of
+    the `vary_headers` request headers (and of any headers in the
+    upstream ``Vary``), the version of the rules and the version of
+    the theme cache.  Themes and ``href`` resources are fetched with
+    the user's cookies, so ``Cookie`` and ``Authorization`` are in
+    `vary_headers` by default; only leave them out if those resources
+    are the same for everyone.
+
+    Changes to the theme or to fetched resources are only noticed
+    when a page is themed again, so entries expire after `ttl`
+    seconds.
+
+    Pages are never cached when the log is requested (``deliv_log``),
+    when the upstream response sets a cookie or is private, or when
+    the rules themselves depend on the request (see
+    :meth:`deliverance.ruleset.RuleSet.depends_on_request`).
+    """
+
+    def __init__(self, max_size=100, ttl=60,
+                 vary_headers=('Cookie', 'Authorization')):
+        self.pages = LRUCache(max_size)
+        self.ttl = ttl
+        self.vary_headers = list(vary_headers)
+        # Held while an entry is looked up and counted:
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def is_cacheable(self, req, resp, rule_set):
+        """True if the themed version of `resp` may be cached"""
+        if 'deliv_log' in req.GET:
+            return False
+        if 'Set-Cookie' in resp.headers:
+            return False
+        cache_control = resp.headers.get('Cache-Control', '').lower()
+        if 'no-store' in cache_control or 'private' in cache_control:
+            return False
+        if resp.headers.get('Vary', '').strip() == '*':
+            return False
+        return not rule_set.depends_on_request()
+
+    def key(self, req, resp, rule_set, theme_cache, default_theme=None):
+        """
+        The cache key for theming `resp` (the upstream response).  A
+        body the proxy has attached (see
+        `deliverance.util.proxiedbody.attached_body`) is hashed as it
+        came from upstream, so that it stays attached.
+        """
+        proxied = attached_body(resp)
+        if proxied is not None:
+            body = proxied.read_raw()
+        else:
+            body = resp.body
+        vary = list(self.vary_headers)
+        for name in resp.headers.get('Vary', '').split(','):
+            if name.strip():
+                vary.append(name.strip())
+        return (req.method, req.url,
+                resp.status,
+                resp.headers.get('Content-Type'),
+                resp.headers.get('X-Deliverance-Page-Class'),
+                tuple(req.environ.get('deliverance.page_classes', ())),
+                tuple((name.lower(), req.headers.get(name)) for name in vary),
+                body_hash(body),
+                rule_set.version,
+                getattr(theme_cache, 'version', None),
+                default_theme)
+
+    def lookup(self, key):
+        """
+        Returns the cached ``(content_type, body)`` for the key, or
+        None
+        """
+        with self.lock:
+            # (peek, so that only these counters count the lookup:)
+            entry = self.pages.peek(key)
+            if entry is not None and entry[0] < time.time():
+                self.pages.pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Mark it as recently used:
+            self.pages.set(key, entry)
+            return entry[1:]
+
+    def store(self, key, resp):
+        """Stores the themed response"""
+        self.pages.set(key, (time.time() + self.ttl,
+                             resp.headers.get('Content-Type'), resp.body))
+
+    def clear(self):
+        """Forget all the cached pages"""
+        self.pages.clear()
+
+    def stats(self):
+        """Returns a dictionary of ``size``, ``max_size``, ``hits`` and ``misses``"""
+        with self.lock:
+            return dict(size=len(self.pages), max_size=self.pages.max_size,
+                        hits=self.hits, misses=self.misses)
+
+class NonHTMLPaths(object):
+    """
+    A bounded table of the paths that have returned something other
+    than HTML, so that later requests for them are passed straight to
+    the application (without getting the rules or looking at the
+    response).
+
+    Only ``GET`` and ``HEAD`` requests without a query string are
+    looked up, and only ``200 OK`` responses without a ``Vary`` header
+    are learned.  Paths are kept per ``Accept`` header, so that a
+    content-negotiated path that answers one client with JSON is still
+    themed for clients that ask for HTML.  A path is forgotten after
+    `ttl` seconds, in case it starts returning HTML.
+
+    A `max_size` of 0 disables the table.
+    """
+
+    def __init__(self, max_size=1000, ttl=300):
+        self.paths = LRUCache(max_size)
+        self.ttl = ttl
+
+    def key(self, req):
+        """The key for the request, or None if it isn't kept"""
+        if req.method not in ('GET', 'HEAD') or req.query_string:
+            return None
+        return (req.host, req.script_name, req.path_info,
+                req.headers.get('Accept'))
+
+    def is_known(self, req):
+        """True if the request is for a known non-HTML path"""
+        key = self.key(req)
+        if key is None:
+            return False
+        expires = self.paths.get(key)
+        if expires is None:
+            return False
+        if expires < time.time():
+            self.paths.pop(key)
+            return False
+        return True
+
+    def learn(self, req, status, headers):
+        """
+        Notes the path of the request if the response (its status
+        string and list of headers) is non-HTML
+        """
+        key = self.key(req)
+        if key is None or not status.startswith('200'):
+            return
+        content_type = None
+        for name, value in headers:
+            name = name.lower()
+            if name == 'vary':
+                # The response depends on more than the path:
+                return
+            elif name == 'content-type':
+                content_type = value.split(';')[0].strip().lower()
+        if content_type is not None and content_type != 'text/html':
+            self.paths.set(key, time.time() + self.ttl)
+
+    def clear(self):
+        """Forget all the paths"""
+        self.paths.clear()
+
+    def stats(self):
+        """Hit/miss counters and size, see `LRUCache.stats`"""
+        return self.paths.stats()
+
+class FileContents(object):
+    """
+    A bounded cache of the contents of local files (the ``file:``
+    themes, rules and resources that Deliverance parses), keyed by
+    filename and kept until the file's modification time or size
+    changes.
+
+    Files larger than `max_file_size` bytes are read but not kept.  A
+    `max_size` of 0 disables the cache.
+    """
+
+    def __init__(self, max_size=50, max_file_size=1024*1024):
+        self.files = LRUCache(max_size)
+        self.max_file_size = max_file_size
+
+    def read(self, filename, stat=None):
+        """
+        Returns the contents of the file.  `stat` is the result of
+        ``os.stat(filename)``, if the caller already has it.
+        """
+        if stat is None:
+            stat = os.stat(filename)
+        version = (stat.st_mtime, stat.st_size)
+        cached = self.files.get(filename)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with open(filename, 'rb') as f:
+            body = f.read()
+        if len(body) <= self.max_file_size:
+            self.files.set(filename, (version, body))
+        elif cached is not None:
+            self.files.pop(filename)
+        return body
+
+    def clear(self):
+        """Forget all the files"""
+        self.files.clear()
+
+    def stats(self):
+        """Hit/miss counters and size, see `LRUCache.stats`"""
+        return self.files.stats()
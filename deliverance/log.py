@@ -7,6 +7,7 @@ messages to be strictly per-request.
 """
 
 import logging
+import sys
 from lxml.etree import tostring, _Element
 from tempita import HTMLTemplate, html_quote, html
 from deliverance.security import display_logging, edit_local_files
@@ -15,33 +16,108 @@ NOTIFY = (logging.INFO + logging.WARN) / 2
 
 logging.addLevelName(NOTIFY, 'NOTIFY')
 
+def format_message(msg, args, kw):
+    """Formats a log message with its arguments"""
+    if args:
+        return msg % args
+    elif kw:
+        return msg % kw
+    return msg
+
+def log_displayed(request):
+    """
+    True if the log of the request might be displayed (it was asked
+    for with ``deliv_log``, and the user may see it).  Without a
+    request or a security context this can't be known, and is true.
+    """
+    if request is None:
+        return True
+    if 'deliverance.security_context' not in request.environ:
+        return True
+    return 'deliv_log' in request.GET and display_logging(request)
+
+class ElementSnapshot(object):
+    """
+    A compact description of an element (its tag, source line and
+    path in its document), kept by the log in place of the element so
+    that the document isn't kept alive with the log.
+    """
+
+    __slots__ = ('tag', 'sourceline', 'path')
+
+    def __init__(self, el):
+        if isinstance(el.tag, str):
+            self.tag = el.tag
+        else:
+            # Comments and processing instructions:
+            self.tag = el.tag.__name__.lower()
+        self.sourceline = el.sourceline
+        self.path = el.getroottree().getpath(el)
+
+    def log_description(self, log=None):
+        """The description shown in the log"""
+        parts = ['&lt;%s&gt;' % html_quote(self.tag)]
+        if self.sourceline:
+            parts.append('line %s' % self.sourceline)
+        parts.append(html_quote(self.path))
+        return ' '.join(parts)
+
+    def __str__(self):
+        return '<%s> %s' % (self.tag, self.path)
+
 class SavingLogger(object):
     """
     Logger that saves all its messages locally.
+
+    Messages are kept unformatted, and formatted when they are
+    displayed.  Debug and info messages are only kept at all if
+    `debug_enabled` is true, which by default it is when the log
+    might be displayed (see `log_displayed`).
+
+    If `retain_elements` is false, elements given as the context of a
+    message are replaced with an `ElementSnapshot`, and elements in
+    the arguments are formatted right away, so the log holds no
+    references to the content or theme documents.
     """
-    def __init__(self, request, middleware):
-        self.messages = []
+    def __init__(self, request, middleware, debug_enabled=None,
+                 retain_elements=True):
+        # List of (level, el, msg, args, kw):
+        self.records = []
         self.middleware = middleware
         self.request = request
+        if debug_enabled is None:
+            debug_enabled = log_displayed(request)
+        self.debug_enabled = debug_enabled
+        self.retain_elements = retain_elements
         # This is writable:
         self.theme_url = None
         # Also writable (list of (url, name))
         self.edit_urls = []
 
+    @property
+    def messages(self):
+        """The list of ``(level, el, formatted_message)``"""
+        return [(level, el, format_message(msg, args, kw))
+                for level, el, msg, args, kw in self.records]
+
     def message(self, level, el, msg, *args, **kw):
-        """Add one message at the given log level"""
-        if args:
-            msg = msg % args
-        elif kw:
-            msg = msg % kw
-        self.messages.append((level, el, msg))
-        return msg
+        """Add one message at the given log level (`msg` is formatted
+        with the arguments when it is displayed)"""
+        if not self.retain_elements:
+            if isinstance(el, _Element):
+                el = ElementSnapshot(el)
+            if [arg for arg in args if isinstance(arg, _Element)]:
+                args = tuple(str(arg) if isinstance(arg, _Element) else arg
+                             for arg in args)
+        self.records.append((level, el, msg, args, kw))
     def debug(self, el, msg, *args, **kw):
         """Log at the DEBUG level"""
-        return self.message(logging.DEBUG, el, msg, *args, **kw)
+        if self.debug_enabled:
+            self.message(logging.DEBUG, el, msg, *args, **kw)
     def info(self, el, msg, *args, **kw):
         """Log at the INFO level"""
-        return self.message(logging.INFO, el, msg, *args, **kw)
+        if self.debug_enabled:
+            self.message(logging.INFO, el, msg, *args, **kw)
     def notify(self, el, msg, *args, **kw):
         """Log at the NOTIFY level"""
         return self.message(NOTIFY, el, msg, *args, **kw)
@@ -56,6 +132,28 @@ class SavingLogger(object):
         """Log at the FATAL level"""
         return self.message(logging.FATAL, el, msg, *args, **kw)
 
+    def stats(self):
+        """
+        Returns a dictionary of the number of ``messages``, an
+        estimate of the ``bytes`` their records take (not counting
+        the context objects), and the number of ``documents`` kept
+        alive by element contexts.
+        """
+        size = sys.getsizeof(self.records)
+        documents = set()
+        for record in self.records:
+            level, el, msg, args, kw = record
+            size += sys.getsizeof(record) + sys.getsizeof(msg)
+            size += sys.getsizeof(args) + sys.getsizeof(kw)
+            for arg in list(args) + list(kw.values()):
+                size += sys.getsizeof(arg)
+            if isinstance(el, ElementSnapshot):
+                size += sys.getsizeof(el) + sys.getsizeof(el.path)
+            elif isinstance(el, _Element):
+                documents.add(id(el.getroottree().getroot()))
+        return dict(messages=len(self.records), bytes=size,
+                    documents=len(documents))
+
     def finish_request(self, req, resp):
         """Called by the middleware at the end of the request.
 
@@ -93,9 +191,11 @@ class SavingLogger(object):
       {{endif}}
     </div>
 
-    {{if log.messages}}
+    {{if log.records}}
       {{div}}
-      {{h2}}Log</h2>
+      {{py:stats = log.stats()}}
+      {{h2}}Log ({{stats['messages']}} messages, about {{stats['bytes'] // 1024 + 1}}Kb,
+        {{stats['documents']}} documents kept)</h2>
       {{div_inner}}
       <table>
           <tr>
@@ -160,9 +260,9 @@ class SavingLogger(object):
         """
         Yields a list of ``(level, level_name, context_el, rendered_message)``
         """
-        for level, el, msg in self.messages:
+        for level, el, msg, args, kw in self.records:
             level_name = logging.getLevelName(level)
-            yield level, level_name, el, msg
+            yield level, level_name, el, format_message(msg, args, kw)
 
     def obj_as_html(self, el):
         """
@@ -202,16 +302,18 @@ class PrintingLogger(SavingLogger):
     immediately"""
 
     def __init__(self, request, middleware, print_level=logging.DEBUG):
-        super(PrintingLogger, self).__init__(request, middleware)
+        super(PrintingLogger, self).__init__(
+            request, middleware,
+            debug_enabled=print_level <= logging.INFO or None)
         self.print_level = print_level
 
     def message(self, level, el, msg, *args, **kw):
         """Add one message at the given log level"""
-        msg = super(PrintingLogger, self).message(level, el, msg, *args, **kw)
+        super(PrintingLogger, self).message(level, el, msg, *args, **kw)
         if level >= self.print_level:
+            msg = format_message(msg, args, kw)
             if isinstance(el, _Element):
                 s = tostring(el)
             else:
                 s = str(el)
             print('%s (%s)' % (msg, s))
-        return msg
@@ -10,6 +10,8 @@ import urllib.parse
 import re
 import simplejson
 import datetime
+import time
+from html import unescape as html_unescape
 from webob import Request, Response
 from webob import exc
 from wsgiproxy.exactproxy import proxy_exact_request
@@ -19,9 +21,14 @@ from pygments.formatters import HtmlFormatter
 from tempita import HTMLTemplate, html
 from lxml.etree import _Element, XMLSyntaxError
 from lxml.html import fromstring, document_fromstring, tostring, Element
+from deliverance.cache import CachedDocument, FileContents, FragmentCache, NonHTMLPaths, OutputCache, ThemeCache, file_etag
 from deliverance.log import SavingLogger
 from deliverance.security import display_logging, display_local_files, edit_local_files
 from deliverance.util.filetourl import url_to_filename
+from deliverance.util.filewatcher import FileWatcher
+from deliverance.util.lrucache import LRUCache
+from deliverance.util.prescan import Prescan
+from deliverance.util.proxiedbody import attached_body
 from deliverance.editor.editorapp import Editor
 from deliverance.rules import clientside_action
 from deliverance.ruleset import RuleSet
@@ -40,7 +47,9 @@ class DeliveranceMiddleware(object):
 
     ## FIXME: is log_factory etc very useful?
     def __init__(self, app, rule_getter, log_factory=SavingLogger, 
-                 log_factory_kw={}, default_theme=None):
+                 log_factory_kw={}, default_theme=None, theme_cache=None,
+                 fragment_cache=None, output_cache=None, prefetch_pool=None,
+                 http_client=None, non_html_paths=None, file_contents=None):
         self.app = app
         self.rule_getter = rule_getter
         self.log_factory = log_factory
@@ -48,6 +57,32 @@ class DeliveranceMiddleware(object):
 
         self._default_theme = default_theme
 
+        # Parsed themes are kept between requests; pass in
+        # ThemeCache(max_size=0) to disable this:
+        if theme_cache is None:
+            theme_cache = ThemeCache()
+        self.theme_cache = theme_cache
+        # Likewise for the resources fetched by href actions:
+        if fragment_cache is None:
+            fragment_cache = FragmentCache()
+        self.fragment_cache = fragment_cache
+        # An OutputCache to keep whole themed pages (off by default):
+        self.output_cache = output_cache
+        # An executor (e.g., a ThreadPoolExecutor) to fetch the href
+        # resources of a page at the same time (off by default):
+        self.prefetch_pool = prefetch_pool
+        # The WSGI application that makes external subrequests (e.g.,
+        # a deliverance.util.httppool.ConnectionPool):
+        self.http_client = http_client or proxy_exact_request
+        # A NonHTMLPaths, to pass paths that are known not to be HTML
+        # straight through (off by default):
+        self.non_html_paths = non_html_paths
+        # The contents of file: resources, kept until the file
+        # changes; pass in FileContents(max_size=0) to disable this:
+        if file_contents is None:
+            file_contents = FileContents()
+        self.file_contents = file_contents
+
         ## FIXME: clearly, this should not be a dictionary:
         self.known_html = set()
         self.known_titles = {}
@@ -94,15 +129,18 @@ class DeliveranceMiddleware(object):
             log = self.log_factory(req, self, **self.log_factory_kw)
             ## FIXME: should this be put in both the orig_req and this req?
             req.environ['deliverance.log'] = log
-        def resource_fetcher(url, retry_inner_if_not_200=False):
+        def resource_fetcher(url, retry_inner_if_not_200=False, extra_headers=None):
             """
             Return the Response object for the given URL
             """
-            return self.get_resource(url, orig_req, log, retry_inner_if_not_200)
+            return self.get_resource(url, orig_req, log, retry_inner_if_not_200,
+                                     extra_headers=extra_headers)
         if req.path_info_peek() == '.deliverance':
             req.path_info_pop()
             resp = self.internal_app(req, resource_fetcher)
             return resp(environ, start_response)
+        if self.non_html_paths is not None and self.non_html_paths.is_known(req):
+            return self.app(environ, start_response)
         rule_set = self.rule_getter(resource_fetcher, self.app, orig_req)
         clientside = rule_set.check_clientside(req, log)
         if clientside and req.url in self.known_html:
@@ -120,23 +158,21 @@ class DeliveranceMiddleware(object):
             head_response = head_req.get_response(self.app)
             req.method = "GET"
 
-        resp = req.get_response(self.app)
-
-        ## FIXME: also XHTML?
-        if resp.content_type != 'text/html':
-            ## FIXME: remove from known_html?
-            return resp(environ, start_response)
-        
-        # XXX: Not clear why such responses would have a content type, but
-        # they sometimes do (from Zope/Plone, at least) and that then breaks
-        # when trying to apply a theme.
-        if resp.status_int in (301, 302, 304):
-            return resp(environ, start_response)
-            
-        if resp.content_length == 0:
-            return resp(environ, start_response)
-
-        if resp.body == '':
+        # The app_iter is only read if the response will be themed:
+        status, headers, app_iter = req.call_application(self.app)
+        if not self.will_theme(int(status.split()[0]), headers):
+            if self.non_html_paths is not None:
+                self.non_html_paths.learn(req, status, headers)
+            start_response(status, headers)
+            return app_iter
+        resp = Response(status=status, headerlist=list(headers),
+                        app_iter=app_iter, request=req)
+
+        if rule_set.aborts_before_body(req, resp, log):
+            # Passed on without reading the body, so it can be streamed:
+            return (head_response or resp)(environ, start_response)
+
+        if not self.themeable(resp):
             return resp(environ, start_response)
 
         if clientside and req.url not in self.known_html:
@@ -144,12 +180,8 @@ class DeliveranceMiddleware(object):
                       % req.url)
             self.known_titles[req.url] = self._get_title(resp.body)
             self.known_html.add(req.url)
-        resp = rule_set.apply_rules(req, resp, resource_fetcher, log, 
-                                    default_theme=self.default_theme(environ))
-        if clientside:
-            resp.decode_content()
-            resp.body = self._substitute_jsenable(resp.body)
-        resp = log.finish_request(req, resp)
+        resp = self.theme_response(req, resp, rule_set, resource_fetcher, log,
+                                   clientside=clientside)
 
         if head_response:
             head_response.headers = resp.headers
@@ -157,14 +189,95 @@ class DeliveranceMiddleware(object):
 
         return resp(environ, start_response)
 
-    _title_re = re.compile(r'<title>(.*?)</title>', re.I|re.S)
+    def will_theme(self, status, headers):
+        """
+        False if a response with this status (an integer) and headers
+        (a list of ``(name, value)``) can't be themed, whatever its
+        body; the body is only read when this is true.
+        """
+        # XXX: Not clear why such responses would have a content type, but
+        # they sometimes do (from Zope/Plone, at least) and that then breaks
+        # when trying to apply a theme.
+        if status in (301, 302, 304):
+            return False
+        content_type = None
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-type':
+                content_type = value.split(';')[0].strip().lower()
+            elif name == 'content-length' and value.strip() == '0':
+                return False
+        ## FIXME: also XHTML?
+        ## FIXME: remove from known_html?
+        return content_type == 'text/html'
 
-    def _get_title(self, body):
-        match = self._title_re.search(body)
-        if match:
-            return match.group(1)
+    def themeable(self, resp):
+        """
+        True if the response from the application is something
+        Deliverance should apply the theme to.
+        """
+        if not self.will_theme(resp.status_int, resp.headerlist):
+            return False
+
+        proxied = attached_body(resp)
+        if proxied is not None:
+            # Without serializing the body:
+            return not proxied.is_empty()
+        if resp.body == '':
+            return False
+        return True
+
+    def cached_output(self, req, resp, rule_set):
+        """
+        Returns ``(cache_key, cached)``: the key of the response in the
+        output cache (None if it can't be cached) and the cached
+        themed page (None if there isn't one).
+        """
+        cache_key = cached = None
+        if (self.output_cache is not None
+            and self.output_cache.is_cacheable(req, resp, rule_set)):
+            cache_key = self.output_cache.key(
+                req, resp, rule_set, self.theme_cache,
+                default_theme=self.default_theme(req.environ))
+            cached = self.output_cache.lookup(cache_key)
+        return cache_key, cached
+
+    def theme_response(self, req, resp, rule_set, resource_fetcher, log,
+                       clientside=False, output=None, selection=None):
+        """
+        Applies the rules to the response (or uses the output cache),
+        returning the themed response.
+
+        `output` is the result of :meth:`cached_output` and
+        `selection` that of
+        :meth:`deliverance.ruleset.RuleSet.select_rules`, if they have
+        already been worked out.
+        """
+        if clientside:
+            cache_key = cached = None
+        elif output is None:
+            cache_key, cached = self.cached_output(req, resp, rule_set)
         else:
-            return None
+            cache_key, cached = output
+        if cached is not None:
+            log.debug(self, 'Using the cached themed page for %s', req.url)
+            resp.headers['Content-Type'], resp.body = cached
+        else:
+            resp = rule_set.apply_rules(req, resp, resource_fetcher, log, 
+                                        default_theme=self.default_theme(req.environ),
+                                        theme_cache=self.theme_cache,
+                                        fragment_cache=self.fragment_cache,
+                                        prefetch_pool=self.prefetch_pool,
+                                        selection=selection)
+            if cache_key is not None:
+                self.output_cache.store(cache_key, resp)
+        if clientside:
+            resp.decode_content()
+            resp.body = self._substitute_jsenable(resp.body)
+        return log.finish_request(req, resp)
+
+    def _get_title(self, body):
+        return Prescan(body).title
 
     _end_head_re = re.compile(r'</head>', re.I)
     _jsenable_js = '''\
@@ -182,17 +295,21 @@ document.cookie = 'jsEnabled=1; expires=__DATE__; path=/';
 
     def clientside_response(self, req, rule_set, resource_fetcher, log):
         theme_href = rule_set.default_theme.resolve_href(req, None, log)
-        theme_doc = rule_set.get_theme(theme_href, resource_fetcher, log)
+        theme_doc = rule_set.get_theme(theme_href, resource_fetcher, log,
+                                       theme_cache=self.theme_cache)
         js = CLIENTSIDE_JAVASCRIPT.replace('__DELIVERANCE_URL__', req.application_url)
         theme_doc.head.insert(0, fromstring('''\
 <script type="text/javascript">
 %s
 </script>''' % js))
-        theme = tostring(theme_doc)
-        ## FIXME: cache this, use the actual subresponse to get proper last-modified, etc
         title = self.known_titles.get(req.url)
         if title:
-            theme = self._title_re.sub('<title>%s</title>' % title, theme)
+            # The title of the page, which is only known as markup:
+            for title_el in theme_doc.iter('title'):
+                title_el.text = html_unescape(title)
+                break
+        theme = tostring(theme_doc)
+        ## FIXME: cache this, use the actual subresponse to get proper last-modified, etc
         resp = Response(theme, conditional_response=True)
         if not resp.etag:
             resp.md5_etag()
@@ -200,8 +317,9 @@ document.cookie = 'jsEnabled=1; expires=__DATE__; path=/';
 
     def get_resource(self, url, orig_req, log,
                      retry_inner_if_not_200=False,
-                     redirections=5):
-        resp = self._get_resource(url, orig_req, log, retry_inner_if_not_200)
+                     redirections=5, extra_headers=None):
+        resp = self._get_resource(url, orig_req, log, retry_inner_if_not_200,
+                                  extra_headers=extra_headers)
         if not resp.status.startswith("3") or not resp.location:
             return resp
         max_redirections = redirections
@@ -210,7 +328,8 @@ document.cookie = 'jsEnabled=1; expires=__DATE__; path=/';
             log.debug(self, "Request for %s returned %s; following redirect Location: %s" % (
                     url, resp.status, resp.location))
             url = resp.location
-            resp = self._get_resource(url, orig_req, log, retry_inner_if_not_200)
+            resp = self._get_resource(url, orig_req, log, retry_inner_if_not_200,
+                                      extra_headers=extra_headers)
             if not resp.status.startswith("3") or not resp.location:
                 return resp
         log.debug(self, "Max redirects (%s) reached; returning response %s from %s" % (
@@ -218,7 +337,7 @@ document.cookie = 'jsEnabled=1; expires=__DATE__; path=/';
         return resp
 
     def _get_resource(self, url, orig_req, log,
-                      retry_inner_if_not_200=False):
+                      retry_inner_if_not_200=False, extra_headers=None):
         """
         Gets the resource at the given url, using the original request
         `orig_req` as the basis for constructing the subrequest.
@@ -233,6 +352,10 @@ document.cookie = 'jsEnabled=1; expires=__DATE__; path=/';
         described above, non-200 responses from the inner app will be tossed
         out, and the request will be retried as an external http request.
         Currently this is used only by RuleSet.get_theme
+
+        `extra_headers` is a dictionary of headers to add to the
+        subrequest (used for conditional requests); any conditional
+        headers of the original request are dropped in that case.
         """
         assert url is not None
         if url.lower().startswith('file:'):
@@ -243,7 +366,9 @@ document.cookie = 'jsEnabled=1; expires=__DATE__; path=/';
                 return exc.HTTPForbidden(
                     "You cannot access file: URLs (like %r)" % url)
             filename = url_to_filename(url)
-            if not os.path.exists(filename):
+            try:
+                stat = os.stat(filename)
+            except OSError:
                 return exc.HTTPNotFound(
                     "The file %r was not found" % filename)
             if os.path.isdir(filename):
@@ -254,23 +379,14 @@ document.cookie = 'jsEnabled=1; expires=__DATE__; path=/';
             if not type:
                 type = 'application/octet-stream'
             subresp.content_type = type
-            ## FIXME: reading the whole thing obviously ain't great:
-            f = open(filename, 'rb')
-            subresp.body = f.read()
-            f.close()
+            subresp.body = self.file_contents.read(filename, stat)
+            subresp.last_modified = stat.st_mtime
+            subresp.headers['ETag'] = file_etag(stat)
             return subresp
 
         elif self.use_internal_subrequest(url, orig_req, log):
-            subreq = orig_req.copy_get()
-            subreq.environ['deliverance.subrequest_original_environ'] = orig_req.environ
-            new_path_info = url[len(orig_req.application_url):]
-            query_string = ''
-            if '?' in new_path_info:
-                new_path_info, query_string = new_path_info.split('?', 1)
-            new_path_info = urllib.parse.unquote(new_path_info)
-            assert new_path_info.startswith('/')
-            subreq.path_info = new_path_info
-            subreq.query_string = query_string
+            subreq = self.build_internal_subrequest(url, orig_req, log,
+                                                    extra_headers=extra_headers)
             subresp = subreq.get_response(self.app)
             ## FIXME: error if not HTML?
             ## FIXME: handle redirects?
@@ -294,11 +410,34 @@ document.cookie = 'jsEnabled=1; expires=__DATE__; path=/';
             
         ## FIXME: pluggable subrequest handler?
         subreq = self.build_external_subrequest(url, orig_req, log)
-        subresp = subreq.get_response(proxy_exact_request)
+        if extra_headers:
+            subreq.headers.update(extra_headers)
+        subresp = subreq.get_response(self.http_client)
         log.debug(self, 'External request for %s: %s content-type: %s',
                   url, subresp.status, subresp.content_type)
         return subresp
 
+    def build_internal_subrequest(self, url, orig_req, log, extra_headers=None):
+        """
+        Returns a webob.Request for getting ``url`` from the wrapped
+        application (see :meth:`use_internal_subrequest`), based on
+        the original request.
+        """
+        subreq = orig_req.copy_get()
+        subreq.environ['deliverance.subrequest_original_environ'] = orig_req.environ
+        new_path_info = url[len(orig_req.application_url):]
+        query_string = ''
+        if '?' in new_path_info:
+            new_path_info, query_string = new_path_info.split('?', 1)
+        new_path_info = urllib.parse.unquote(new_path_info)
+        assert new_path_info.startswith('/')
+        subreq.path_info = new_path_info
+        subreq.query_string = query_string
+        if extra_headers:
+            subreq.remove_conditional_headers()
+            subreq.headers.update(extra_headers)
+        return subreq
+
     def build_external_subrequest(self, url, orig_req, log):
         """
         Returns a webob.Request to be used when Deliverance is getting
@@ -679,21 +818,35 @@ class SubrequestRuleGetter(object):
     An implementation of `rule_getter` for `DeliveranceMiddleware`.
     This retrieves and instantiates the rules using a subrequest with
     the given url.
+
+    The parsed rules are kept (for up to `max_size` rule URLs) along
+    with the validators of the rule document.  The document is
+    revalidated at most every `min_interval` seconds (or less often,
+    if its caching headers allow), with ``If-None-Match`` /
+    ``If-Modified-Since``; the rules are only parsed again when the
+    document has changed.
     """
 
-    _response = None
-    
-    def __init__(self, url):
+    def __init__(self, url, min_interval=1, max_size=20):
         self.url = url
+        self.min_interval = min_interval
+        # url -> CachedDocument, with the RuleSet as the doc:
+        self.rulesets = LRUCache(max_size)
         
     def __call__(self, get_resource, app, orig_req):
         url = urllib.parse.urljoin(orig_req.url, self.url)
-        doc_resp = get_resource(url)
-        if doc_resp.status_int == 304 and self._response is not None:
-            doc_resp = self._response
-        elif doc_resp.status_int == 200:
-            self._response = doc_resp
+        entry = self.rulesets.get(url)
+        if entry is not None and (
+            entry.is_fresh() or time.time() - entry.checked < self.min_interval):
+            return entry.doc
+        if entry is not None and entry.conditional_headers():
+            doc_resp = get_resource(url, extra_headers=entry.conditional_headers())
         else:
+            doc_resp = get_resource(url)
+        if entry is not None and entry.is_current(doc_resp):
+            entry.touch(doc_resp)
+            return entry.doc
+        if doc_resp.status_int != 200:
             ## FIXME: better error
             assert 0, "Bad response: %r" % doc_resp
         ## FIXME: better content-type detection
@@ -708,7 +861,9 @@ class SubrequestRuleGetter(object):
             raise Exception('Invalid syntax in %s: %s' % (url, e))
         assert doc.tag == 'ruleset', (
             'Bad rule tag <%s> in document %s' % (doc.tag, url))
-        return RuleSet.parse_xml(doc, url)
+        rule_set = RuleSet.parse_xml(doc, url)
+        self.rulesets.set(url, CachedDocument(url, doc_resp, rule_set))
+        return rule_set
 
 from lxml.etree import parse
 class FileRuleGetter(object):
@@ -716,7 +871,10 @@ class FileRuleGetter(object):
     An implementation of `rule_getter` for `DeliveranceMiddleware`.
     This reads the rules from a file.
 
-    If always_reload=True, the file will be re-read on every request.
+    If always_reload=True, the file is watched (see
+    :class:`deliverance.util.filewatcher.FileWatcher`) and the rules
+    are re-read when it changes.  If the changed file can't be read
+    the previous rules are kept.
     """
 
     def load_rules(self):
@@ -730,20 +888,29 @@ class FileRuleGetter(object):
             raise Exception('Invalid syntax in %s: %s' % (filename, e))
         assert doc.tag == 'ruleset', (
             'Bad rule tag <%s> in document %s' % (doc.tag, filename))
-        assert doc.tag == 'ruleset', (
-            'Bad rule tag <%s> in document %s' % (doc.tag, filename))
         self.ruleset = RuleSet.parse_xml(doc, filename)
+
+    def reload_rules(self):
+        """Called by the watcher when the file changes"""
+        try:
+            self.load_rules()
+        except Exception as e:
+            print('Error in rule file %s (still using the previous rules): %s'
+                  % (self.filename, e))
         
     def __init__(self, filename, always_reload=False):
         self.filename = filename
         self.always_reload = always_reload
         self.load_rules()
+        self.watcher = None
+        if always_reload:
+            self.watcher = FileWatcher([filename], self.reload_rules)
+            self.watcher.start()
 
     def __call__(self, get_resource, app, orig_req):
-        if self.always_reload:
-            self.load_rules()
         return self.ruleset
 
+from concurrent.futures import ThreadPoolExecutor
 from deliverance import security
 from paste.deploy.converters import asbool
 
@@ -751,7 +918,13 @@ def make_deliverance_middleware(app, global_conf,
                                 rule_uri=None, rule_filename=None,
                                 theme_uri=None,
                                 debug=None,
-                                execute_pyref=None):
+                                execute_pyref=None,
+                                output_cache_size=None,
+                                output_cache_ttl=None,
+                                prefetch_threads=None,
+                                retain_log_elements=None,
+                                non_html_paths_size=None,
+                                non_html_paths_ttl=None):
 
     assert sum([bool(x) for x in [rule_uri, rule_filename]]) == 1, (
         "You must give one, and only one, of rule_uri or rule_filename")
@@ -771,7 +944,29 @@ def make_deliverance_middleware(app, global_conf,
     
     execute_pyref = asbool(execute_pyref)
 
-    app = DeliveranceMiddleware(app, rule_getter, default_theme=theme_uri)
+    output_cache = None
+    if output_cache_size and int(output_cache_size) > 0:
+        output_cache = OutputCache(max_size=int(output_cache_size),
+                                   ttl=int(output_cache_ttl or 60))
+
+    prefetch_pool = None
+    if prefetch_threads and int(prefetch_threads) > 0:
+        prefetch_pool = ThreadPoolExecutor(max_workers=int(prefetch_threads))
+
+    non_html_paths = None
+    if non_html_paths_size and int(non_html_paths_size) > 0:
+        non_html_paths = NonHTMLPaths(max_size=int(non_html_paths_size),
+                                      ttl=int(non_html_paths_ttl or 300))
+
+    log_factory_kw = {}
+    if retain_log_elements is not None:
+        log_factory_kw['retain_elements'] = asbool(retain_log_elements)
+
+    app = DeliveranceMiddleware(app, rule_getter, default_theme=theme_uri,
+                                log_factory_kw=log_factory_kw,
+                                output_cache=output_cache,
+                                prefetch_pool=prefetch_pool,
+                                non_html_paths=non_html_paths)
 
     app = security.SecurityContext.middleware(
         app,
@@ -4,6 +4,7 @@ Handles the <match> tag and matching requests and responses against these patter
 
 from deliverance.exceptions import DeliveranceSyntaxError, AbortTheme
 from deliverance.stringmatch import compile_matcher, compile_header_matcher
+from deliverance.stringmatch import HeaderGroup, PatternGroup
 from deliverance.util.converters import asbool, html_quote
 from deliverance.pyref import PyReference
 from deliverance.security import execute_pyref
@@ -114,19 +115,30 @@ class AbstractMatch(object):
         """The return value is used for the context to ``log.debug()`` etc methds"""
         return self
 
-    def __call__(self, request, resp, response_headers, log):
+    def __call__(self, request, resp, response_headers, log, known=None):
         """
         Checks this match against the given request and
         response_headers object.
 
         `response_headers` should be a case-insensitive dictionary.
         `request` should be a :class:webob.Request object.
+
+        `known` is an optional dictionary of results already worked
+        out for this match (see `MatchIndex`): ``path`` and ``domain``
+        are booleans, ``request_header`` and ``response_header`` are
+        ``(result, header_names)``.
         """
+        if known is None:
+            known = {}
         result = True
         debug_name = self.debug_description()
         debug_context = self.log_context()
         if self.path:
-            if not self.path(request.path):
+            if 'path' in known:
+                result = known['path']
+            else:
+                result = self.path(request.path)
+            if not result:
                 log.debug(
                     debug_context, 'Skipping %s because request URL (%s) does not '
                     'match path="%s"',
@@ -134,14 +146,21 @@ class AbstractMatch(object):
                 return False
         if self.domain:
             host = request.host.split(':', 1)[0]
-            if not self.domain(host):
+            if 'domain' in known:
+                result = known['domain']
+            else:
+                result = self.domain(host)
+            if not result:
                 log.debug(
                     debug_context, 'Skipping %s because request domain (%s) does '
                     'not match domain="%s"',
                     debug_name, host, self.domain)
                 return False
         if self.request_header:
-            result, headers = self.request_header(request.headers)
+            if 'request_header' in known:
+                result, headers = known['request_header']
+            else:
+                result, headers = self.request_header(request.headers)
             if not result:
                 log.debug(
                     debug_context, 'Skipping %s because request headers %s do not '
@@ -149,7 +168,10 @@ class AbstractMatch(object):
                     debug_name, ', '.join(headers), self.request_header)
                 return False
         if self.response_header:
-            result, headers = self.response_header(response_headers)
+            if 'response_header' in known:
+                result, headers = known['response_header']
+            else:
+                result, headers = self.response_header(response_headers)
             if not result:
                 header_debug = []
                 for header in headers:
@@ -269,13 +291,58 @@ class ClientsideMatch(AbstractMatch):
         """Description for debugging messages"""
         return ''
 
-def run_matches(matchers, request, resp, response_headers, log):
+class MatchIndex(object):
+    """
+    The ``path``, ``domain`` and header patterns of a list of match
+    objects compiled together (see
+    :class:`deliverance.stringmatch.PatternGroup` and
+    :class:`deliverance.stringmatch.HeaderGroup`), so that they are
+    checked against a request all at once.
+
+    The match objects still decide (and log) in order, using these
+    results; see `run_matches`.
+    """
+
+    def __init__(self, matchers):
+        self.matchers = matchers
+        self.paths = PatternGroup([m.path for m in matchers])
+        self.domains = PatternGroup([m.domain for m in matchers])
+        self.request_headers = HeaderGroup([m.request_header for m in matchers])
+        self.response_headers = HeaderGroup([m.response_header for m in matchers])
+
+    def evaluate(self, request, response_headers):
+        """
+        Returns a list with the ``known`` results (see
+        `AbstractMatch.__call__`) for each match object
+        """
+        paths = self.paths.matching(request.path)
+        domains = self.domains.matching(request.host.split(':', 1)[0])
+        request_headers = self.request_headers.results(request.headers)
+        response_headers = self.response_headers.results(response_headers)
+        known = []
+        for index, matcher in enumerate(self.matchers):
+            results = {'path': index in paths, 'domain': index in domains}
+            if index in request_headers:
+                results['request_header'] = request_headers[index]
+            if index in response_headers:
+                results['response_header'] = response_headers[index]
+            known.append(results)
+        return known
+
+def run_matches(matchers, request, resp, response_headers, log, index=None):
     """
     Runs all the match objects in matchers, returning the list of matched classes.
+
+    If a `MatchIndex` of the matchers is given, it is used to check
+    their patterns all at once.
     """
+    if index is not None:
+        known = index.evaluate(request, response_headers)
+    else:
+        known = [None] * len(matchers)
     results = []
-    for matcher in matchers:
-        classes = matcher(request, resp, response_headers, log)
+    for matcher, matcher_known in zip(matchers, known):
+        classes = matcher(request, resp, response_headers, log, known=matcher_known)
         if classes:
             if matcher.abort:
                 log.debug(matcher, '<match> matched request, aborting')
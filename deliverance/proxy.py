@@ -12,14 +12,15 @@ import string
 import tempfile
 from deliverance.util.proxyrequest import Request, Response
 from webob import exc
-from wsgiproxy.exactproxy import proxy_exact_request
 from tempita import html_quote
 from paste.fileapp import FileApp
 from paste.deploy import loadwsgi
 from lxml.etree import tostring as xml_tostring, Comment, parse
-from lxml.html import document_fromstring, tostring
 from deliverance.exceptions import DeliveranceSyntaxError, AbortProxy
 from deliverance.pagematch import AbstractMatch
+from deliverance.stringmatch import (
+    ExactInsensitiveMatcher, ExactMatcher, PathMatcher, SubpathMatcher,
+    WildcardInsensitiveMatcher, split_path)
 from deliverance.util.converters import asbool
 from deliverance.middleware import DeliveranceMiddleware
 from deliverance.ruleset import RuleSet
@@ -30,6 +31,8 @@ from deliverance.security import execute_pyref, edit_local_files
 from deliverance.pyref import PyReference
 from deliverance.util.filetourl import filename_to_url, url_to_filename
 from deliverance.util.urlnormalize import url_normalize
+from deliverance.util.httppool import ConnectionPool
+from deliverance.util.proxiedbody import ProxiedBody, ENVIRON_KEY as PROXIED_BODY_KEY
 from deliverance.editor.editorapp import Editor
 
 class ProxySet(object):
@@ -40,20 +43,33 @@ class ProxySet(object):
 
     def __init__(self, proxies, ruleset, source_location=None, 
                  middleware_factory=None, 
-                 middleware_factory_kwargs=None):
+                 middleware_factory_kwargs=None,
+                 http_client=None):
         self.proxies = proxies
         self.ruleset = ruleset
         self.source_location = source_location
+        self.index = ProxyIndex(proxies)
+        self.edit_paths = [
+            ('/.deliverance/proxy-editor/%s/' % (index+1), proxy.editable_name)
+            for index, proxy in enumerate(proxies) if proxy.editable]
+        # The WSGI application for requests to other servers (e.g.,
+        # a deliverance.util.httppool.ConnectionPool):
+        if http_client is not None:
+            for proxy in proxies:
+                proxy.http_client = http_client
 
         middleware_factory = middleware_factory or DeliveranceMiddleware
-        middleware_factory_kwargs = middleware_factory_kwargs or {}
+        middleware_factory_kwargs = dict(middleware_factory_kwargs or {})
+        if http_client is not None:
+            middleware_factory_kwargs.setdefault('http_client', http_client)
         self.deliverator = middleware_factory(self.proxy_app, self.rule_getter, 
                                               **middleware_factory_kwargs)
 
     @classmethod
     def parse_xml(cls, el, source_location, 
                   middleware_factory=None,
-                  middleware_factory_kwargs=None):
+                  middleware_factory_kwargs=None,
+                  http_client=None):
         """Parse an instance from an XML/etree element"""
         proxies = []
         for child in el:
@@ -62,12 +78,14 @@ class ProxySet(object):
         ruleset = RuleSet.parse_xml(el, source_location)
         return cls(proxies, ruleset, source_location, 
                    middleware_factory=middleware_factory,
-                   middleware_factory_kwargs=middleware_factory_kwargs)
+                   middleware_factory_kwargs=middleware_factory_kwargs,
+                   http_client=http_client)
 
     @classmethod
     def parse_file(cls, filename,
                    middleware_factory=None,
-                   middleware_factory_kwargs=None):
+                   middleware_factory_kwargs=None,
+                   http_client=None):
         """Parse this from a filname"""
         file_url = filename_to_url(filename)
         file = open(filename)
@@ -77,7 +95,8 @@ class ProxySet(object):
         tree.xinclude()
         return cls.parse_xml(el, file_url, 
                              middleware_factory=middleware_factory,
-                             middleware_factory_kwargs=middleware_factory_kwargs)
+                             middleware_factory_kwargs=middleware_factory_kwargs,
+                             http_client=http_client)
 
     def proxy_app(self, environ, start_response):
         """Implements the proxy, finding the matching `Proxy` object and
@@ -85,12 +104,17 @@ class ProxySet(object):
         """
         request = Request(environ)
         log = environ['deliverance.log']
-        for index, proxy in enumerate(self.proxies):
-            if proxy.editable:
-                url = request.application_url + '/.deliverance/proxy-editor/%s/' % (index+1)
-                name = proxy.editable_name
-                if (url, name) not in log.edit_urls:
-                    log.edit_urls.append((url, name))
+        for path, name in self.edit_paths:
+            url = request.application_url + path
+            if (url, name) not in log.edit_urls:
+                log.edit_urls.append((url, name))
+        candidates = self.index.candidates(request)
+        if len(candidates) < len(self.proxies):
+            log.debug(
+                self, 'Trying %i of the %i <proxy> blocks (the others cannot '
+                'match the domain and path of the request)',
+                len(candidates), len(self.proxies))
+        for proxy in candidates:
             ## FIXME: obviously this is wonky:
             if proxy.match(request, None, None, log):
                 try:
@@ -128,7 +152,88 @@ class ProxySet(object):
         req = Request(environ)
         proxy = self.proxies[int(req.path_info_pop())-1]
         return proxy.edit_app(environ, start_response)
-        
+
+class ProxyIndex(object):
+    """
+    An index of the `Proxy` objects of a `ProxySet` by their
+    ``domain`` and ``path`` patterns, to find the proxies that might
+    match a request without trying each one.
+
+    Literal domains (``domain="example.com"``) are kept in a
+    dictionary, and ``path:``, ``subpath:`` and ``exact:`` paths in a
+    trie of path segments.  Proxies with any other kind of pattern
+    (wildcards, regular expressions, ``not:``...), or none, are
+    candidates for every request.  The candidates still have to match
+    in full, and are tried in the order of the rule file.
+    """
+
+    def __init__(self, proxies):
+        self.proxies = proxies
+        # host -> set of proxy indexes:
+        self.domains = {}
+        self.any_domain = set()
+        # Each node of the trie is [proxy indexes, {segment: node}]:
+        self.paths = [set(), {}]
+        self.any_path = set()
+        for index, proxy in enumerate(proxies):
+            domain = self.literal_domain(proxy.match.domain)
+            if domain is None:
+                self.any_domain.add(index)
+            else:
+                self.domains.setdefault(domain, set()).add(index)
+            segments = self.path_prefix(proxy.match.path)
+            if segments is None:
+                self.any_path.add(index)
+            else:
+                node = self.paths
+                for segment in segments:
+                    node = node[1].setdefault(segment, [set(), {}])
+                node[0].add(index)
+
+    @staticmethod
+    def literal_domain(matcher):
+        """
+        The (lower-case) domain the matcher matches, if it matches
+        just one, else None
+        """
+        if isinstance(matcher, ExactInsensitiveMatcher):
+            return matcher.pattern.lower()
+        if (isinstance(matcher, WildcardInsensitiveMatcher)
+            and not [c for c in '*?[' if c in matcher.pattern]):
+            return matcher.pattern.lower()
+        return None
+
+    @staticmethod
+    def path_prefix(matcher):
+        """
+        The segments that any path the matcher matches starts with,
+        or None if that isn't known
+        """
+        if isinstance(matcher, (PathMatcher, SubpathMatcher, ExactMatcher)):
+            return split_path(matcher.pattern)
+        return None
+
+    def candidates(self, request):
+        """
+        The proxies that might match the request, in order
+        """
+        host = request.host.split(':', 1)[0].lower()
+        indexes = self.any_domain | self.domains.get(host, set())
+        node = self.paths
+        by_path = self.any_path | node[0]
+        for segment in split_path(request.path):
+            node = node[1].get(segment)
+            if node is None:
+                break
+            by_path |= node[0]
+        return [self.proxies[index] for index in sorted(indexes & by_path)]
+
+
+# Makes the requests of proxies without a <connection-pool>: a new
+# connection for every request, with large bodies streamed as they
+# are sent on:
+default_http_client = ConnectionPool(max_per_host=None, keep_alive=False)
+
 
 class Proxy(object):
     """Represents one ``<proxy>`` element.
@@ -138,6 +243,10 @@ class Proxy(object):
     ``file:`` URLs.
     """
 
+    # The WSGI application that makes the request to the destination
+    # (set by `ProxySet`); None means `default_http_client`:
+    http_client = None
+
     def __init__(self, match, dest,
                  request_modifications, response_modifications,
                  strip_script_name=True, keep_host=False,
@@ -339,6 +448,9 @@ class Proxy(object):
         for modifier in self.response_modifications:
             response = modifier.modify_response(request, response, orig_base, 
                                                 proxied_base, proxied_url, log)
+        if isinstance(response.app_iter, ProxiedBody):
+            # So DeliveranceMiddleware can get the document from it:
+            environ[PROXIED_BODY_KEY] = response.app_iter
         return response(environ, start_response)
 
     def construct_proxy_request(self, request, dest):
@@ -423,7 +535,7 @@ class Proxy(object):
 
         proxy_req.accept_encoding = None
         try:
-            resp = proxy_req.get_response(proxy_exact_request)
+            resp = proxy_req.get_response(self.http_client or default_http_client)
             if resp.status_int == 500:
                 print('Request:')
                 print(proxy_req)
@@ -757,16 +869,13 @@ class ProxyResponseModification(object):
                     'Not rewriting links in response from %s, because Content-Type is %s'
                     % (proxied_url, response.content_type))
             else:
-                if not response.charset:
-                    ## FIXME: maybe we should guess the encoding?
-                    body = response.body
-                else:
-                    body = response.unicode_body
-                if len(body) > 0:
-                    body_doc = document_fromstring(body, base_url=proxied_url)
-                    body_doc.make_links_absolute()
-                    body_doc.rewrite_links(link_repl_func)
-                    response.body = tostring(body_doc)
+                # Rewritten as the body streams through, or in the
+                # document if the page is themed (see ProxiedBody):
+                response.decode_content()
+                response.app_iter = ProxiedBody(
+                    response.app_iter, link_repl_func, proxied_url,
+                    charset=response.charset)
+                response.content_length = None
             if response.location:
                 ## FIXME: if you give a proxy like
                 ## http://openplans.org, and it redirects to
@@ -804,7 +913,8 @@ class ProxySettings(object):
                  dev_expiration=0, dev_secret_file='/tmp/deliverance/devauth.txt',
                  source_location=None,
                  middleware_factory=None,
-                 middleware_factory_kwargs=None):
+                 middleware_factory_kwargs=None,
+                 connection_pool=None):
         self.server_host = server_host
         self.execute_pyref = execute_pyref
         self.display_local_files = display_local_files
@@ -819,6 +929,8 @@ class ProxySettings(object):
 
         self.middleware_factory = middleware_factory
         self.middleware_factory_kwargs = middleware_factory_kwargs
+        # A ConnectionPool from <connection-pool>, or None:
+        self.connection_pool = connection_pool
 
     @classmethod
     def parse_xml(cls, el, source_location, environ=None, traverse=False):
@@ -826,6 +938,7 @@ class ProxySettings(object):
 
         middleware_factory = None
         middleware_factory_kwargs = None
+        connection_pool = None
 
         if traverse and el.tag != 'server-settings':
             try:
@@ -889,6 +1002,8 @@ class ProxySettings(object):
                 ref = PyReference.parse_xml(child, source_location)
                 middleware_factory = ref.function
                 middleware_factory_kwargs = ref.args or None
+            elif child.tag == 'connection-pool':
+                connection_pool = cls.parse_connection_pool(child, environ)
             else:
                 raise DeliveranceSyntaxError(
                     'Unknown element in <server-settings>: <%s>' % child.tag,
@@ -910,7 +1025,37 @@ class ProxySettings(object):
                    source_location=source_location,
                    dev_secret_file=dev_secret_file,
                    middleware_factory=middleware_factory,
-                   middleware_factory_kwargs=middleware_factory_kwargs)
+                   middleware_factory_kwargs=middleware_factory_kwargs,
+                   connection_pool=connection_pool)
+
+    @classmethod
+    def parse_connection_pool(cls, el, environ):
+        """
+        Parses ``<connection-pool max-per-host="10" idle-timeout="30"
+        timeout="60" wait-timeout="30" />`` into a
+        :class:`deliverance.util.httppool.ConnectionPool`
+        """
+        options = {}
+        for attr, name, convert in [('max-per-host', 'max_per_host', int),
+                                    ('idle-timeout', 'idle_timeout', float),
+                                    ('timeout', 'timeout', float),
+                                    ('wait-timeout', 'wait_timeout', float)]:
+            value = el.get(attr)
+            if value is None:
+                continue
+            try:
+                options[name] = convert(cls.substitute(value, environ))
+            except ValueError:
+                raise DeliveranceSyntaxError(
+                    'Bad value for <connection-pool %s="%s">' % (attr, value),
+                    element=el)
+        for attr in el.attrib:
+            if attr not in ('max-per-host', 'idle-timeout', 'timeout',
+                            'wait-timeout'):
+                raise DeliveranceSyntaxError(
+                    'Unknown attribute in <connection-pool>: %s' % attr,
+                    element=el)
+        return ConnectionPool(**options)
 
     @classmethod
     def parse_file(cls, filename):
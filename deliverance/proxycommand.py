@@ -1,12 +1,12 @@
 #!/usr/bin/env python
 """Implements the ``deliverance-proxy`` command"""
 import sys
-import os
 import optparse
 from paste.httpserver import serve
 from pkg_resources import get_distribution
 from deliverance.proxy import ProxySet
 from deliverance.proxy import ProxySettings
+from deliverance.util.filewatcher import FileWatcher, source_files
 
 description = """\
 Starts up a proxy server using the given rule file.
@@ -101,34 +101,49 @@ def run_command(rule_filename, debug=False, interactive_debugger=False,
 
 class ReloadingApp(object):
     """
-    This is a WSGI app that notices when the rule file changes, and
-    reloads it in that case.
+    This is a WSGI app that notices when the rule file (or a file it
+    includes) changes, and reloads it in that case.
+
+    The files are watched from a background thread (see
+    `FileWatcher`), and the new rules are swapped in once they have
+    been loaded; if they can't be loaded the previous rules are kept.
     """
-    def __init__(self, rule_filename, settings):
+    def __init__(self, rule_filename, settings, watch=True):
         self.rule_filename = rule_filename
         self.settings = settings
         self.proxy_set = None
-        self.proxy_set_mtime = None
         self.application = None
         # This gives syntax errors earlier:
         self.load_proxy_set(warn=False)
+        self.watcher = FileWatcher(source_files(rule_filename), self.reload)
+        if watch:
+            self.watcher.start()
         
     def __call__(self, environ, start_response):
-        if (self.proxy_set is None
-            or self.proxy_set_mtime < os.path.getmtime(self.rule_filename)):
-            self.load_proxy_set()
         return self.application(environ, start_response)
 
     def load_proxy_set(self, warn=True):
         """Loads or reloads the ProxySet object from the file"""
         if warn:
             print('Reloading rule file %s' % self.rule_filename)
-        self.proxy_set = ProxySet.parse_file(
+        proxy_set = ProxySet.parse_file(
             self.rule_filename,
             middleware_factory=self.settings.middleware_factory,
-            middleware_factory_kwargs=self.settings.middleware_factory_kwargs)
-        self.proxy_set_mtime = os.path.getmtime(self.rule_filename)
-        self.application = self.settings.middleware(self.proxy_set.application)
+            middleware_factory_kwargs=self.settings.middleware_factory_kwargs,
+            http_client=self.settings.connection_pool)
+        application = self.settings.middleware(proxy_set.application)
+        # Requests use whichever application they find:
+        self.proxy_set, self.application = proxy_set, application
+
+    def reload(self):
+        """Called by the watcher when the files change"""
+        try:
+            self.load_proxy_set()
+        except Exception as e:
+            print('Error in rule file %s (still using the previous rules): %s'
+                  % (self.rule_filename, e))
+        # The includes might have changed:
+        self.watcher.watch(source_files(self.rule_filename))
 
 def main(args=None):
     """Runs the command from ``sys.argv``"""
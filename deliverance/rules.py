@@ -5,17 +5,19 @@ puts them together
 
 import copy
 import urllib.parse
+from concurrent.futures import Future
 from lxml import etree
 from lxml.html import document_fromstring, tostring
 from urllib.parse import quote as url_quote
 from tempita import html
+from deliverance.cache import copy_document
 from deliverance.exceptions import DeliveranceSyntaxError, AbortTheme
 from deliverance.util.converters import asbool, html_quote
 from deliverance.selector import Selector
 from deliverance.pagematch import AbstractMatch
 from deliverance.themeref import Theme
-from deliverance.util.cdata import escape_cdata, unescape_cdata
-from deliverance.util.charset import fix_meta_charset_position
+from deliverance.util.cdata import unescape_cdata
+from deliverance.util.prescan import prepare_document
 
 CONTENT_ATTRIB = 'x-a-marker-attribute-for-deliverance'
 
@@ -63,24 +65,224 @@ class Rule(object):
                 break
         return inst
 
-    def apply(self, content_doc, theme_doc, resource_fetcher, log):
+    def apply(self, content_doc, theme_doc, resource_fetcher, log,
+              start=0, end=None, state=None):
         """
         Applies all the actions in this rule to the theme_doc
 
-        Note that this leaves behind attributes to mark elements that
-        originated in the content.  You should call
-        :func:`remove_content_attribs` after applying all rules.
+        Only the actions ``[start:end]`` are applied if `start` or
+        `end` are given (actions before `start` may already be baked
+        into the theme, see :meth:`static_prefix`).
+
+        Elements that originated in the content are recorded in
+        `state` (a :class:`TransformState`, which should be shared by
+        all the rules applied to a theme).  Without a state this
+        leaves behind attributes to mark those elements, and you
+        should call :func:`remove_content_attribs` after applying all
+        rules.
         """
-        for action in self._actions:
-            action.apply(content_doc, theme_doc, resource_fetcher, log)
+        for action in self._actions[start:end]:
+            action.apply(content_doc, theme_doc, resource_fetcher, log,
+                         state=state)
         return theme_doc
 
+    def static_prefix(self):
+        """
+        Returns ``(actions, complete)``: the leading actions of this
+        rule that don't depend on the content (see
+        :meth:`AbstractAction.is_static`), and true if that is all of
+        the actions.
+
+        A rule with a match depends on the request, so none of its
+        actions are static.
+        """
+        if self.match is not None:
+            return [], not self._actions
+        actions = []
+        for action in self._actions:
+            if not action.is_static():
+                return actions, False
+            actions.append(action)
+        return actions, True
+
+    def href_actions(self, start=0, end=None):
+        """
+        The actions (of those from `start` to `end`) that fetch a
+        resource with ``href``.
+        """
+        return [action for action in self._actions[start:end]
+                if getattr(action, 'content_href', None)]
+
     def clientside_actions(self, content_doc, log):
         actions = []
         for action in self._actions:
             actions.extend(action.clientside_actions(content_doc, log))
         return actions
 
+class TransformState(object):
+    """
+    The state shared by all the actions applied to one theme and
+    content document during a request.
+
+    `theme_selections` maps actions to the result of their theme
+    selection, worked out in advance by a :class:`ThemePlan`; an
+    action uses (and removes) its entry instead of running its theme
+    selector.
+
+    `content_roots` is the set of elements that were moved (or
+    copied) from the content into the theme; they and their
+    descendants can't be selected as theme elements (see
+    :func:`is_content_element`).
+
+    `content_memo` is a :class:`deliverance.selector.SelectorMemo`
+    for the content document, if one has been set up; actions that
+    change the content call :meth:`content_changed`.
+
+    `fragments` holds the resources fetched (or being fetched, see
+    :meth:`prefetch`) by ``href`` actions (see :meth:`get_fragment`),
+    so each is only fetched and parsed once;
+    `fragment_cache` is a :class:`deliverance.cache.FragmentCache`
+    that keeps them between requests.
+    """
+
+    def __init__(self, theme_selections=None, content_roots=(),
+                 content_memo=None, fragment_cache=None):
+        if theme_selections is None:
+            theme_selections = {}
+        self.theme_selections = theme_selections
+        self.content_roots = set(content_roots)
+        self.content_memo = content_memo
+        self.fragments = {}
+        self.fragment_cache = fragment_cache
+
+    def get_fragment(self, url, resource_fetcher, parse):
+        """
+        Fetches the resource at `url` and parses it with `parse`,
+        returning ``(response, doc)``; `doc` is None if the response
+        isn't 200 OK.  Every caller gets its own copy of the document.
+        """
+        if url not in self.fragments:
+            self.fragments[url] = self.load_fragment(url, resource_fetcher, parse)
+        result = self.fragments[url]
+        if isinstance(result, Future):
+            result = self.fragments[url] = result.result()
+        resp, doc = result
+        if doc is not None:
+            doc = copy_document(doc)
+        return resp, doc
+
+    def prefetch(self, url, resource_fetcher, parse, pool):
+        """
+        Starts fetching and parsing the resource at `url` on `pool` (a
+        :class:`concurrent.futures.Executor`); :meth:`get_fragment`
+        waits for the result.
+        """
+        if url not in self.fragments:
+            self.fragments[url] = pool.submit(
+                self.load_fragment, url, resource_fetcher, parse)
+
+    def load_fragment(self, url, resource_fetcher, parse):
+        """
+        Does the fetching and parsing for :meth:`get_fragment`, using
+        `fragment_cache` if there is one.
+        """
+        if self.fragment_cache is not None:
+            return self.fragment_cache.fetch(url, resource_fetcher, parse)
+        resp = resource_fetcher(url)
+        doc = None
+        if resp.status_int == 200:
+            doc = parse(resp)
+        return resp, doc
+
+    def content_changed(self):
+        """Called when elements are moved out of or dropped from the content"""
+        if self.content_memo is not None:
+            self.content_memo.clear()
+
+class ThemePlan(object):
+    """
+    The theme selections of a list of rules, worked out in advance
+    against a theme document that is copied for every request (see
+    :class:`deliverance.cache.Skeleton`).
+
+    The selected elements (and the `content_roots` already in the
+    document) are kept as positions in document order, which are the
+    same in every copy of the document.  A selection is
+    only planned if earlier actions can't change its result: any
+    selection before the first action that changes the theme, and
+    after that only selections that aren't position-sensitive (see
+    :meth:`deliverance.selector.Selector.is_position_sensitive`) as
+    long as earlier actions only insert marked content elements (which
+    theme selections skip anyway).  Everything else is selected when
+    the action is applied, as usual.
+    """
+
+    def __init__(self, rules, theme_doc, applied=(), content_roots=()):
+        # Maps actions to (type, [position, ...], attributes):
+        self.selections = {}
+        self.content_roots = []
+        state = TransformState(content_roots=content_roots)
+        positions = None
+        if content_roots:
+            positions = dict(
+                (el, pos) for pos, el in enumerate(theme_doc.iter()))
+            self.content_roots = [positions[el] for el in content_roots
+                                  if el in positions]
+        actions = []
+        for index, rule in enumerate(rules):
+            if index < len(applied):
+                actions.extend(rule._actions[applied[index]:])
+            else:
+                actions.extend(rule._actions)
+        untouched = stable = True
+        for action in actions:
+            selector = action.theme
+            if selector is not None and (
+                untouched or not selector.is_position_sensitive()):
+                if positions is None:
+                    positions = dict(
+                        (el, pos) for pos, el in enumerate(theme_doc.iter()))
+                sel_type, els, attributes = action.select_elements(
+                    selector, theme_doc, theme=True, state=state)
+                self.selections[action] = (
+                    sel_type, [positions[el] for el in els], attributes)
+            changes = action.theme_changes()
+            if changes is not None:
+                untouched = False
+            if changes == 'modify':
+                stable = False
+            if not untouched and not stable:
+                break
+
+    def resolve(self, theme_doc, state=None):
+        """
+        Returns a :class:`TransformState` with the planned selections
+        in `theme_doc`, which must be an unmodified copy of the
+        document the plan was made for.  If a `state` is given the
+        selections are added to it.
+        """
+        wanted = set(self.content_roots)
+        for sel_type, selected, attributes in list(self.selections.values()):
+            wanted.update(selected)
+        found = {}
+        if wanted:
+            last = max(wanted)
+            for pos, el in enumerate(theme_doc.iter()):
+                if pos in wanted:
+                    found[pos] = el
+                if pos >= last:
+                    break
+        theme_selections = {}
+        for action, (sel_type, selected, attributes) in list(self.selections.items()):
+            theme_selections[action] = (
+                sel_type, [found[pos] for pos in selected], attributes)
+        content_roots = [found[pos] for pos in self.content_roots]
+        if state is None:
+            return TransformState(theme_selections, content_roots)
+        state.theme_selections.update(theme_selections)
+        state.content_roots.update(content_roots)
+        return state
+
 class RuleMatch(AbstractMatch):
     """
     Represents match rules in the <rule> element
@@ -210,7 +412,7 @@ class AbstractAction(object):
                 return None
         return '%s="%s"' % (attr, html_quote(text))
 
-    def if_content_matches(self, content_doc, log):
+    def if_content_matches(self, content_doc, log, state=None):
         """
         Returns true if the if-content selector matches something,
         i.e., if this rule should be executed.
@@ -219,7 +421,7 @@ class AbstractAction(object):
             # No if-content means always run
             return True
         sel_type, els, attributes = self.select_elements(
-            self.if_content, content_doc, theme=False)
+            self.if_content, content_doc, theme=False, state=state)
         matched = bool(els)
         if sel_type == 'elements':
             # els is fine then
@@ -253,6 +455,24 @@ class AbstractAction(object):
             return False
         return True
 
+    def is_static(self):
+        """
+        True if this action never looks at the content document, so
+        its effect on a given theme is always the same (as long as
+        any resources it fetches don't change).
+        """
+        return False
+
+    def theme_changes(self):
+        """
+        How applying this action may change the theme, as far as later
+        theme selections are concerned: None if it doesn't touch the
+        theme, ``'insert'`` if it only inserts elements that are
+        marked as coming from the content (see
+        :func:`mark_content_els`), or ``'modify'``.
+        """
+        return 'modify'
+
     # Set to the tag name in subclasses (append, prepend, etc):
     name = None
     # Set to true in subclasses if the move attribute means something:
@@ -306,20 +526,32 @@ class AbstractAction(object):
             result.extend(el)
         return els[0].text, result
 
-    def select_elements(self, selector, doc, theme):
+    def select_theme_elements(self, theme_doc, state=None):
+        """
+        Selects the elements of the theme, using the selection planned
+        in `state` (a :class:`TransformState`) if there is one.
+        """
+        if state is not None:
+            selection = state.theme_selections.pop(self, None)
+            if selection is not None:
+                return selection
+        return self.select_elements(self.theme, theme_doc, theme=True,
+                                    state=state)
+
+    def select_elements(self, selector, doc, theme, state=None):
         """
         Selects the elements from the document.  `theme` is a boolean,
         true if the document is the theme (in which case elements
-        originating in the content are not selectable).
+        originating in the content, as recorded in `state`, are not
+        selectable).  Content selections use the memo in `state`.
         """
-        type, elements, attributes = selector(doc)
+        if not theme and state is not None:
+            type, elements, attributes = selector(doc, memo=state.content_memo)
+        else:
+            type, elements, attributes = selector(doc)
         if theme:
-            bad_els = []
-            for el in elements:
-                if is_content_element(el):
-                    bad_els.append(el)
-            for el in bad_els:
-                elements.remove(el)
+            elements = [el for el in elements
+                        if not is_content_element(el, state)]
         return type, elements, attributes
 
     def log_description(self, log=None):
@@ -475,14 +707,48 @@ class TransformAction(AbstractAction):
                    manycontent=tag.get('manycontent'),
                    collapse_sources=collapse_sources)
 
-    def apply(self, content_doc, theme_doc, resource_fetcher, log):
+    def is_static(self):
+        """
+        An action with an ``href`` takes its content from that
+        resource, not from the content document.
+        """
+        return bool(self.content_href)
+
+    def theme_changes(self):
+        """
+        Moving content elements only inserts marked elements, unless
+        the sources aren't marked (``collapse-sources``).  Moving
+        children or attributes changes the theme elements themselves.
+        """
+        if self.collapse_sources or self.content.selector_types() != set(['elements']):
+            return 'modify'
+        return 'insert'
+
+    def content_url(self, log):
+        """
+        The resolved URL of the ``href`` attribute.
+        """
+        ## FIXME: Is this a weird way to resolve the href?
+        return urllib.parse.urljoin(log.request.url, self.content_href)
+
+    def parse_content(self, resp):
+        """
+        Parses the response fetched for the ``href`` attribute.
+        """
+        body = prepare_document(resp.body)
+        return document_fromstring(body, base_url=self.content_href)
+
+    def apply(self, content_doc, theme_doc, resource_fetcher, log, state=None):
         """
         Applies this action to the theme_doc.
         """
         if self.content_href:
-            ## FIXME: Is this a weird way to resolve the href?
-            href = urllib.parse.urljoin(log.request.url, self.content_href)
-            content_resp = resource_fetcher(href)
+            href = self.content_url(log)
+            if state is not None:
+                content_resp, content_doc = state.get_fragment(
+                    href, resource_fetcher, self.parse_content)
+            else:
+                content_resp = resource_fetcher(href)
             log.debug(
                 self, 'Fetching resource from href="%s": %s',
                 href, content_resp.status)
@@ -491,15 +757,12 @@ class TransformAction(AbstractAction):
                     self, 'Resource %s returned the status %s; skipping rule',
                     href, content_resp.status)
                 return
-            body = content_resp.body
-            body = escape_cdata(body)
-            body = fix_meta_charset_position(body)
-            content_doc = document_fromstring(
-                body, base_url=self.content_href)
-        if not self.if_content_matches(content_doc, log):
+            if state is None:
+                content_doc = self.parse_content(content_resp)
+        if not self.if_content_matches(content_doc, log, state):
             return
         content_type, content_els, content_attributes = self.select_elements(
-            self.content, content_doc, theme=False)
+            self.content, content_doc, theme=False, state=state)
         if not content_els:
             if self.nocontent == 'abort':
                 log.debug(
@@ -514,8 +777,8 @@ class TransformAction(AbstractAction):
                 self, 'skipping rule because no content matches rule content="%s"', 
                 self.content)
             return
-        theme_type, theme_els, theme_attributes = self.select_elements(
-            self.theme, theme_doc, theme=True)
+        theme_type, theme_els, theme_attributes = self.select_theme_elements(
+            theme_doc, state)
         attributes = self.join_attributes(content_attributes, theme_attributes)
         if not theme_els:
             if self.notheme == 'abort':
@@ -555,13 +818,15 @@ class TransformAction(AbstractAction):
         if not self.move and theme_type in ('children', 'elements'):
             content_els = copy.deepcopy(content_els)
         if not self.collapse_sources:
-            mark_content_els(content_els)
+            mark_content_els(content_els, state)
         self.apply_transformation(content_type, content_els, attributes, 
                                   theme_type, theme_el, log)
+        if self.move and not self.content_href and state is not None:
+            state.content_changed()
 
     def clientside_actions(self, content_doc, log):
         if self.content_href:
-            href = urllib.parse.urljoin(log.request.url, self.content_href)
+            href = self.content_url(log)
             url = '%s/.deliverance/subreq?url=%s&action=%s&content=%s&theme=%s' % (
                 log.request.application_url,
                 url_quote(href),
@@ -640,6 +905,10 @@ class Replace(TransformAction):
         ]
 
     name = 'replace'
+
+    def theme_changes(self):
+        """Replacing always removes something from the theme"""
+        return 'modify'
  
     def apply_transformation(self, content_type, content_els, attributes, 
                              theme_type, theme_el, log):
@@ -1064,19 +1333,36 @@ class Drop(AbstractAction):
         self.nocontent = self.convert_error('nocontent', nocontent)
         self.notheme = self.convert_error('notheme', notheme)
 
-    def apply(self, content_doc, theme_doc, resource_fetcher, log):
+    def is_static(self):
+        """
+        Only dropping from the theme (without an ``if-content``) is
+        independent of the content.
+        """
+        return self.content is None and self.if_content is None
+
+    def theme_changes(self):
+        """Dropping from the content doesn't touch the theme"""
+        if self.theme is None:
+            return None
+        return 'modify'
+
+    def apply(self, content_doc, theme_doc, resource_fetcher, log, state=None):
         """Applies the action"""
-        if not self.if_content_matches(content_doc, log):
+        if not self.if_content_matches(content_doc, log, state):
             return
         for doc, selector, error, name in [
             (theme_doc, self.theme, self.notheme, 'theme'), 
             (content_doc, self.content, self.nocontent, 'content')]:
-            self._apply_drop(doc, selector, error, name, log)
+            self._apply_drop(doc, selector, error, name, log, state)
 
-    def _apply_drop(self, doc, selector, error, name, log):
+    def _apply_drop(self, doc, selector, error, name, log, state=None):
         if selector is None:
             return
-        sel_type, els, attributes = self.select_elements(selector, doc, name=='theme')
+        if name == 'theme':
+            sel_type, els, attributes = self.select_theme_elements(doc, state)
+        else:
+            sel_type, els, attributes = self.select_elements(
+                selector, doc, False, state)
         if not els:
             if error == 'abort':
                 log.debug(
@@ -1139,6 +1425,8 @@ class Drop(AbstractAction):
                 name, self.format_tags(els))
         else:
             assert 0
+        if name == 'content' and state is not None:
+            state.content_changed()
 
     @classmethod
     def from_xml(cls, tag, source_location):
@@ -1201,10 +1489,16 @@ def iter_self_and_ancestors(el):
     for item in el.iterancestors():
         yield item
 
-def mark_content_els(els):
+def mark_content_els(els, state=None):
     """
-    Mark an element as originating from the content (this uses a special attribute)
+    Mark an element as originating from the content.  The elements
+    are added to the `content_roots` of `state` (a
+    :class:`TransformState`); without a state a special attribute is
+    used.
     """
+    if state is not None:
+        state.content_roots.update(els)
+        return
     ## FIXME: see http://trac.socialplanning.org/deliverance/ticket/70
     for el in els:
         ## FIXME: maybe put something that is trackable to the rule
@@ -1217,11 +1511,19 @@ def mark_content_els(els):
             # http://trac.socialplanning.org/deliverance/ticket/69
             pass
 
-def is_content_element(el):
+def is_content_element(el, state=None):
     """
     Tests if the element came from the content (which includes if any of its ancestors)
     """
     ## FIXME: should this check children too?
+    if state is not None:
+        roots = state.content_roots
+        if not roots:
+            return False
+        for parent in iter_self_and_ancestors(el):
+            if parent in roots:
+                return True
+        return False
     for parent in iter_self_and_ancestors(el):
         if parent.get(CONTENT_ATTRIB):
             return True
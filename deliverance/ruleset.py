@@ -1,6 +1,6 @@
 """Implements the <ruleset> handler."""
 
-import re
+import itertools
 from lxml.html import tostring, document_fromstring
 from lxml.etree import XML, Comment
 
@@ -9,14 +9,24 @@ try: # webob 1.0
 except ImportError:  # webob 0.9.8
     from webob.headerdict import HeaderDict as ResponseHeaders
 
+from deliverance.cache import CachedDocument, Skeleton, body_hash, is_shareable
 from deliverance.exceptions import AbortTheme, DeliveranceSyntaxError
-from deliverance.pagematch import run_matches, Match, ClientsideMatch
-from deliverance.rules import Rule, remove_content_attribs
+from deliverance.log import SavingLogger
+from deliverance.pagematch import run_matches, Match, MatchIndex, ClientsideMatch
+from deliverance.rules import Rule, ThemePlan, TransformState
+from deliverance.security import display_local_files
+from deliverance.selector import SelectorMemo
 from deliverance.themeref import Theme
-from deliverance.util.cdata import escape_cdata, unescape_cdata
-from deliverance.util.charset import fix_meta_charset_position, force_charset
+from deliverance.util.cdata import unescape_cdata
+from deliverance.util.charset import force_charset
+from deliverance.util.nesting import round_trips
+from deliverance.util.prescan import Prescan, prepare_document
+from deliverance.util.proxiedbody import attached_body
 from urllib.parse import urljoin
 
+## Versions for rulesets that aren't parsed from XML:
+_versions = itertools.count()
+
 class RuleSet(object):
     """
     Represents ``<ruleset>``, except for proxy/settings (which are
@@ -24,29 +34,154 @@ class RuleSet(object):
 
     This is a container for rules/actions.  It contains many
     ``<rule>`` objects.
+
+    `version` identifies the rules (for caches); rulesets parsed from
+    the same XML get the same version.
     """
 
     def __init__(self, matchers, clientsides, rules_by_class, default_theme=None,
-                 source_location=None):
+                 source_location=None, version=None):
         self.matchers = matchers
+        self.match_index = MatchIndex(matchers)
         self.clientsides = clientsides
         self.rules_by_class = rules_by_class
         self.default_theme = default_theme
         self.source_location = source_location
+        if version is None:
+            version = next(_versions)
+        self.version = version
 
-    def apply_rules(self, req, resp, resource_fetcher, log, default_theme=None):
+    def apply_rules(self, req, resp, resource_fetcher, log, default_theme=None,
+                    theme_cache=None, fragment_cache=None, prefetch_pool=None,
+                    selection=None):
         """
         Apply the whatever the appropriate rules are to the request/response.
+
+        If a `theme_cache` (:class:`deliverance.cache.ThemeCache`) is
+        given the parsed theme is kept there between requests, and a
+        `fragment_cache` (:class:`deliverance.cache.FragmentCache`)
+        does the same for the resources of ``href`` actions.
+
+        If a `prefetch_pool` (a :class:`concurrent.futures.Executor`)
+        is given, those resources are fetched on it while the theme is
+        fetched (see :meth:`prefetch_fragments`).
+
+        `selection` is the result of :meth:`select_rules` for the
+        request/response, if that has already been called.
+        """
+        if selection is None:
+            selection = self.select_rules(req, resp, log, default_theme)
+        if selection is None:
+            return resp
+        scan, response_headers, rules, theme_href = selection
+        # The body the proxy left unparsed for us, if nothing else read it:
+        proxied = attached_body(resp)
+
+        try:
+            state = TransformState(fragment_cache=fragment_cache)
+            if prefetch_pool is not None:
+                self.prefetch_fragments(
+                    rules, resource_fetcher, log, prefetch_pool, state,
+                    skip_static=theme_cache is not None)
+            theme_entry = None
+            if theme_cache is not None:
+                theme_entry = self.get_theme_entry(
+                    theme_href, resource_fetcher, log, theme_cache,
+                    should_escape_cdata=True,
+                    should_fix_meta_charset_position=True)
+                original_theme_resp = theme_entry.response
+            else:
+                original_theme_resp = self.get_theme_response(
+                    theme_href, resource_fetcher, log)
+                theme_doc = self.get_theme_doc(
+                    original_theme_resp, theme_href,
+                    should_escape_cdata=True,
+                    should_fix_meta_charset_position=True)
+
+            resp = force_charset(resp, scan=scan)
+            # (Unless a match or the theme fetch has read the body since:)
+            if proxied is not None and attached_body(resp) is proxied:
+                log.debug(self, "Using the document of the proxied response")
+                content_doc = proxied.document(req.url, resp.charset)
+            else:
+                body = prepare_document(resp.unicode_body)
+                content_doc = self.parse_document(body, req.url)
+
+            # The number of actions of each rule already applied to the theme:
+            applied = []
+            if theme_entry is not None:
+                skeleton, applied = self.get_skeleton(
+                    theme_entry, rules, content_doc, resource_fetcher, log)
+                theme_doc = skeleton.copy_doc()
+                self.get_plan(skeleton, rules, applied).resolve(theme_doc, state)
+            state.content_memo = SelectorMemo(content_doc)
+
+            run_standard = True
+            for index, rule in enumerate(rules):
+                if index < len(applied):
+                    start = applied[index]
+                else:
+                    start = 0
+                rule.apply(content_doc, theme_doc, resource_fetcher, log,
+                           start=start, state=state)
+                if rule.suppress_standard:
+                    run_standard = False
+            if run_standard:
+                ## FIXME: should it be possible to put the standard rule in the ruleset?
+                standard_rule.apply(content_doc, theme_doc, resource_fetcher, log,
+                                    state=state)
+        except AbortTheme:
+            return resp
+
+        if original_theme_resp.body.strip().startswith("<!DOCTYPE"):
+            tree = theme_doc.getroottree()
+        else:
+            tree = content_doc.getroottree()
+
+        doctype = tree.docinfo.doctype or default_doctype
+        if "XHTML" in doctype:
+            method = "xml"
+        else:
+            method = "html"
+
+        if not round_trips(theme_doc):
+            # The rules (or the actions pre-applied to a skeleton) left
+            # nesting that the parser repairs, as it always has been:
+            theme_str = tostring(theme_doc, encoding=str,
+                                 include_meta_content_type=True)
+            theme_doc = document_fromstring(doctype + theme_str)
+
+        resp.body = tostring(theme_doc, method=method, doctype=doctype,
+                             include_meta_content_type=True)
+        resp.body = unescape_cdata(resp.body)
+
+        return resp
+
+    def select_rules(self, req, resp, log, default_theme=None):
         """
-        extra_headers = parse_meta_headers(resp.body)
+        Runs the matches of the ruleset against the request/response,
+        returning ``(scan, response_headers, rules, theme_href)``: the
+        :class:`deliverance.util.prescan.Prescan` of the body, the
+        response headers (with those of ``<meta http-equiv>`` tags),
+        the rules that apply and the theme URL.  Returns None if the
+        page isn't themed.
+        """
+        # The <head> of the raw body, for <meta> headers and the charset:
+        proxied = attached_body(resp)
+        if proxied is not None:
+            scan = proxied.prescan()
+        else:
+            scan = Prescan(resp.body)
+        extra_headers = scan.meta_headers
         if extra_headers:
             response_headers = ResponseHeaders(resp.headerlist + extra_headers)
         else:
             response_headers = resp.headers
         try:
-            classes = run_matches(self.matchers, req, resp, response_headers, log)
+            classes = run_matches(self.matchers, req, resp, response_headers, log,
+                                  index=self.match_index)
         except AbortTheme:
-            return resp
+            return None
         if 'X-Deliverance-Page-Class' in response_headers:
             log.debug(self, "Found page class %s in headers", response_headers['X-Deliverance-Page-Class'].strip())
             classes.extend(response_headers['X-Deliverance-Page-Class'].strip().split())
@@ -74,60 +209,127 @@ class RuleSet(object):
             
         if theme is None:
             log.error(self, "No theme has been defined for the request")
-            return resp
+            return None
 
         try:
             theme_href = theme.resolve_href(req, resp, log)
-            original_theme_resp = self.get_theme_response(
-                theme_href, resource_fetcher, log)
-            theme_doc = self.get_theme_doc(
-                original_theme_resp, theme_href,
-                should_escape_cdata=True,
-                should_fix_meta_charset_position=True)
-
-            resp = force_charset(resp)
-            body = resp.unicode_body
-            body = escape_cdata(body)
-            body = fix_meta_charset_position(body)
-            content_doc = self.parse_document(body, req.url)
-
-            run_standard = True
-            for rule in rules:
-                if rule.match is not None:
-                    matches = rule.match(req, resp, response_headers, log)
-                    if not matches:
-                        log.debug(rule, "Skipping <rule>")
-                        continue
-                rule.apply(content_doc, theme_doc, resource_fetcher, log)
-                if rule.suppress_standard:
-                    run_standard = False
-            if run_standard:
-                ## FIXME: should it be possible to put the standard rule in the ruleset?
-                standard_rule.apply(content_doc, theme_doc, resource_fetcher, log)
         except AbortTheme:
-            return resp
-        remove_content_attribs(theme_doc)
-        ## FIXME: handle caching?
-
-        if original_theme_resp.body.strip().startswith("<!DOCTYPE"):
-            tree = theme_doc.getroottree()
-        else:
-            tree = content_doc.getroottree()
+            return None
+        applicable = []
+        for rule in rules:
+            if rule.match is not None:
+                matches = rule.match(req, resp, response_headers, log)
+                if not matches:
+                    log.debug(rule, "Skipping <rule>")
+                    continue
+            applicable.append(rule)
+        return scan, response_headers, applicable, theme_href
 
-        if "XHTML" in tree.docinfo.doctype:
-            method = "xml"
-        else:
-            method = "html"
+    def resource_requests(self, selection, log, theme_cache=None,
+                          fragment_cache=None):
+        """
+        The requests for the theme and the resources of ``href``
+        actions that :meth:`apply_rules` will make through its
+        resource fetcher, as far as they can be told in advance, for
+        the `selection` of :meth:`select_rules`: a list of ``(url,
+        kw)``, where `kw` are the keyword arguments the fetcher is
+        called with.  Resources the caches have fresh copies of are
+        left out, and the static actions of a cached skeleton (see
+        :meth:`get_skeleton`) only check that their resources haven't
+        changed.
+        """
+        scan, response_headers, rules, theme_href = selection
+        requests = []
+        entry = None
+        if theme_cache is not None:
+            entry = theme_cache.documents.peek((theme_href, True, True))
+        if entry is None or not theme_cache.is_fresh(entry):
+            kw = dict(retry_inner_if_not_200=True)
+            if entry is not None and entry.conditional_headers():
+                kw['extra_headers'] = entry.conditional_headers()
+            requests.append((theme_href, kw))
+        skipped = []
+        if entry is not None:
+            key, applied = self.skeleton_key(rules, log)
+            skeleton = entry.skeletons.peek(key)
+            if skeleton is not None and sum(applied):
+                skipped = applied
+                for fragment in skeleton.fragments:
+                    if not fragment.is_fresh() and fragment.mtime is None:
+                        requests.append((fragment.url, dict(
+                            extra_headers=fragment.conditional_headers())))
+        urls = []
+        for index, rule in enumerate(rules):
+            if index < len(skipped):
+                start = skipped[index]
+            else:
+                start = 0
+            for action in rule.href_actions(start=start):
+                url = action.content_url(log)
+                if url not in urls:
+                    urls.append(url)
+        for url in urls:
+            kw = {}
+            if fragment_cache is not None:
+                cached = fragment_cache.documents.peek(url)
+                if cached is not None and cached.is_fresh():
+                    continue
+                if cached is not None and cached.conditional_headers():
+                    kw['extra_headers'] = cached.conditional_headers()
+            requests.append((url, kw))
+        return requests
 
-        theme_str = tostring(theme_doc, include_meta_content_type=True)
-        theme_str = tree.docinfo.doctype + theme_str
-        theme_doc = document_fromstring(theme_str)
-        tree = theme_doc.getroottree()
+    def depends_on_request(self):
+        """
+        True if applying the rules might depend on more than the URL
+        of the request: matches on request headers or the environ,
+        Python code (pyrefs), or theme hrefs with URI template
+        variables.
+        """
+        matchers = list(self.matchers)
+        themes = [self.default_theme]
+        for rules in list(self.rules_by_class.values()):
+            for rule in rules:
+                if rule.match is not None:
+                    matchers.append(rule.match)
+                themes.append(rule.theme)
+        for matcher in matchers:
+            if matcher.request_header or matcher.environ or matcher.pyref:
+                return True
+        for theme in themes:
+            if theme is None:
+                continue
+            if theme.pyref or '{' in (theme.href or ''):
+                return True
+        return False
 
-        resp.body = tostring(tree, method=method, include_meta_content_type=True)
-        resp.body = unescape_cdata(resp.body)
+    def aborts_before_body(self, req, resp, log):
+        """
+        True if a ``<match abort="1">`` applies to the response, as
+        far as can be told without reading the body (so the response
+        can be passed on as it is streamed).
 
-        return resp
+        Matches on the response headers are left to
+        :meth:`apply_rules`, since ``<meta http-equiv>`` tags in the
+        body count as headers; so are Python code (pyref) matches,
+        which might read the body.
+        """
+        if not [matcher for matcher in self.matchers if matcher.abort]:
+            return False
+        for matcher in self.matchers:
+            if matcher.response_header or matcher.pyref:
+                return False
+        # The matching is only logged if it is final:
+        saved = SavingLogger(req, None,
+                             debug_enabled=getattr(log, 'debug_enabled', True))
+        try:
+            run_matches(self.matchers, req, resp, resp.headers, saved,
+                        index=self.match_index)
+        except AbortTheme:
+            for level, el, msg, args, kw in saved.records:
+                log.message(level, el, msg, *args, **kw)
+            return True
+        return False
 
     def check_clientside(self, req, log):
         for clientside in self.clientsides:
@@ -136,12 +338,25 @@ class RuleSet(object):
                 return True
         return False
 
-    def get_theme_response(self, url, resource_fetcher, log):
+    def get_theme_response(self, url, resource_fetcher, log, cached=None):
+        """
+        Fetches the theme.  If `cached` (a
+        :class:`deliverance.cache.CachedDocument`) is given the request
+        is made conditional on its validators, and a ``304 Not
+        Modified`` response may be returned.
+        """
         log.info(self, 'Fetching theme from %s' % url)
         log.theme_url = url
-        ## FIXME: should do caching
-        ## FIXME: check response status
-        resp = resource_fetcher(url, retry_inner_if_not_200=True)
+        extra_headers = None
+        if cached is not None:
+            extra_headers = cached.conditional_headers()
+        if extra_headers:
+            resp = resource_fetcher(url, retry_inner_if_not_200=True,
+                                    extra_headers=extra_headers)
+        else:
+            resp = resource_fetcher(url, retry_inner_if_not_200=True)
+        if resp.status_int == 304 and cached is not None:
+            return resp
         if resp.status_int != 200:
             log.fatal(
                 self, "The resource %s was not 200 OK: %s" % (url, resp.status))
@@ -154,28 +369,191 @@ class RuleSet(object):
                       should_escape_cdata=False,
                       should_fix_meta_charset_position=False):
         
-        body = resp.unicode_body
-
-        if should_escape_cdata:
-            body = escape_cdata(body)
-        if should_fix_meta_charset_position:
-            body = fix_meta_charset_position(body)
+        body = prepare_document(resp.unicode_body,
+                                should_escape_cdata,
+                                should_fix_meta_charset_position)
         doc = self.parse_document(body, url)
         self.make_links_absolute(doc)
         return doc
 
     def get_theme(self, url, resource_fetcher, log,
                   should_escape_cdata=False,
-                  should_fix_meta_charset_position=False):
+                  should_fix_meta_charset_position=False,
+                  theme_cache=None):
         """
         Retrieves the theme at the given URL.  Also stores it in the
         log for later use by the log.
         """        
+        if theme_cache is not None:
+            resp, doc = self.get_cached_theme(
+                url, resource_fetcher, log, theme_cache,
+                should_escape_cdata, should_fix_meta_charset_position)
+            return doc
         resp = self.get_theme_response(url, resource_fetcher, log)
         return self.get_theme_doc(resp, url, 
                                   should_escape_cdata,
                                   should_fix_meta_charset_position)
 
+    def get_cached_theme(self, url, resource_fetcher, log, theme_cache,
+                         should_escape_cdata=False,
+                         should_fix_meta_charset_position=False):
+        """
+        Retrieves the theme through `theme_cache`, only parsing it
+        again when the theme response has changed.
+
+        Returns ``(theme_response, theme_doc)``; the document is a
+        private copy that can be modified.
+        """
+        entry = self.get_theme_entry(url, resource_fetcher, log, theme_cache,
+                                     should_escape_cdata,
+                                     should_fix_meta_charset_position)
+        return entry.response, entry.copy_doc()
+
+    def get_theme_entry(self, url, resource_fetcher, log, theme_cache,
+                        should_escape_cdata=False,
+                        should_fix_meta_charset_position=False):
+        """
+        Like :meth:`get_cached_theme`, but returns the (shared)
+        :class:`deliverance.cache.CachedDocument` itself.
+
+        Themes whose responses may not be shared between users (see
+        :func:`deliverance.cache.is_shareable`) aren't kept.
+        """
+        key = (url, should_escape_cdata, should_fix_meta_charset_position)
+        entry = theme_cache.lookup(key)
+        # Fresh (file:) themes are used without going through the
+        # resource fetcher, so the request's access is checked here:
+        if (entry is not None and theme_cache.is_fresh(entry)
+            and log.request is not None and display_local_files(log.request)):
+            log.theme_url = url
+            log.debug(self, 'Using the cached theme %s', url)
+            return entry
+        resp = self.get_theme_response(url, resource_fetcher, log, cached=entry)
+        if entry is not None and entry.is_current(resp):
+            entry.touch()
+            log.debug(self, 'The theme %s has not changed (%s); using the cached copy',
+                      url, resp.status)
+            return entry
+        doc = self.get_theme_doc(resp, url, 
+                                 should_escape_cdata,
+                                 should_fix_meta_charset_position)
+        entry = CachedDocument(url, resp, doc)
+        if is_shareable(resp):
+            theme_cache.store(key, entry)
+        return entry
+
+    def get_skeleton(self, theme_entry, rules, content_doc, resource_fetcher, log):
+        """
+        Returns ``(skeleton, applied)``, where `skeleton` is a
+        :class:`deliverance.cache.Skeleton` of the theme with the
+        leading static actions of `rules` (see
+        :meth:`deliverance.rules.Rule.static_prefix`) applied, and
+        `applied` is a list of the number of actions applied from each
+        rule.
+
+        The skeleton is kept with the cached theme and reused until
+        the theme or one of the resources the static actions fetched
+        changes.  If any of those resources may not be shared (see
+        :func:`deliverance.cache.is_shareable`) the skeleton isn't
+        kept, and the actions are applied for every request.
+        """
+        key, applied = self.skeleton_key(rules, log)
+        if not sum(applied):
+            # Nothing to apply, but the skeleton still holds the plans:
+            skeleton = theme_entry.skeletons.get(())
+            if skeleton is None:
+                skeleton = Skeleton(theme_entry.doc, [])
+                theme_entry.skeletons.set((), skeleton)
+            return skeleton, []
+        skeleton = theme_entry.skeletons.get(key)
+        if skeleton is not None and skeleton.is_current(resource_fetcher):
+            log.debug(self, 'Using the theme with %s static action(s) already applied',
+                      sum(applied))
+            return skeleton, applied
+        fragments = []
+        def recording_fetcher(url, *args, **kw):
+            resp = resource_fetcher(url, *args, **kw)
+            fragments.append(CachedDocument(url, resp, None))
+            return resp
+        theme_doc = theme_entry.copy_doc()
+        state = TransformState()
+        for rule, count in zip(rules, applied):
+            rule.apply(content_doc, theme_doc, recording_fetcher, log,
+                       end=count, state=state)
+        # (when children are moved the marked elements stay behind in
+        # the fragment, and those aren't needed)
+        content_roots = [el for el in state.content_roots
+                         if el.getroottree().getroot() is theme_doc]
+        skeleton = Skeleton(theme_doc, fragments, content_roots)
+        # (A resource that couldn't be fetched might work next time)
+        if all(is_shareable(f.response) for f in fragments):
+            theme_entry.skeletons.set(key, skeleton)
+        return skeleton, applied
+
+    def skeleton_key(self, rules, log):
+        """
+        Returns ``(key, applied)``: the key of the skeleton (see
+        :meth:`get_skeleton`) for `rules` in the cached theme's
+        skeletons, and the number of actions it applies from each rule.
+        """
+        applied = self.static_counts(rules)
+        hrefs = []
+        for rule, count in zip(rules, applied):
+            for action in rule.href_actions(end=count):
+                hrefs.append(action.content_url(log))
+        return (tuple(zip(rules, applied)), tuple(hrefs)), applied
+
+    def static_counts(self, rules):
+        """
+        The number of leading static actions (see
+        :meth:`deliverance.rules.Rule.static_prefix`) of each rule
+        that :meth:`get_skeleton` applies to the cached theme.
+        """
+        applied = []
+        for rule in rules:
+            actions, complete = rule.static_prefix()
+            applied.append(len(actions))
+            if not complete:
+                break
+        return applied
+
+    def prefetch_fragments(self, rules, resource_fetcher, log, pool, state,
+                           skip_static=False):
+        """
+        Starts fetching the resources of the ``href`` actions of
+        `rules` on `pool`, so they are fetched at the same time instead
+        of one after another as the actions are applied (see
+        :meth:`deliverance.rules.TransformState.prefetch`).
+
+        With `skip_static` the static actions applied by
+        :meth:`get_skeleton` are left out too.
+        """
+        if skip_static:
+            skipped = self.static_counts(rules)
+        else:
+            skipped = []
+        for index, rule in enumerate(rules):
+            if index < len(skipped):
+                start = skipped[index]
+            else:
+                start = 0
+            for action in rule.href_actions(start=start):
+                state.prefetch(action.content_url(log), resource_fetcher,
+                               action.parse_content, pool)
+
+    def get_plan(self, skeleton, rules, applied):
+        """
+        Returns the :class:`deliverance.rules.ThemePlan` for applying
+        `rules` (and the standard rule) to copies of `skeleton`.
+        """
+        key = tuple(rules)
+        plan = skeleton.plans.get(key)
+        if plan is None:
+            plan = ThemePlan(rules + [standard_rule], skeleton.doc, applied,
+                             skeleton.content_roots)
+            skeleton.plans.set(key, plan)
+        return plan
+
     def make_links_absolute(self, doc):
         base_url = doc.base_url
         def link_repl_preserve_internal(href):
@@ -239,16 +617,19 @@ class RuleSet(object):
             for class_name in rule.classes:
                 rules_by_class.setdefault(class_name, []).append(rule)
         return cls(matchers, clientsides, rules_by_class, default_theme=default_theme,
-                   source_location=source_location)
+                   source_location=source_location,
+                   version=(source_location, body_hash(tostring(doc))))
 
     def clientside_actions(self, req, resp, log):
-        extra_headers = parse_meta_headers(resp.body)
+        scan = Prescan(resp.body)
+        extra_headers = scan.meta_headers
         if extra_headers:
             response_headers = ResponseHeaders(resp.headerlist + extra_headers)
         else:
             response_headers = resp.headers
         try:
-            classes = run_matches(self.matchers, req, resp, response_headers, log)
+            classes = run_matches(self.matchers, req, resp, response_headers, log,
+                                  index=self.match_index)
         except AbortTheme:
             assert 0, 'no abort should happen'
         if 'X-Deliverance-Page-Class' in response_headers:
@@ -266,7 +647,7 @@ class RuleSet(object):
                     rules.append(rule)
                     if rule.theme:
                         assert 0, 'no rule themes should be present'
-        resp = force_charset(resp)
+        resp = force_charset(resp, scan=scan)
         content_doc = self.parse_document(resp.unicode_body, req.url)
         actions = []
         run_standard = True
@@ -285,33 +666,18 @@ class RuleSet(object):
         return actions
         
 
-_meta_tag_re = re.compile(r'<meta\s+(.*?)>', re.I | re.S)
-_http_equiv_re = re.compile(r'http-equiv=(?:"([^"]*)"|([^\s>]*))', re.I|re.S)
-_content_re = re.compile(r'content=(?:"([^"]*)"|([^\s>]*))', re.I|re.S)
-        
+# The doctype the HTML parser gives documents that don't have one:
+default_doctype = ('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.0 Transitional//EN" '
+                   '"http://www.w3.org/TR/REC-html40/loose.dtd">')
+
 def parse_meta_headers(body):
     """
     Returns a list of headers (in the form ``[(header_name,
-    header_value)...]`` parsed from an HTML document, where the
-    headers are in the format ``<meta http-equiv="header_name"
-    content="header_value">``
+    header_value)...]``) parsed from the ``<head>`` of an HTML
+    document, where the headers are in the format ``<meta
+    http-equiv="header_name" content="header_value">``
     """
-    headers = []
-    for match in _meta_tag_re.finditer(body):
-        content = match.group(1)
-        http_equiv_match = _http_equiv_re.search(content)
-        content_match = _content_re.search(content)
-        if not http_equiv_match or not content_match:
-            ## FIXME: log partial matches?
-            continue
-        http_equiv = (http_equiv_match.group(1) or http_equiv_match.group(2) or '')
-        http_equiv = http_equiv.strip()
-        content = content_match.group(1) or content_match.group(2) or ''
-        if not http_equiv or not content:
-            ## FIXME: is empty content really meaningless?
-            continue
-        headers.append((http_equiv, content))
-    return headers
+    return Prescan(body).meta_headers
 
 # Note: these are included in the documentation; any changes should be
 # reflected there as well.
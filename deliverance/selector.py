@@ -7,10 +7,14 @@ import re
 from lxml.etree import XPath
 from lxml.cssselect import CSSSelector
 from deliverance.exceptions import DeliveranceSyntaxError
+from deliverance.util.lrucache import LRUCache
 
 type_re = re.compile(r'^(elements?|children|tag|attributes?):')
 type_map = dict(element='elements', attribute='attributes')
 attributes_re = re.compile(r'^attributes[(]([a-zA-Z0-9_, -:]+)[)]:')
+# Predicates that only test an attribute, like [@id="content"]:
+_attribute_predicate_re = re.compile(
+    r'\[\s*@[\w:-]+\s*(?:=\s*(?:"[^"]*"|\'[^\']*\')\s*)?\]')
 
 class Selector(object):
     """
@@ -93,22 +97,35 @@ class Selector(object):
                 "Expression %s in selector %r uses the type %r, but this is not "
                 "compatible with the type %r already declared earlier in the selector"
                 % (expr, self, type, self.major_type))
-        if rest_expr.startswith('/'):
-            selector = XPath(rest_expr)
-        else:
-            try:
-                selector = CSSSelector(rest_expr)
-            except AssertionError as e:
-                raise DeliveranceSyntaxError('Bad CSS selector: "%s" (%s)' % (expr, e))
+        try:
+            selector = compile_expression(rest_expr)
+        except AssertionError as e:
+            raise DeliveranceSyntaxError('Bad CSS selector: "%s" (%s)' % (expr, e))
         return (type, selector, expr, attributes)
 
-    def __call__(self, doc):
+    def __call__(self, doc, memo=None):
         """
         Match this selector against the doc.  Returns (type, elements,
         attributes), where type is one of elements, children, tag,
         attributes.  attributes is the list of attributes, if that was
         given.
+
+        If a `memo` (:class:`SelectorMemo`) for `doc` is given, the
+        result of an earlier selection with the same expression is
+        reused.
         """
+        if memo is not None and memo.doc is doc:
+            key = self.memo_key()
+            result = memo.get(key)
+            if result is None:
+                result = self.select(doc)
+                memo.set(key, result)
+            type, elements, attributes = result
+            return (type, list(elements), attributes)
+        return self.select(doc)
+
+    def select(self, doc):
+        """Does the actual selection for :meth:`__call__`"""
         for sel_type, selector, sel_expr, sel_attributes in self.selectors:
             result = selector(doc)
             if result:
@@ -116,6 +133,15 @@ class Selector(object):
                 attributes = sel_attributes or self.attributes
                 return (type, result, attributes)
         return (self.major_type, [], self.attributes)
+
+    def memo_key(self):
+        """
+        A key that is the same for selectors with the same expression
+        """
+        attributes = self.attributes
+        if attributes is not None:
+            attributes = tuple(attributes)
+        return (self.major_type, attributes, tuple(self.selectors_source))
     
     def selector_types(self):
         """
@@ -125,6 +151,30 @@ class Selector(object):
         return set([sel_type
                     for sel_type, selector, sel_expr, sel_attributes in self.selectors])
     
+    def is_position_sensitive(self):
+        """
+        True if what this selector matches might change when other
+        elements are inserted into the document, even if those
+        elements don't match themselves.
+
+        This is conservative: positional and text predicates, axes,
+        functions, CSS pseudo-classes and sibling combinators all
+        count, and so does a cascade (``||``) of several selectors.
+        """
+        if len(self.selectors) > 1:
+            return True
+        for sel_type, selector, sel_expr, sel_attributes in self.selectors:
+            expr = self.parse_prefix(sel_expr)[2]
+            if expr.startswith('/'):
+                expr = _attribute_predicate_re.sub('', expr)
+                if '[' in expr or '::' in expr or '(' in expr:
+                    return True
+            else:
+                for char in ':+~':
+                    if char in expr:
+                        return True
+        return False
+
     def __unicode__(self):
         parts = []
         for sel_type, dummy_selector, sel_expr, sel_attributes in self.selectors:
@@ -132,3 +182,66 @@ class Selector(object):
                 sel_type = '%s(%s)' % (sel_type, ','.join(sel_attributes))
             parts.append('%s:%s' % (sel_type, sel_expr))
         return ' || '.join(parts)
+
+## Compiled expressions, shared by all the selectors in the process
+## (translating CSS to XPath and compiling it isn't cheap, and rules
+## are parsed again on every reload and clientside subrequest):
+_compiled_expressions = LRUCache(max_size=1000)
+
+def compile_expression(expr):
+    """
+    Returns the compiled selector for an expression: an ``XPath`` if
+    it starts with ``/``, otherwise a ``CSSSelector``.
+
+    The compiled objects are cached and shared; lxml serializes the
+    evaluation of a single XPath object, so they can be used from
+    several threads.
+    """
+    selector = _compiled_expressions.get(expr)
+    if selector is None:
+        if expr.startswith('/'):
+            selector = XPath(expr)
+        else:
+            selector = CSSSelector(expr)
+        _compiled_expressions.set(expr, selector)
+    return selector
+
+def compiled_expression_stats():
+    """
+    Returns the size and hit/miss counters of the cache used by
+    :func:`compile_expression` (see
+    :meth:`deliverance.util.lrucache.LRUCache.stats`).
+    """
+    return _compiled_expressions.stats()
+
+class SelectorMemo(object):
+    """
+    Remembers the results of selections in one document, so that
+    selectors with the same expression are only evaluated once.
+
+    The memo must be cleared (:meth:`clear`) whenever the document is
+    changed.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the remembered ``(type, elements, attributes)``, or None"""
+        result = self.results.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def set(self, key, result):
+        """Remembers a result"""
+        self.results[key] = result
+
+    def clear(self):
+        """Forgets all results"""
+        self.results.clear()
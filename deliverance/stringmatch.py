@@ -6,7 +6,8 @@ import fnmatch
 import re
 from deliverance.util.converters import asbool
 
-__all__ = ['compile_matcher', 'compile_header_matcher', 'MatchSyntaxError']
+__all__ = ['compile_matcher', 'compile_header_matcher', 'MatchSyntaxError',
+           'PatternGroup', 'HeaderGroup', 'split_path']
 
 _prefix_re = re.compile(r'^([a-z_-]+):', re.I)
 
@@ -342,3 +343,112 @@ class HeaderWildcardMatcher(object):
 
     def __str__(self):
         return str(self).encode('utf8')
+
+def split_path(path):
+    """The non-empty ``/``-separated segments of a path"""
+    return [segment for segment in path.split('/') if segment]
+
+class PatternGroup(object):
+    """
+    Several matchers compiled together, to find all the ones that
+    match a value at once.
+
+    `matchers` is a list of matchers (or None, for no pattern).
+    ``path:``, ``subpath:`` and ``exact:`` patterns share a trie of
+    path segments, literal case-insensitive patterns share a
+    dictionary, and the wildcard and regular expression patterns are
+    combined in one regular expression, so that when none of them
+    match (the usual case) they are all ruled out by a single search.
+    Other matchers are called one by one.
+    """
+
+    def __init__(self, matchers):
+        self.matchers = matchers
+        # Each node of the trie is [indexes, {segment: node}]:
+        self.trie = [[], {}]
+        self.literals = {}
+        self.patterns = []
+        self.others = []
+        combined = []
+        for index, matcher in enumerate(matchers):
+            if matcher is None:
+                continue
+            if isinstance(matcher, (PathMatcher, SubpathMatcher, ExactMatcher)):
+                node = self.trie
+                for segment in split_path(matcher.pattern):
+                    node = node[1].setdefault(segment, [[], {}])
+                node[0].append(index)
+            elif (isinstance(matcher, ExactInsensitiveMatcher)
+                  or (isinstance(matcher, WildcardInsensitiveMatcher)
+                      and not [c for c in '*?[' if c in matcher.pattern])):
+                self.literals.setdefault(matcher.pattern.lower(), []).append(index)
+            elif (isinstance(matcher, (WildcardMatcher, WildcardInsensitiveMatcher, RegexMatcher))
+                  and not matcher.compiled.groups):
+                self.patterns.append(index)
+                if matcher.compiled.flags & re.I:
+                    combined.append('(?i:%s)' % matcher.compiled.pattern)
+                else:
+                    combined.append('(?:%s)' % matcher.compiled.pattern)
+            else:
+                self.others.append(index)
+        self.combined = None
+        if combined:
+            try:
+                self.combined = re.compile('|'.join(combined))
+            except re.error:
+                # E.g., a regex with its own global flags; these are
+                # then tried one by one:
+                self.others.extend(self.patterns)
+                self.patterns = []
+
+    def matching(self, value):
+        """The set of the indexes of the matchers that match `value`"""
+        matchers = self.matchers
+        indexes = set()
+        node = self.trie
+        candidates = list(node[0])
+        for segment in split_path(value):
+            node = node[1].get(segment)
+            if node is None:
+                break
+            candidates.extend(node[0])
+        candidates.extend(self.literals.get(value.lower(), ()))
+        if self.combined is not None and self.combined.match(value):
+            candidates.extend(self.patterns)
+        candidates.extend(self.others)
+        for index in candidates:
+            if matchers[index](value):
+                indexes.add(index)
+        return indexes
+
+class HeaderGroup(object):
+    """
+    Several header matchers (or None) compiled together: each header
+    is looked up once for all the simple matchers on it.
+    """
+
+    def __init__(self, matchers):
+        self.matchers = matchers
+        # header name -> list of indexes:
+        self.by_header = {}
+        self.others = []
+        for index, matcher in enumerate(matchers):
+            if isinstance(matcher, HeaderMatcher):
+                self.by_header.setdefault(matcher.header, []).append(index)
+            elif matcher is not None:
+                self.others.append(index)
+
+    def results(self, headers):
+        """
+        Returns a dictionary of index to the result of the matcher,
+        ``(matched, header_names)``
+        """
+        matchers = self.matchers
+        results = {}
+        for header, indexes in self.by_header.items():
+            value = headers.get(header, '')
+            for index in indexes:
+                results[index] = (matchers[index].pattern(value), [header])
+        for index in self.others:
+            results[index] = matchers[index](headers)
+        return results
@@ -0,0 +1,163 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from deliverance.asgi import AsyncDeliveranceMiddleware, environ_to_scope, scope_to_environ
+from deliverance.cache import NonHTMLPaths
+from deliverance.log import SavingLogger
+from deliverance.ruleset import RuleSet
+from lxml.etree import XML
+from nose.tools import assert_equals
+from webob import Request
+
+RULES = '''\
+<ruleset>
+  <theme href="/theme.html" />
+  <rule>
+    <replace content="children:#main" theme="children:#content" />
+  </rule>
+</ruleset>'''
+
+PAGES = {
+    '/theme.html': b'<html><head><title>theme</title></head><body><div id="content">x</div></body></html>',
+    '/page': b'<html><body><div id="main">main</div></body></html>',
+    '/raw': b'<html><body>raw</body></html>',
+    '/sidebar': b'<html><body><div id="side">side</div></body></html>',
+    }
+
+async def app(scope, receive, send):
+    """
+    Serves PAGES as HTML; the request body of /upload, as it was
+    received; anything else as two chunks of text
+    """
+    requests.append((scope['path'], dict(scope['headers']).get(b'if-none-match')))
+    if scope['path'] == '/upload':
+        messages = [await receive(), await receive()]
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': repr(messages).encode()})
+        return
+    if scope['path'] in PAGES:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/html; charset=utf8')]})
+        await send({'type': 'http.response.body', 'body': PAGES[scope['path']]})
+        return
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': b'a', 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b'b'})
+
+requests = []
+
+def rule_getter(get_resource, app, orig_req):
+    return RuleSet.parse_xml(XML(RULES), 'test')
+
+def abort_rule_getter(get_resource, app, orig_req):
+    rules = RULES.replace('<ruleset>', '<ruleset><match path="/" abort="1" />')
+    return RuleSet.parse_xml(XML(rules), 'test')
+
+def make_scope(path, method='GET'):
+    return {'type': 'http', 'method': method, 'scheme': 'http',
+            'path': path, 'query_string': b'', 'root_path': '',
+            'headers': [(b'host', b'localhost')],
+            'server': ('localhost', 80), 'http_version': '1.1'}
+
+def request(middleware, path, method='GET', body=[b'']):
+    sent = []
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': True}
+                for chunk in body]
+    messages[-1]['more_body'] = False
+    async def receive():
+        return messages.pop(0)
+    async def send(message):
+        sent.append(message)
+    asyncio.run(middleware(make_scope(path, method), receive, send))
+    return sent
+
+def test_passthrough():
+    rule_sets = []
+    def counting_rule_getter(*args):
+        rule_sets.append(rule_getter(*args))
+        return rule_sets[-1]
+    middleware = AsyncDeliveranceMiddleware(app, counting_rule_getter,
+                                            non_html_paths=NonHTMLPaths())
+    sent = request(middleware, '/file.txt')
+    # Streamed on as it was sent:
+    assert_equals([m.get('body') for m in sent], [None, b'a', b'b'])
+    # The path is now known not to be HTML, so the rules aren't needed:
+    sent = request(middleware, '/file.txt')
+    assert_equals([m.get('body') for m in sent], [None, b'a', b'b'])
+    assert_equals(len(rule_sets), 1)
+
+def test_upload():
+    sent = request(AsyncDeliveranceMiddleware(app, rule_getter), '/upload',
+                   method='POST', body=[b'a', b'b'])
+    # The body is passed on as it comes, not read first:
+    assert_equals(eval(sent[1]['body'])[0]['more_body'], True)
+
+def test_abort():
+    sent = request(AsyncDeliveranceMiddleware(app, abort_rule_getter), '/raw')
+    # An aborted page is passed on without being read:
+    assert_equals(sent[1], {'type': 'http.response.body', 'body': PAGES['/raw']})
+
+def test_theme():
+    sent = request(AsyncDeliveranceMiddleware(app, rule_getter), '/page')
+    assert_equals(sent[0]['status'], 200)
+    body = sent[1]['body']
+    assert b'<title>theme</title>' in body
+    assert b'<div id="content">main</div>' in body
+
+def test_saturated_executor():
+    # The rules are applied on an executor with one thread, that the
+    # application also uses; the theme and the sidebar are fetched
+    # before the rules are applied, instead of from that thread:
+    executor = ThreadPoolExecutor(max_workers=1)
+    async def busy_app(scope, receive, send):
+        await asyncio.get_running_loop().run_in_executor(executor, len, '')
+        await app(scope, receive, send)
+    def sidebar_rule_getter(get_resource, app, orig_req):
+        rules = RULES.replace(
+            '</rule>', '<append href="/sidebar" content="#side" theme="children:body" /></rule>')
+        return RuleSet.parse_xml(XML(rules), 'test')
+    middleware = AsyncDeliveranceMiddleware(busy_app, sidebar_rule_getter,
+                                            executor=executor)
+    sent = []
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+    async def send(message):
+        sent.append(message)
+    async def themed():
+        await asyncio.wait_for(middleware(make_scope('/page'), receive, send), 5)
+    try:
+        asyncio.run(themed())
+    finally:
+        executor.shutdown(wait=False)
+    body = sent[1]['body']
+    assert b'<div id="content">main</div>' in body
+    assert b'<div id="side">side</div>' in body
+
+def test_internal_subrequest():
+    middleware = AsyncDeliveranceMiddleware(app, rule_getter)
+    async def fetch():
+        environ = scope_to_environ(make_scope('/page'), b'')
+        environ['deliverance.asgi_loop'] = asyncio.get_running_loop()
+        orig_req = Request(environ)
+        log = SavingLogger(orig_req, middleware)
+        # The fetcher is called from the executor, like apply_rules does:
+        return await middleware.run_sync(
+            middleware.get_resource, 'http://localhost/theme.html', orig_req,
+            log, False, 5, {'If-None-Match': '"v1"'})
+    del requests[:]
+    resp = asyncio.run(fetch())
+    assert_equals(resp.body, PAGES['/theme.html'])
+    assert_equals(requests, [('/theme.html', b'"v1"')])
+
+def test_scope_roundtrip():
+    scope = make_scope('/a%20b/c')
+    scope['root_path'] = '/app'
+    scope['path'] = '/app/a b/c'
+    scope['query_string'] = b'x=1'
+    req = Request(scope_to_environ(scope, b''))
+    assert_equals(req.url, 'http://localhost/app/a%20b/c?x=1')
+    new_scope = environ_to_scope(req.environ)
+    assert_equals(new_scope['path'], '/app/a b/c')
+    assert_equals(new_scope['root_path'], '/app')
+    assert_equals(new_scope['query_string'], b'x=1')
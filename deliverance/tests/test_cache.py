@@ -0,0 +1,467 @@
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from deliverance.cache import CachedDocument, FileContents, FragmentCache, NonHTMLPaths, OutputCache, ThemeCache
+from deliverance.exceptions import AbortTheme
+from deliverance.log import SavingLogger
+from deliverance.rules import ThemePlan, TransformState, is_content_element
+from deliverance.ruleset import RuleSet
+from deliverance.security import SecurityContext
+from deliverance.util.lrucache import LRUCache
+from lxml.etree import XML
+from lxml.html import tostring, document_fromstring
+from nose.tools import assert_equals
+from webob import Request, Response
+
+THEME = '<html><head><title>theme</title></head><body><div id="content">x</div></body></html>'
+
+def test_lru_eviction():
+    cache = LRUCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert_equals(cache.get('a'), 1)
+    cache.set('c', 3)
+    # 'b' was the least recently used:
+    assert 'b' not in cache
+    assert_equals(cache.get('a'), 1)
+    assert_equals(cache.get('c'), 3)
+    assert_equals(cache.get('b'), None)
+    assert_equals(cache.stats(), dict(size=2, max_size=2, hits=3, misses=1))
+
+def test_lru_disabled():
+    cache = LRUCache(max_size=0)
+    cache.set('a', 1)
+    assert_equals(len(cache), 0)
+
+class Fetcher(object):
+    """Serves the theme, answering conditional requests with a 304"""
+
+    def __init__(self, body=THEME, etag=None, pages=None):
+        self.body = body
+        self.etag = etag
+        # Other URLs (served without validators):
+        self.pages = pages or {}
+        self.requests = []
+
+    def __call__(self, url, retry_inner_if_not_200=False, extra_headers=None):
+        if url in self.pages:
+            return Response(self.pages[url], charset='utf8')
+        self.requests.append(extra_headers)
+        if (extra_headers and self.etag
+            and extra_headers.get('If-None-Match') == self.etag):
+            return Response(status=304)
+        resp = Response(self.body, charset='utf8')
+        if self.etag:
+            resp.headers['ETag'] = self.etag
+        return resp
+
+def get_theme(ruleset, cache, fetcher, url='http://localhost/theme.html'):
+    log = SavingLogger(None, None)
+    return ruleset.get_cached_theme(url, fetcher, log, cache)
+
+def test_theme_cache_revalidates():
+    ruleset = RuleSet([], [], {})
+    cache = ThemeCache()
+    fetcher = Fetcher(etag='"v1"')
+    resp, doc1 = get_theme(ruleset, cache, fetcher)
+    resp, doc2 = get_theme(ruleset, cache, fetcher)
+    assert_equals(fetcher.requests, [None, {'If-None-Match': '"v1"'}])
+    # Every request gets its own copy:
+    assert doc1 is not doc2
+    doc1.get_element_by_id('content').text = 'changed'
+    assert_equals(doc2.get_element_by_id('content').text, 'x')
+    assert_equals(cache.stats()['hits'], 1)
+
+def test_theme_cache_notices_changes():
+    ruleset = RuleSet([], [], {})
+    cache = ThemeCache()
+    fetcher = Fetcher()
+    resp, doc = get_theme(ruleset, cache, fetcher)
+    fetcher.body = THEME.replace('>x<', '>y<')
+    resp, doc = get_theme(ruleset, cache, fetcher)
+    assert_equals(doc.get_element_by_id('content').text, 'y')
+
+def test_theme_cache_shareable():
+    ruleset = RuleSet([], [], {})
+    cache = ThemeCache()
+    fetcher = Fetcher()
+    for header, value in [('Cache-Control', 'private'),
+                          ('Cache-Control', 'no-store'),
+                          ('Set-Cookie', 'session=1')]:
+        def private_fetcher(url, **kw):
+            resp = fetcher(url, **kw)
+            resp.headers[header] = value
+            return resp
+        get_theme(ruleset, cache, private_fetcher)
+        assert_equals(len(cache.documents), 0)
+    get_theme(ruleset, cache, fetcher)
+    assert_equals(len(cache.documents), 1)
+
+def test_theme_cache_file_access():
+    ruleset = RuleSet([], [], {})
+    cache = ThemeCache(file_ttl=60)
+    url = 'file:///themes/theme.html'
+    def fetch(url, display_local_files, fetcher):
+        req = Request.blank('http://localhost/page')
+        SecurityContext.install(req.environ,
+                                display_local_files=display_local_files)
+        log = SavingLogger(req, None)
+        return ruleset.get_theme_entry(url, fetcher, log, cache)
+    fetch(url, True, Fetcher())
+    # The fresh copy is used without fetching the theme:
+    fetcher = Fetcher()
+    fetch(url, True, fetcher)
+    assert_equals(fetcher.requests, [])
+    # But not for a request that may not read local files (whose
+    # resource fetcher refuses it):
+    def forbidden(url, **kw):
+        forbidden.requests.append(url)
+        return Response(status=403)
+    forbidden.requests = []
+    try:
+        fetch(url, False, forbidden)
+    except AbortTheme:
+        pass
+    else:
+        assert False, 'The cached theme was used'
+    assert_equals(forbidden.requests, [url])
+
+def test_cached_document_keeps_doctype():
+    ruleset = RuleSet([], [], {})
+    body = ('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
+            '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">' + THEME)
+    resp = Response(body, charset='utf8')
+    doc = ruleset.get_theme_doc(resp, 'http://localhost/theme.html')
+    entry = CachedDocument('http://localhost/theme.html', resp, doc)
+    copy = entry.copy_doc()
+    assert 'XHTML' in copy.getroottree().docinfo.doctype
+    assert_equals(copy.base_url, 'http://localhost/theme.html')
+    assert_equals(tostring(copy), tostring(doc))
+
+def test_skeleton():
+    ruleset = RuleSet.parse_xml(XML('''\
+<ruleset>
+  <rule>
+    <drop theme="/html/head/title" />
+    <append href="/nav.html" content="/html/body/p" theme="children:#content" />
+    <replace content="children:#main" theme="children:#content" />
+  </rule>
+</ruleset>'''), 'test')
+    rules = ruleset.rules_by_class['default']
+    cache = ThemeCache()
+    fetcher = Fetcher(etag='"v1"', pages={
+        'http://localhost/nav.html': '<html><body><p>nav</p></body></html>'})
+    def skeleton():
+        log = SavingLogger(Request.blank('http://localhost/page'), None)
+        entry = ruleset.get_theme_entry(
+            'http://localhost/theme.html', fetcher, log, cache)
+        content_doc = document_fromstring(
+            '<html><body><div id="main">main</div></body></html>')
+        skeleton, applied = ruleset.get_skeleton(
+            entry, rules, content_doc, fetcher, log)
+        doc = skeleton.copy_doc()
+        state = ruleset.get_plan(skeleton, rules, applied).resolve(doc)
+        used = [msg for level, el, msg in log.messages
+                if 'already applied' in msg]
+        return doc, applied, used, state
+    doc, applied, used, state = skeleton()
+    assert_equals(applied, [2])
+    assert_equals(used, [])
+    assert doc.find('head/title') is None
+    assert_equals(doc.get_element_by_id('content').findtext('p'), 'nav')
+    # The fragment is known to come from elsewhere, without marking it:
+    nav = doc.get_element_by_id('content').find('p')
+    assert is_content_element(nav, state)
+    assert not is_content_element(nav.getparent(), state)
+    assert 'x-a-marker' not in tostring(doc).decode('ascii')
+    doc, applied, used, state = skeleton()
+    assert_equals(len(used), 1)
+    assert_equals(doc.get_element_by_id('content').findtext('p'), 'nav')
+    # A changed fragment means the static actions are applied again:
+    fetcher.pages['http://localhost/nav.html'] = (
+        '<html><body><p>new nav</p></body></html>')
+    doc, applied, used, state = skeleton()
+    assert_equals(used, [])
+    assert_equals(doc.get_element_by_id('content').findtext('p'), 'new nav')
+
+def test_skeleton_private_fragment():
+    ruleset = RuleSet.parse_xml(XML('''\
+<ruleset>
+  <rule>
+    <append href="/nav.html" content="/html/body/p" theme="children:#content" />
+  </rule>
+</ruleset>'''), 'test')
+    rules = ruleset.rules_by_class['default']
+    cache = ThemeCache()
+    theme_fetcher = Fetcher(etag='"v1"')
+    def fetcher(url, **kw):
+        if url != 'http://localhost/nav.html':
+            return theme_fetcher(url, **kw)
+        fetcher.user += 1
+        resp = Response('<html><body><p>user %s</p></body></html>' % fetcher.user,
+                        charset='utf8')
+        resp.cache_control.private = True
+        return resp
+    fetcher.user = 0
+    for user in (1, 2):
+        log = SavingLogger(Request.blank('http://localhost/page'), None)
+        entry = ruleset.get_theme_entry(
+            'http://localhost/theme.html', fetcher, log, cache)
+        skeleton, applied = ruleset.get_skeleton(
+            entry, rules, document_fromstring('<html></html>'), fetcher, log)
+        # Each request gets its own copy of the private resource:
+        assert_equals(skeleton.doc.get_element_by_id('content').findtext('p'),
+                      'user %s' % user)
+    assert_equals(len(entry.skeletons), 0)
+
+def test_fragment_cache():
+    responses = {}
+    requests = []
+    def fetcher(url, retry_inner_if_not_200=False, extra_headers=None):
+        requests.append((url, extra_headers))
+        if extra_headers and extra_headers.get('If-None-Match') == '"v1"':
+            return Response(status=304)
+        return Response(
+            '<html><body><p>%s</p></body></html>' % url, charset='utf8',
+            headers=responses[url])
+    parsed = []
+    def parse(resp):
+        parsed.append(resp)
+        return document_fromstring(resp.body)
+    cache = FragmentCache()
+    responses['http://localhost/fresh'] = [('Cache-Control', 'max-age=60')]
+    responses['http://localhost/etag'] = [('ETag', '"v1"')]
+    responses['http://localhost/private'] = [('Cache-Control', 'private, max-age=60')]
+    for i in range(2):
+        for url in sorted(responses):
+            resp, doc = cache.fetch(url, fetcher, parse)
+            assert_equals(doc.findtext('body/p'), url)
+    assert_equals(requests, [
+        ('http://localhost/etag', None),
+        ('http://localhost/fresh', None),
+        ('http://localhost/private', None),
+        ('http://localhost/etag', {'If-None-Match': '"v1"'}),
+        ('http://localhost/private', None)])
+    # Only the private response was parsed twice:
+    assert_equals(len(parsed), 4)
+
+def test_fragment_dedupe():
+    ruleset = RuleSet.parse_xml(XML('''\
+<ruleset>
+  <rule>
+    <append href="/nav.html" content="#one" theme="children:#content" />
+    <append href="/nav.html" content="#two" theme="children:#content" />
+  </rule>
+</ruleset>'''), 'test')
+    rule = ruleset.rules_by_class['default'][0]
+    fetcher = Fetcher(body='<html><body><p id="one">1</p><p id="two">2</p></body></html>')
+    log = SavingLogger(Request.blank('http://localhost/page'), None)
+    theme_doc = document_fromstring(THEME)
+    content_doc = document_fromstring('<html><body></body></html>')
+    rule.apply(content_doc, theme_doc, fetcher, log, state=TransformState())
+    assert_equals(len(fetcher.requests), 1)
+    assert_equals([p.get('id') for p in theme_doc.get_element_by_id('content')],
+                  ['one', 'two'])
+
+def test_prefetch():
+    ruleset = RuleSet.parse_xml(XML('''\
+<ruleset>
+  <rule>
+    <replace content="children:#main" theme="children:#content" />
+    <append href="/a.html" content="/html/body/p" theme="children:#content" />
+    <append href="/b.html" content="/html/body/p" theme="children:#content" />
+    <append href="/c.html" content="/html/body/p" theme="children:#content" />
+  </rule>
+</ruleset>'''), 'test')
+    # Each fetch waits until all three are being fetched:
+    barrier = threading.Barrier(3)
+    def fetcher(url, retry_inner_if_not_200=False, extra_headers=None):
+        barrier.wait(timeout=5)
+        return Response('<html><body><p>%s</p></body></html>' % url[-6:],
+                        charset='utf8')
+    rules = ruleset.rules_by_class['default']
+    log = SavingLogger(Request.blank('http://localhost/page'), None)
+    state = TransformState()
+    pool = ThreadPoolExecutor(max_workers=3)
+    try:
+        ruleset.prefetch_fragments(rules, fetcher, log, pool, state)
+        theme_doc = document_fromstring(THEME)
+        content_doc = document_fromstring(
+            '<html><body><div id="main">main</div></body></html>')
+        rules[0].apply(content_doc, theme_doc, fetcher, log, state=state)
+    finally:
+        pool.shutdown()
+    assert_equals([p.text for p in theme_doc.get_element_by_id('content').findall('p')],
+                  ['a.html', 'b.html', 'c.html'])
+
+def test_theme_plan():
+    ruleset = RuleSet.parse_xml(XML('''\
+<ruleset>
+  <rule>
+    <append content="elements:#a" theme="children:#content" />
+    <replace content="children:#b" theme="children:#footer" />
+    <drop theme="#content > div:first-child" />
+  </rule>
+</ruleset>'''), 'test')
+    rule = ruleset.rules_by_class['default'][0]
+    append, replace, drop = rule._actions
+    theme = document_fromstring(
+        '<html><body><div id="content"><div>x</div></div>'
+        '<div id="footer">f</div></body></html>')
+    plan = ThemePlan([rule], theme)
+    # Nothing but marked content is inserted before the <replace>;
+    # after that the positional selector has to be evaluated normally:
+    assert_equals(set(plan.selections), set([append, replace]))
+    copy = CachedDocument('http://localhost/theme.html',
+                          Response(), theme).copy_doc()
+    state = plan.resolve(copy)
+    for action in append, replace:
+        sel_type, els, attributes = state.theme_selections[action]
+        assert_equals(
+            [el.getroottree().getpath(el) for el in els],
+            [el.getroottree().getpath(el)
+             for el in action.select_elements(action.theme, copy, True)[1]])
+        assert els[0].getroottree().getroot() is copy
+
+def test_output_cache():
+    ruleset = RuleSet([], [], {})
+    theme_cache = ThemeCache()
+    cache = OutputCache(ttl=60)
+    def key(url='http://localhost/page', body=THEME, **headers):
+        req = Request.blank(url, headers=headers)
+        resp = Response(body, charset='utf8')
+        assert cache.is_cacheable(req, resp, ruleset)
+        return cache.key(req, resp, ruleset, theme_cache)
+    assert_equals(cache.lookup(key()), None)
+    themed = Response('themed', charset='utf8')
+    cache.store(key(), themed)
+    assert_equals(cache.lookup(key()), (themed.headers['Content-Type'], themed.body))
+    assert_equals(cache.lookup(key(Cookie='user=bob')), None)
+    assert_equals(cache.lookup(key(body=THEME.replace('x', 'y'))), None)
+    assert_equals(cache.lookup(key('http://localhost/other')), None)
+    assert_equals((cache.stats()['hits'], cache.stats()['misses']), (1, 4))
+    # A new theme means a new key:
+    theme_cache.store('theme', CachedDocument('http://localhost/theme.html',
+                                              Response(), None))
+    assert_equals(cache.lookup(key()), None)
+    cache.ttl = -1
+    cache.store(key(), themed)
+    assert_equals(cache.lookup(key()), None)
+    # Each lookup is counted once (an expired page is a miss):
+    assert_equals((cache.stats()['hits'], cache.stats()['misses']), (1, 6))
+
+def test_output_cache_threads():
+    cache = OutputCache(max_size=5)
+    for n in range(5):
+        cache.store(n, Response('themed', charset='utf8'))
+    def lookups():
+        for n in range(200):
+            cache.lookup(n % 10)
+    threads = [threading.Thread(target=lookups) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equals((cache.stats()['hits'], cache.stats()['misses']), (400, 400))
+
+def test_output_cache_bypass():
+    cache = OutputCache()
+    ruleset = RuleSet([], [], {})
+    req = Request.blank('http://localhost/page')
+    resp = Response(THEME, charset='utf8')
+    assert cache.is_cacheable(req, resp, ruleset)
+    assert not cache.is_cacheable(
+        Request.blank('http://localhost/page?deliv_log'), resp, ruleset)
+    resp.set_cookie('session', '1')
+    assert not cache.is_cacheable(req, resp, ruleset)
+    resp = Response(THEME, charset='utf8', cache_control='private')
+    assert not cache.is_cacheable(req, resp, ruleset)
+    ruleset = RuleSet.parse_xml(XML('''\
+<ruleset>
+  <theme href="/theme.html?user={HTTP_X_USER}" />
+</ruleset>'''), 'test')
+    assert ruleset.depends_on_request()
+    assert not cache.is_cacheable(req, Response(THEME, charset='utf8'), ruleset)
+
+def test_non_html_paths():
+    paths = NonHTMLPaths(ttl=60)
+    css = [('Content-Type', 'text/css')]
+    paths.learn(Request.blank('/style.css'), '200 OK', css)
+    paths.learn(Request.blank('/page'), '200 OK', [('Content-Type', 'text/html; charset=utf8')])
+    paths.learn(Request.blank('/moved'), '302 Found', css)
+    paths.learn(Request.blank('/search?q=x'), '200 OK', css)
+    assert paths.is_known(Request.blank('/style.css'))
+    assert not paths.is_known(Request.blank('/style.css?v=2'))
+    assert not paths.is_known(Request.blank('/style.css', method='POST'))
+    assert not paths.is_known(Request.blank('/page'))
+    assert not paths.is_known(Request.blank('/moved'))
+    assert not paths.is_known(Request.blank('/search'))
+    # Paths are forgotten after the ttl:
+    paths.ttl = -1
+    paths.learn(Request.blank('/style.css'), '200 OK', css)
+    assert not paths.is_known(Request.blank('/style.css'))
+    assert_equals(paths.stats()['size'], 0)
+    # Content-negotiated paths:
+    paths.ttl = 60
+    json = [('Content-Type', 'application/json')]
+    paths.learn(Request.blank('/api', accept='application/json'), '200 OK', json)
+    assert paths.is_known(Request.blank('/api', accept='application/json'))
+    assert not paths.is_known(Request.blank('/api', accept='text/html'))
+    assert not paths.is_known(Request.blank('/api'))
+    paths.learn(Request.blank('/items'), '200 OK', json + [('Vary', 'Accept')])
+    assert not paths.is_known(Request.blank('/items'))
+
+def test_file_contents():
+    tmp = tempfile.mkdtemp()
+    filename = os.path.join(tmp, 'page.html')
+    content = b'<html><body>' + b'x' * 1000 + b'</body></html>'
+    with open(filename, 'wb') as f:
+        f.write(content)
+    try:
+        contents = FileContents(max_size=10)
+        assert_equals(contents.read(filename), content)
+        assert_equals(contents.read(filename), content)
+        assert_equals(contents.stats()['hits'], 1)
+        # A changed file is read again:
+        with open(filename, 'wb') as f:
+            f.write(b'changed')
+        os.utime(filename, (0, 0))
+        assert_equals(contents.read(filename), b'changed')
+        # Large files aren't kept:
+        contents = FileContents(max_file_size=10)
+        assert_equals(contents.read(filename), b'changed')
+        with open(filename, 'wb') as f:
+            f.write(content)
+        assert_equals(contents.read(filename), content)
+        assert_equals(contents.stats()['size'], 0)
+    finally:
+        shutil.rmtree(tmp)
+
+def test_subrequest_rule_getter():
+    from deliverance.middleware import SubrequestRuleGetter
+    rules = ['<ruleset><theme href="/theme.html" /></ruleset>']
+    fetches = []
+    def get_resource(url, extra_headers=None):
+        fetches.append((url, extra_headers))
+        if extra_headers and extra_headers.get('If-None-Match') == '"v%s"' % len(rules):
+            return Response(status=304)
+        resp = Response(rules[-1].encode('utf8'), content_type='text/xml')
+        resp.headers['ETag'] = '"v%s"' % len(rules)
+        return resp
+    getter = SubrequestRuleGetter('/rules.xml', min_interval=0)
+    orig_req = Request.blank('http://localhost/page')
+    rule_set = getter(get_resource, None, orig_req)
+    assert_equals(fetches, [('http://localhost/rules.xml', None)])
+    # Revalidated, and not parsed again:
+    assert getter(get_resource, None, orig_req) is rule_set
+    assert_equals(fetches[-1][1], {'If-None-Match': '"v1"'})
+    rules.append('<ruleset><theme href="/other.html" /></ruleset>')
+    new_rule_set = getter(get_resource, None, orig_req)
+    assert new_rule_set is not rule_set
+    assert_equals(new_rule_set.default_theme.href, '/other.html')
+    # Not revalidated within the interval:
+    getter.min_interval = 60
+    assert getter(get_resource, None, orig_req) is new_rule_set
+    assert_equals(len(fetches), 3)
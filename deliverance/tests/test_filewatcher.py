@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import threading
+from deliverance.middleware import FileRuleGetter
+from deliverance.util.filewatcher import FileWatcher, source_files
+from nose.tools import assert_equals
+
+RULES = '<ruleset><theme href="/%s.html" /></ruleset>'
+
+def write(filename, content):
+    with open(filename, 'w') as f:
+        f.write(content)
+
+def check_watcher(use_inotify):
+    tmp = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp, 'rules.xml')
+        write(filename, 'a')
+        changed = threading.Event()
+        watcher = FileWatcher([filename], changed.set, interval=0.05,
+                              use_inotify=use_inotify)
+        watcher.start()
+        try:
+            # Other files are ignored:
+            write(os.path.join(tmp, 'other.xml'), 'b')
+            assert not changed.wait(0.3)
+            write(filename, 'bb')
+            os.utime(filename, (0, 0))
+            assert changed.wait(5)
+        finally:
+            watcher.stop()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_poll():
+    check_watcher(False)
+
+def test_inotify():
+    # Falls back to polling where inotify isn't available:
+    check_watcher(True)
+
+def test_source_files():
+    tmp = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(tmp, 'sub'))
+        write(os.path.join(tmp, 'rules.xml'),
+              '<ruleset xmlns:xi="http://www.w3.org/2001/XInclude">'
+              '<xi:include href="sub/proxies.xml" /></ruleset>')
+        write(os.path.join(tmp, 'sub', 'proxies.xml'),
+              '<proxies xmlns:xi="http://www.w3.org/2001/XInclude">'
+              '<xi:include href="more.xml" />'
+              '<xi:include href="http://example.com/remote.xml" /></proxies>')
+        write(os.path.join(tmp, 'sub', 'more.xml'), '<proxy />')
+        assert_equals(source_files(os.path.join(tmp, 'rules.xml')),
+                      [os.path.join(tmp, 'rules.xml'),
+                       os.path.join(tmp, 'sub', 'proxies.xml'),
+                       os.path.join(tmp, 'sub', 'more.xml')])
+    finally:
+        shutil.rmtree(tmp)
+
+def test_rule_getter_keeps_good_rules():
+    tmp = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp, 'rules.xml')
+        write(filename, RULES % 'one')
+        getter = FileRuleGetter(filename, always_reload=True)
+        getter.watcher.stop()
+        assert_equals(getter(None, None, None).default_theme.href, '/one.html')
+        write(filename, RULES % 'two')
+        getter.reload_rules()
+        assert_equals(getter(None, None, None).default_theme.href, '/two.html')
+        write(filename, '<ruleset><broken')
+        getter.reload_rules()
+        assert_equals(getter(None, None, None).default_theme.href, '/two.html')
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,163 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from deliverance.util.httppool import ConnectionPool
+from nose.tools import assert_equals
+from webob import Request
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Set to let /slow respond:
+    go = threading.Event()
+
+    def do_GET(self):
+        if self.path == '/slow':
+            self.go.wait(5)
+        if self.path == '/big':
+            body = b'x' * 200000
+        else:
+            body = ('%s %s' % (self.path, self.headers.get('Connection'))).encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        if self.path == '/close':
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%s' % server.server_port
+
+def test_keep_alive():
+    server, url = serve()
+    pool = ConnectionPool(max_per_host=2)
+    try:
+        req = Request.blank(url + '/a')
+        # Hop-by-hop headers aren't passed on:
+        req.headers['Connection'] = 'close'
+        resp = req.get_response(pool)
+        assert_equals(resp.body, b'/a None')
+        resp = Request.blank(url + '/b?x=1').get_response(pool)
+        assert_equals(resp.body, b'/b?x=1 None')
+        assert_equals(pool.stats(), dict(created=1, reused=1, idle=1))
+        # A connection the server closes isn't reused:
+        resp = Request.blank(url + '/close').get_response(pool)
+        assert 'Connection' not in resp.headers
+        assert_equals(pool.stats()['idle'], 0)
+    finally:
+        pool.clear()
+        server.shutdown()
+        server.server_close()
+
+def test_stale_connection():
+    server, url = serve()
+    pool = ConnectionPool()
+    try:
+        Request.blank(url + '/a').get_response(pool)
+        # The server drops the idle connection:
+        for conns in pool.idle.values():
+            for conn, last_used in conns:
+                conn.sock.shutdown(2)
+        resp = Request.blank(url + '/b').get_response(pool)
+        assert_equals(resp.body, b'/b None')
+        assert_equals(pool.stats()['created'], 2)
+    finally:
+        pool.clear()
+        server.shutdown()
+        server.server_close()
+
+def test_streaming():
+    server, url = serve()
+    pool = ConnectionPool(max_per_host=1, chunk_size=50000)
+    try:
+        resp = Request.blank(url + '/big').get_response(pool)
+        assert_equals(resp.content_length, 200000)
+        # Read as it is consumed, holding the connection:
+        app_iter = resp.app_iter
+        assert_equals(len(next(iter(app_iter))), 50000)
+        assert_equals(pool.stats()['idle'], 0)
+        assert_equals(sum(len(chunk) for chunk in app_iter), 150000)
+        app_iter.close()
+        assert_equals(pool.stats(), dict(created=1, reused=0, idle=1))
+        # Small bodies are read at once:
+        resp = Request.blank(url + '/a').get_response(pool)
+        assert_equals(resp.app_iter, [b'/a None'])
+        assert_equals(pool.stats(), dict(created=1, reused=1, idle=1))
+    finally:
+        pool.clear()
+        server.shutdown()
+        server.server_close()
+
+def test_host_limit_timeout():
+    server, url = serve()
+    pool = ConnectionPool(max_per_host=1, wait_timeout=0.2, chunk_size=50000)
+    try:
+        # A download in progress doesn't hold the only slot:
+        resp = Request.blank(url + '/big').get_response(pool)
+        next(iter(resp.app_iter))
+        assert_equals(Request.blank(url + '/a').get_response(pool).body, b'/a None')
+        resp.app_iter.close()
+        # A request waiting for its response does:
+        Handler.go.clear()
+        slow = threading.Thread(
+            target=lambda: Request.blank(url + '/slow').get_response(pool))
+        slow.start()
+        time.sleep(0.1)
+        assert_equals(Request.blank(url + '/a').get_response(pool).status_int, 503)
+        Handler.go.set()
+        slow.join()
+        assert_equals(Request.blank(url + '/a').get_response(pool).body, b'/a None')
+        # A failed connection gives its slot back:
+        pool.request = lambda *args: 1/0
+        try:
+            Request.blank(url + '/a').get_response(pool)
+        except ZeroDivisionError:
+            pass
+        del pool.request
+        assert_equals(Request.blank(url + '/a').get_response(pool).body, b'/a None')
+    finally:
+        pool.clear()
+        server.shutdown()
+        server.server_close()
+
+class FullLimit(object):
+    """A host limit with no place left, noting how long it was waited on"""
+
+    waited = None
+
+    def acquire(self, timeout=None):
+        self.waited = timeout
+        return False
+
+def test_default_wait_timeout():
+    pool = ConnectionPool()
+    limit = FullLimit()
+    pool.host_limit = lambda key: limit
+    # With the default settings a full host isn't waited on forever
+    # (whatever the socket timeout):
+    resp = Request.blank('http://127.0.0.1:9/a').get_response(pool)
+    assert_equals(resp.status_int, 503)
+    assert_equals(limit.waited, 30)
+    assert_equals(pool.timeout, None)
+
+def test_no_keep_alive():
+    server, url = serve()
+    # As used for proxying without <connection-pool>:
+    pool = ConnectionPool(max_per_host=None, keep_alive=False, chunk_size=50000)
+    try:
+        resp = Request.blank(url + '/a').get_response(pool)
+        assert_equals(resp.body, b'/a close')
+        resp = Request.blank(url + '/big').get_response(pool)
+        assert_equals(len(next(iter(resp.app_iter))), 50000)
+        resp.app_iter.close()
+        assert_equals(pool.stats(), dict(created=2, reused=0, idle=0))
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,50 @@
+from deliverance.log import SavingLogger
+from deliverance.security import SecurityContext
+from lxml.html import document_fromstring
+from nose.tools import assert_equals
+from webob import Request
+
+class Counted(object):
+    formatted = 0
+    def __str__(self):
+        Counted.formatted += 1
+        return 'counted'
+
+def make_log(url, display_logging):
+    req = Request.blank(url)
+    SecurityContext.install(req.environ, display_logging=display_logging)
+    return SavingLogger(req, None)
+
+def test_debug_disabled():
+    for url, display_logging in [('/page', True), ('/page?deliv_log', False)]:
+        log = make_log(url, display_logging)
+        assert not log.debug_enabled
+        log.debug(None, 'skipped %s', Counted())
+        log.info(None, 'skipped')
+        log.warn(None, 'kept %s', 1)
+        assert_equals([msg for level, el, msg in log.messages], ['kept 1'])
+
+def test_lazy_formatting():
+    log = make_log('/page?deliv_log', True)
+    assert log.debug_enabled
+    Counted.formatted = 0
+    log.debug(None, 'message %s', Counted())
+    log.info(None, 'message %(x)s', x=2)
+    assert_equals(Counted.formatted, 0)
+    assert_equals([msg for level, el, msg in log.messages],
+                  ['message counted', 'message 2'])
+    assert_equals(Counted.formatted, 1)
+
+def test_snapshot_elements():
+    doc = document_fromstring('<html><body><div>a</div><div id="x">b</div></body></html>')
+    el = doc.body[1]
+    log = SavingLogger(None, None, retain_elements=False)
+    log.debug(el, 'moved %s', el)
+    level, context, msg = log.messages[0]
+    assert_equals(str(context), '<div> /html/body/div[2]')
+    assert msg.startswith('moved <Element div')
+    assert_equals(log.stats()['documents'], 0)
+    log = SavingLogger(None, None)
+    log.debug(el, 'moved %s', el)
+    assert log.messages[0][1] is el
+    assert_equals(log.stats()['documents'], 1)
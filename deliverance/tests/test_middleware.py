@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
-from deliverance.log import PrintingLogger
+from deliverance.log import PrintingLogger, SavingLogger
 from deliverance.middleware import DeliveranceMiddleware
 from deliverance.middleware import FileRuleGetter, SubrequestRuleGetter
+from deliverance.middleware import make_deliverance_middleware
+from deliverance.ruleset import RuleSet
+from deliverance.util.proxiedbody import ProxiedBody, ENVIRON_KEY
 import logging
+import os
 from lxml.cssselect import CSSSelector
 import lxml.html
+from lxml.etree import XML
 import re
 from paste.urlmap import URLMap
 import pkg_resources
@@ -517,3 +522,59 @@ def test_head_requests():
     resp = deliv_filename.get("/collapse_content.html")
     assert resp.content_length == head_resp.content_length
     assert resp.headers == head_resp.headers
+
+def test_clientside_title():
+    """ The clientside theme has the title of the page, if it is known """
+    middleware = deliv_filename.app
+    rule_set = RuleSet.parse_xml(
+        XML('<ruleset><theme href="/theme.html" /></ruleset>'),
+        'http://localhost/rules.xml')
+    def resource_fetcher(url, retry_inner_if_not_200=False, extra_headers=None):
+        return Response(get_text("theme.html"))
+    req = Request.blank('http://localhost/about.html')
+    middleware.known_titles[req.url] = 'About &amp; more'
+    log = SavingLogger(req, middleware)
+    resp = middleware.clientside_response(req, rule_set, resource_fetcher, log)
+    tree = lxml.html.document_fromstring(resp.body)
+    assert tree.findtext('head/title') == 'About & more'
+    assert tree.find('head/script') is not None
+
+PROXIED_PAGE = b'<html><head><base href="/dir/"></head><body><a href="page">x</a></body></html>'
+
+def repl(link):
+    return link.replace('http://up/', 'http://me/')
+
+def test_output_cache_proxied_body():
+    rules = tempfile.NamedTemporaryFile('w', suffix='.xml', delete=False)
+    rules.write('''\
+<ruleset>
+  <theme href="/theme.html" />
+  <rule>
+    <replace content="children:/html/body" theme="children:/html/body" />
+  </rule>
+</ruleset>''')
+    rules.close()
+    bodies = []
+    def app(environ, start_response):
+        req = Request(environ)
+        if req.path_info == '/theme.html':
+            resp = Response(b'<html><body>theme</body></html>', content_type='text/html')
+        else:
+            proxied = ProxiedBody([PROXIED_PAGE], repl, 'http://up/blog/1')
+            bodies.append(proxied)
+            environ[ENVIRON_KEY] = proxied
+            resp = Response(app_iter=proxied, content_type='text/html', charset=None)
+        return resp(environ, start_response)
+    try:
+        wsgi_app = make_deliverance_middleware(
+            app, {}, rule_filename=rules.name, output_cache_size='10')
+        themed = [Request.blank('http://me/blog/1').get_response(wsgi_app)
+                  for n in range(2)]
+    finally:
+        os.unlink(rules.name)
+    assert b'href="http://me/dir/page"' in themed[0].body
+    assert themed[1].body == themed[0].body
+    # The cache key didn't read the rewritten body, so the page was
+    # parsed from the document:
+    assert not bodies[0].dirty
+    assert not bodies[1].dirty
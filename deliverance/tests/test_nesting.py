@@ -0,0 +1,42 @@
+from deliverance.util.nesting import round_trips
+from lxml.etree import Comment
+from lxml.html import document_fromstring, fragment_fromstring, tostring
+from nose.tools import assert_equals
+
+DOCTYPE = ('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.0 Transitional//EN" '
+           '"http://www.w3.org/TR/REC-html40/loose.dtd">')
+
+def reparsed(doc):
+    html = DOCTYPE + tostring(doc, encoding=str)
+    return tostring(document_fromstring(html).getroottree(), method='html')
+
+def theme(body):
+    return document_fromstring(
+        '<html><head><title>t</title></head><body>%s</body></html>' % body)
+
+def check(doc, expected):
+    before = reparsed(doc)
+    assert_equals(round_trips(doc), expected)
+    if expected:
+        assert_equals(tostring(doc, method='html', doctype=DOCTYPE), before)
+
+def test_well_formed():
+    check(theme('<div id="a"><p>x <b>y</b></p><ul><li>1</li><li>2</li></ul></div>'
+                '<table><tr><td>c</td></tr></table><!-- c -->'), True)
+    # Empty text, as the rules leave in emptied elements:
+    doc = theme('<ul><li>1</li><li></li></ul>')
+    doc.body[0][1].text = ''
+    check(doc, True)
+
+def test_repaired():
+    doc = theme('<p>x</p>')
+    doc.body[0].append(fragment_fromstring('<div>y</div>'))
+    check(doc, False)
+    # An empty element whose end tag is left out swallows what follows:
+    doc = theme('<ul></ul>')
+    doc.body.insert(0, doc.body.makeelement('li', {}))
+    check(doc, False)
+    # Markup in a <style> is text to the parser:
+    doc = theme('<style></style>')
+    doc.body[0].append(Comment('c'))
+    check(doc, False)
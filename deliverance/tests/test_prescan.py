@@ -0,0 +1,59 @@
+from deliverance.util.cdata import escape_cdata, unescape_cdata
+from deliverance.util.charset import fix_meta_charset_position
+from deliverance.util.prescan import Prescan, prepare_document
+from nose.tools import assert_equals
+
+DOC = '''<html><HEAD profile="x">
+<title>The  <b>title</b></title>
+<meta http-equiv="X-Deliverance-Page-Class" content="blog">
+<script>
+//<![CDATA[
+if (1 > 0 && 2 < 3) { document.write('<meta charset="bad">'); }
+//]]>
+</script>
+<meta http-equiv="Content-Type" content="text/html; charset=ISO-8859-1" />
+<meta name="description" content="nothing">
+</head>
+<body>
+<meta http-equiv="Refresh" content="5">
+<title>Not the title</title>
+<script>//<![CDATA[
+x = 1 < 2;
+//]]></script>
+</body></html>'''
+
+def test_scan():
+    scan = Prescan(DOC)
+    assert_equals(scan.title, 'The  <b>title</b>')
+    assert_equals(scan.charset, 'ISO-8859-1')
+    # Only the <head> is looked at:
+    assert_equals(scan.meta_headers,
+                  [('X-Deliverance-Page-Class', 'blog'),
+                   ('Content-Type', 'text/html; charset=ISO-8859-1')])
+    assert_equals(len(scan.cdata), 2)
+    assert_equals(len(scan.charset_tags), 1)
+    assert DOC[scan.head_tag:].startswith('\n<title>')
+
+def test_bytes():
+    scan = Prescan(DOC.encode('ascii'))
+    assert_equals(scan.title, 'The  <b>title</b>')
+    assert_equals(scan.charset, 'ISO-8859-1')
+    assert_equals(scan.meta_headers[0], ('X-Deliverance-Page-Class', 'blog'))
+    assert_equals(prepare_document(DOC.encode('ascii')),
+                  prepare_document(DOC).encode('ascii'))
+
+def test_prepare():
+    doc = DOC.replace('<HEAD profile="x">', '<head>')
+    expected = fix_meta_charset_position(escape_cdata(doc))
+    assert_equals(prepare_document(doc), expected)
+    assert_equals(prepare_document(doc, fix_meta_charset_position=False),
+                  escape_cdata(doc))
+    assert_equals(unescape_cdata(prepare_document(doc, fix_meta_charset_position=False)),
+                  doc)
+    # The charset tag is moved to the start of the <head>:
+    prepared = prepare_document(DOC)
+    assert prepared.startswith('<html><HEAD profile="x"><meta http-equiv="Content-Type"')
+    assert_equals(prepared.count('charset=ISO-8859-1'), 1)
+    # Nothing to do:
+    doc = '<html><body>x</body></html>'
+    assert prepare_document(doc) is doc
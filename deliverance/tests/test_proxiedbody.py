@@ -0,0 +1,86 @@
+from deliverance.util.proxiedbody import ProxiedBody, attached_body, ENVIRON_KEY
+from lxml.html import tostring
+from nose.tools import assert_equals
+from webob import Request, Response
+
+PAGE = b'<html><head><base href="/dir/"></head><body><a href="page">x</a> <a href="http://other/">o</a></body></html>'
+
+def repl(link):
+    if link.startswith('http://up/'):
+        return 'http://me/' + link[len('http://up/'):]
+    return link
+
+def proxied_response(body=PAGE, charset=None):
+    req = Request.blank('http://me/blog/1')
+    proxied = ProxiedBody([body], repl, 'http://up/blog/1', charset=charset)
+    req.environ[ENVIRON_KEY] = proxied
+    resp = Response(app_iter=proxied, content_type='text/html', charset=charset,
+                    request=req)
+    return proxied, resp
+
+def test_document():
+    proxied, resp = proxied_response()
+    assert attached_body(resp) is proxied
+    doc = proxied.document('http://me/blog/1', 'utf8')
+    assert_equals([link for el, attr, link, pos in doc.iterlinks()],
+                  ['http://me/dir/page', 'http://other/'])
+    assert not proxied.dirty
+    # The body can still be used, rewritten as if streamed:
+    assert_equals(resp.body, PAGE.replace(b'"/dir/"', b'"http://me/dir/"')
+                  .replace(b'"page"', b'"http://me/dir/page"'))
+    assert proxied.dirty
+    assert attached_body(resp) is None
+
+def test_not_attached():
+    proxied, resp = proxied_response()
+    # Another middleware reads (and perhaps changes) the body:
+    resp.body = resp.body.replace(b'x', b'y')
+    assert attached_body(resp) is None
+    # Or never saw a ProxiedBody:
+    resp = Response(b'<html></html>', request=Request.blank('/'))
+    assert attached_body(resp) is None
+
+def test_utf16():
+    body = PAGE.decode('ascii').encode('utf-16')
+    proxied, resp = proxied_response(body, charset='utf-16')
+    doc = proxied.document('http://me/blog/1', 'utf-16')
+    assert b'http://me/dir/page' in tostring(doc)
+    assert 'http://me/dir/page' in resp.body.decode('utf-16')
+
+class Upstream(object):
+    """An app_iter that notes whether it was closed"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = 0
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed += 1
+
+def test_close():
+    upstream = Upstream([b'<html><body><a href="/a">a</a>', b'<a href="/b">b</a></body></html>'])
+    proxied = ProxiedBody(upstream, repl, 'http://up/blog/1')
+    stream = iter(proxied)
+    assert b'href="http://me/a"' in next(stream)
+    # The client goes away:
+    proxied.close()
+    assert_equals(upstream.closed, 1)
+    proxied.close()
+    assert_equals(upstream.closed, 1)
+    # Closed unread:
+    upstream = Upstream([PAGE])
+    proxied, resp = proxied_response()
+    proxied.app_iter = upstream
+    proxied.close()
+    assert_equals(upstream.closed, 1)
+    assert attached_body(resp) is None
+    # And after reading the whole body for theming:
+    upstream = Upstream([PAGE])
+    proxied, resp = proxied_response()
+    proxied.app_iter = upstream
+    assert not proxied.is_empty()
+    assert_equals(upstream.closed, 1)
+    assert attached_body(resp) is proxied
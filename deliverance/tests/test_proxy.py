@@ -1,12 +1,12 @@
 import datetime
 from deliverance.log import SavingLogger
-from deliverance.proxy import Proxy
+from deliverance.proxy import Proxy, ProxyIndex, ProxyResponseModification
 from deliverance.util.filetourl import filename_to_url
 from lxml.etree import fromstring
 from pkg_resources import resource_filename
 from time import mktime
 from webtest import TestApp, TestResponse, TestRequest
-from webob import Request
+from webob import Request, Response
 from wsgiref.handlers import format_date_time
 
 app = None
@@ -48,3 +48,40 @@ def test_no_cache_theme_file():
     resp = app.get("/_theme/theme.html", extra_environ=dict(HTTP_IF_MODIFIED_SINCE=recently))
     assert resp.status == "200 OK", resp.status
     
+
+def test_proxy_index():
+    proxies = [
+        Proxy.parse_xml(fromstring(xml), 'http://localhost/rules.xml')
+        for xml in [
+            '<proxy path="/blog" domain="a.example.com"><dest href="http://a/" /></proxy>',
+            '<proxy path="/blog/admin"><dest href="http://b/" /></proxy>',
+            '<proxy path="regex:/bl.g"><dest href="http://c/" /></proxy>',
+            '<proxy domain="*.example.com"><dest href="http://d/" /></proxy>',
+            '<proxy path="/"><dest href="http://e/" /></proxy>',
+            '<proxy path="/blogs"><dest href="http://f/" /></proxy>',
+            ]]
+    index = ProxyIndex(proxies)
+    def candidates(url):
+        return [proxies.index(proxy) for proxy in index.candidates(Request.blank(url))]
+    assert candidates('http://A.example.com/blog/admin/x') == [0, 1, 2, 3, 4]
+    assert candidates('http://b.example.com/blog') == [2, 3, 4]
+    assert candidates('http://other.com/blogs/1') == [2, 3, 4, 5]
+    assert candidates('http://other.com/') == [2, 3, 4]
+
+def test_rewrite_links_streams():
+    modification = ProxyResponseModification(rewrite_links=True)
+    read = []
+    def app_iter():
+        for chunk in [b'<html><body><a hr', b'ef="/blog/1">x</a>', b'</body></html>']:
+            read.append(chunk)
+            yield chunk
+    resp = Response(app_iter=app_iter(), content_type='text/html', charset=None)
+    resp.content_length = 60
+    req = Request.blank('http://localhost/blog/1')
+    resp = modification.modify_response(
+        req, resp, 'http://localhost', 'http://upstream', 'http://upstream/blog/1',
+        SavingLogger(req, None))
+    # Nothing has been read yet:
+    assert read == []
+    assert resp.content_length is None
+    assert resp.body == b'<html><body><a href="http://localhost/blog/1">x</a></body></html>', resp.body
@@ -0,0 +1,55 @@
+from deliverance.log import SavingLogger
+from deliverance.util.proxyrequest import CharsetGuesses, Request, Response
+from nose.tools import assert_equals
+
+TEXT = '<html><body>%s</body></html>' % ('R\xe9sum\xe9 na\xefve caf\xe9 d\xe9j\xe0 vu. ' * 20)
+
+def app(body):
+    def application(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        return [body]
+    return application
+
+def get(path, body, guesses):
+    req = Request.blank(path)
+    req.environ['deliverance.log'] = log = SavingLogger(None, None)
+    resp = req.get_response(app(body))
+    resp.charset_guesses = guesses
+    return resp, log
+
+def test_charset_guesses():
+    guesses = CharsetGuesses(sample_size=200)
+    body = TEXT.encode('utf8')
+    resp, log = get('/blog/1', body, guesses)
+    assert resp.request is not None
+    assert_equals(resp.unicode_body, TEXT)
+    charset = resp.charset
+    messages = [message for level, el, message in log.messages]
+    assert messages[0].startswith('Detected charset'), messages
+    assert ' from 200 of %s bytes' % len(body) in messages[0], messages
+    # Remembered for the same host and prefix:
+    resp, log = get('/blog/2', body, guesses)
+    assert_equals(resp.unicode_body, TEXT)
+    assert_equals(resp.charset, charset)
+    messages = [message for level, el, message in log.messages]
+    assert messages[0].startswith('Using the charset'), messages
+    assert_equals(guesses.stats()['hits'], 1)
+    # But not elsewhere:
+    resp, log = get('/wiki/1', body, guesses)
+    assert_equals(resp.unicode_body, TEXT)
+    assert_equals(guesses.stats()['hits'], 1)
+    # A remembered charset that doesn't work is forgotten:
+    guesses.charsets.set(('localhost:80', '/blog'), 'ascii')
+    resp, log = get('/blog/3', body, guesses)
+    assert_equals(resp.unicode_body, TEXT)
+    messages = [message for level, el, message in log.messages]
+    assert 'did not decode' in messages[0], messages
+
+def test_misleading_sample():
+    # The sample is all ASCII:
+    text = 'a' * 300 + '☃ snow'
+    resp, log = get('/', text.encode('utf8'), CharsetGuesses(sample_size=100))
+    assert_equals(resp.unicode_body, text)
+    # Responses without a request still work:
+    resp = Response(body=TEXT.encode('utf8'), content_type='text/html', charset=None)
+    assert_equals(resp.unicode_body, TEXT)
@@ -0,0 +1,54 @@
+from deliverance.util.rewritelinks import LinkRewriter, is_ascii_compatible, rewrite_links_iter
+from nose.tools import assert_equals
+
+PAGE = '''<!DOCTYPE html>
+<html><head><title>a <a href="/title"></title>
+<style>body { background: url("img/bg.png") } @import 'print.css';</style>
+<script>var s = '<a href="/script">';</script></head>
+<body><!-- <a href="/comment"> --><a href="/a?x=1&amp;y=2" class=foo>A</a>
+<img src=pic.png alt='it&#39;s'><form action="http://up/post"></form>
+<div style="background: url(&quot;/bg.gif&quot;)">café <a href="http://other/">o</a>
+<a HREF='/q?a="b"'>q</a> <a name="x">x</a> 1 < 2 <a href="/&eacute;t&eacute;"></a>
+</body></html>'''
+
+EXPECTED = '''<!DOCTYPE html>
+<html><head><title>a <a href="/title"></title>
+<style>body { background: url("http://me/dir/img/bg.png") } @import 'http://me/dir/print.css';</style>
+<script>var s = '<a href="/script">';</script></head>
+<body><!-- <a href="/comment"> --><a href="http://me/a?x=1&amp;y=2" class=foo>A</a>
+<img src="http://me/dir/pic.png" alt='it&#39;s'><form action="http://me/post"></form>
+<div style="background: url(&quot;http://me/bg.gif&quot;)">café <a href="http://other/">o</a>
+<a HREF='http://me/q?a="b"'>q</a> <a name="x">x</a> 1 < 2 <a href="http://me/&eacute;t&eacute;"></a>
+</body></html>'''
+
+def repl(link):
+    if link.startswith('http://up/'):
+        return 'http://me/' + link[len('http://up/'):]
+    return link
+
+def test_rewrite():
+    rewriter = LinkRewriter(repl, 'http://up/dir/page')
+    assert_equals(rewriter.feed(PAGE) + rewriter.close(), EXPECTED)
+
+def test_chunks():
+    body = PAGE.encode('utf8')
+    expected = EXPECTED.encode('utf8')
+    for size in (1, 2, 3, 7, 64, len(body)):
+        chunks = [body[i:i+size] for i in range(0, len(body), size)]
+        output = list(rewrite_links_iter(chunks, repl, 'http://up/dir/page'))
+        assert_equals(b''.join(output), expected)
+    # Only unfinished tags are held back:
+    rewriter = LinkRewriter(repl, 'http://up/')
+    assert_equals(rewriter.feed('<p>some text</p><a hr'), '<p>some text</p>')
+    assert_equals(rewriter.feed('ef="x">'), '<a href="http://me/x">')
+
+def test_base_and_limits():
+    rewriter = LinkRewriter(repl, 'http://up/dir/page')
+    output = rewriter.feed('<base href="/other/"><a href="x">') + rewriter.close()
+    assert_equals(output, '<base href="http://me/other/"><a href="http://me/other/x">')
+    # Tags longer than max_buffer are passed on as they are:
+    rewriter = LinkRewriter(repl, 'http://up/', max_buffer=10)
+    assert_equals(rewriter.feed('<a title="long title" href="x"'), '<a title="long title" href="x"')
+    assert is_ascii_compatible('UTF-8')
+    assert is_ascii_compatible(None)
+    assert not is_ascii_compatible('utf-16le')
@@ -0,0 +1,51 @@
+from deliverance.log import SavingLogger
+from deliverance.rules import TransformState, parse_action
+from deliverance.selector import Selector, SelectorMemo, compiled_expression_stats
+from lxml.etree import XML
+from lxml.html import document_fromstring
+from nose.tools import assert_equals
+
+CONTENT = '''\
+<html><head><title>t</title>
+<link rel="stylesheet" href="a.css"><link rel="stylesheet" href="b.css">
+</head><body><div id="content">c</div></body></html>'''
+
+def test_memo():
+    doc = document_fromstring(CONTENT)
+    memo = SelectorMemo(doc)
+    # Different selector objects with the same expression share results:
+    sel_type, els1, attributes = Selector.parse('/html/head/link')(doc, memo=memo)
+    sel_type, els2, attributes = Selector.parse('/html/head/link')(doc, memo=memo)
+    assert_equals(len(els1), 2)
+    assert_equals(els1, els2)
+    assert els1 is not els2
+    assert_equals((memo.hits, memo.misses), (1, 1))
+    # But not with the same expression of another type:
+    Selector.parse('children:/html/head/link')(doc, memo=memo)
+    assert_equals(memo.misses, 2)
+    # The memo is ignored for other documents:
+    other = document_fromstring(CONTENT)
+    sel_type, els, attributes = Selector.parse('/html/head/link')(other, memo=memo)
+    assert els[0].getroottree().getroot() is other
+    assert_equals((memo.hits, memo.misses), (1, 2))
+
+def test_memo_cleared_by_drop():
+    content = document_fromstring(CONTENT)
+    theme = document_fromstring('<html><head></head><body></body></html>')
+    state = TransformState(content_memo=SelectorMemo(content))
+    drop = parse_action(XML('<drop content="/html/head/link" />'), None)
+    log = SavingLogger(None, None)
+    assert_equals(len(Selector.parse('/html/head/link')(
+        content, memo=state.content_memo)[1]), 2)
+    drop.apply(content, theme, None, log, state=state)
+    assert_equals(Selector.parse('/html/head/link')(
+        content, memo=state.content_memo)[1], [])
+
+def test_compiled_expressions_shared():
+    stats = compiled_expression_stats()
+    sel1 = Selector.parse('children:#content-shared')
+    sel2 = Selector.parse('elements:#content-shared || /html/body/div[@id="shared"]')
+    assert sel1.selectors[0][1] is sel2.selectors[0][1]
+    new_stats = compiled_expression_stats()
+    assert_equals(new_stats['hits'] - stats['hits'], 1)
+    assert_equals(new_stats['misses'] - stats['misses'], 2)
@@ -35,18 +35,21 @@ class Unescaper(Escaper):
             string = string.replace(char[1], char[0])
         return string
 
+_cdata_re = re.compile(r'<!\[CDATA\[(.*?)\]\]>', re.DOTALL)
+_escaped_cdata_re = re.compile(r'__START_CDATA__(.*?)__END_CDATA__', re.DOTALL)
+
 def escape_cdata(s):
-    cdata_re = re.compile(r'<!\[CDATA\[(.*?)\]\]>', re.DOTALL)
-    inners = cdata_re.findall(s)
+    # (deliverance.util.prescan does this, and the other fixes made
+    # before parsing, in one scan of the document)
+    inners = _cdata_re.findall(s)
     if not inners:
         return s
     repl = Escaper(inners)
-    return cdata_re.sub(repl, s)
+    return _cdata_re.sub(repl, s)
 
 def unescape_cdata(s):
-    cdata_re = re.compile(r'__START_CDATA__(.*?)__END_CDATA__', re.DOTALL)
-    inners = cdata_re.findall(s)
+    inners = _escaped_cdata_re.findall(s)
     if not inners:
         return s
     repl = Unescaper(inners)
-    return cdata_re.sub(repl, s)
+    return _escaped_cdata_re.sub(repl, s)
@@ -19,7 +19,7 @@ def fix_meta_charset_position(s):
 
     return s
 
-def force_charset(resp, default="utf8"):
+def force_charset(resp, default="utf8", scan=None):
     """
     Sets the charset of the response, to guarantee that
     ``resp.unicode_body`` won't raise AttributeError:
@@ -30,9 +30,16 @@ def force_charset(resp, default="utf8"):
         response body, use it.
 
      3. Otherwise use ``default``.
+
+    `scan` is a ``deliverance.util.prescan.Prescan`` of the response
+    body, if the caller already has one (it is used instead of
+    searching the body again).
     """
     if resp.charset:
         return resp
+    if scan is not None:
+        resp.charset = scan.charset or default
+        return resp
     match = META_CHARSET_TAG.search(resp.body)
     if match is None:
         resp.charset = default
@@ -0,0 +1,228 @@
+"""
+Watches files (like a rule file and the files it includes) from a
+background thread, so that changes are noticed without looking at the
+files on every request.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+import threading
+import time
+from lxml.etree import parse, XMLSyntaxError
+from deliverance.util.filetourl import url_to_filename
+
+__all__ = ['FileWatcher', 'source_files']
+
+# From <sys/inotify.h>:
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+_event_header = struct.Struct('iIII')
+
+_scheme_re = re.compile(r'^[a-z][a-z0-9+.-]*:', re.I)
+
+def _load_inotify():
+    """Returns libc if it has inotify (i.e., on Linux), else None"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError, TypeError):
+        return None
+    return libc
+
+_libc = _load_inotify()
+
+def source_files(filename):
+    """
+    The filenames of the file and of all the files it includes
+    (recursively) with ``<xi:include>``.
+    """
+    filenames = []
+    def add(filename):
+        filename = os.path.abspath(filename)
+        if filename in filenames:
+            return
+        filenames.append(filename)
+        try:
+            tree = parse(filename)
+        except (IOError, XMLSyntaxError):
+            return
+        for include in tree.iter('{http://www.w3.org/2001/XInclude}include'):
+            href = include.get('href')
+            if not href:
+                continue
+            if href.startswith('file:'):
+                included = url_to_filename(href)
+            elif _scheme_re.match(href):
+                # Not a file
+                continue
+            else:
+                included = os.path.join(os.path.dirname(filename), href)
+            if include.get('parse') == 'text':
+                filenames.append(os.path.abspath(included))
+            else:
+                add(included)
+    add(filename)
+    return filenames
+
+class FileWatcher(object):
+    """
+    Calls `callback` (with no arguments, from a background thread)
+    when any of the files in `filenames` is changed, created or
+    deleted.
+
+    On Linux inotify is used to watch the directories of the files;
+    elsewhere (or with ``use_inotify=False``) the modification times
+    are checked every `interval` seconds.  Changes that come close
+    together (an editor saving a file in several steps) are collected
+    for `delay` seconds, and reported with one call.
+
+    Call `start` to begin watching, and `stop` to end it.
+    """
+
+    def __init__(self, filenames, callback, interval=1, delay=0.1,
+                 use_inotify=True):
+        self.callback = callback
+        self.interval = interval
+        self.delay = delay
+        self.use_inotify = use_inotify and _libc is not None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+        self.watch(filenames)
+
+    def watch(self, filenames):
+        """Changes the files that are watched"""
+        filenames = [os.path.abspath(filename) for filename in filenames]
+        with self.lock:
+            self.filenames = filenames
+            self.mtimes = self.get_mtimes(filenames)
+            self.rewatch = True
+
+    @staticmethod
+    def get_mtimes(filenames):
+        """A dictionary of filename to mtime (None if missing)"""
+        mtimes = {}
+        for filename in filenames:
+            try:
+                mtimes[filename] = os.stat(filename).st_mtime
+            except OSError:
+                mtimes[filename] = None
+        return mtimes
+
+    def start(self):
+        """Starts the background thread"""
+        if self.use_inotify:
+            target = self.run_inotify
+        else:
+            target = self.run_poll
+        self.stopped.clear()
+        self.thread = threading.Thread(target=target,
+                                       name='FileWatcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops the background thread (after at most a second)"""
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def check(self):
+        """
+        Polls the files once, returning True (after calling the
+        callback) if any has changed
+        """
+        with self.lock:
+            filenames = self.filenames
+            old = self.mtimes
+        mtimes = self.get_mtimes(filenames)
+        if mtimes == old:
+            return False
+        with self.lock:
+            if self.filenames is filenames:
+                self.mtimes = mtimes
+        self.callback()
+        return True
+
+    def run_poll(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def run_inotify(self):
+        fd = _libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            # E.g., too many instances; fall back to polling:
+            self.run_poll()
+            return
+        try:
+            watched = {}
+            while not self.stopped.is_set():
+                with self.lock:
+                    if self.rewatch:
+                        self.rewatch = False
+                        watched = self.add_watches(fd)
+                ready, _, _ = select.select([fd], [], [], 1)
+                if not ready:
+                    continue
+                changed = self.read_events(fd, watched)
+                # Collect the rest of a burst of events:
+                deadline = time.time() + self.delay
+                while True:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    ready, _, _ = select.select([fd], [], [], timeout)
+                    if ready:
+                        changed = self.read_events(fd, watched) or changed
+                if changed and not self.stopped.is_set():
+                    with self.lock:
+                        self.mtimes = self.get_mtimes(self.filenames)
+                    self.callback()
+        finally:
+            os.close(fd)
+
+    def add_watches(self, fd):
+        """
+        Watches the directories of the files, returning a dictionary
+        of watch descriptor to ``(directory, names)``
+        """
+        directories = {}
+        for filename in self.filenames:
+            dirname, name = os.path.split(filename)
+            directories.setdefault(dirname, set()).add(name.encode('utf8'))
+        mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO
+                | IN_CREATE | IN_DELETE)
+        watched = {}
+        for dirname, names in directories.items():
+            wd = _libc.inotify_add_watch(fd, dirname.encode('utf8'), mask)
+            if wd >= 0:
+                watched[wd] = (dirname, names)
+        return watched
+
+    def read_events(self, fd, watched):
+        """
+        Reads the pending events, returning True if one was for a
+        watched file
+        """
+        data = os.read(fd, 65536)
+        changed = False
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, pos)
+            pos += _event_header.size
+            name = data[pos:pos+length].rstrip(b'\0')
+            pos += length
+            if wd in watched and name in watched[wd][1]:
+                changed = True
+        return changed
@@ -0,0 +1,251 @@
+"""
+A pool of persistent (keep-alive) HTTP/1.1 connections, used in
+place of :func:`wsgiproxy.exactproxy.proxy_exact_request` for
+proxying and external subrequests.
+"""
+
+import http.client
+import socket
+import threading
+import time
+from urllib.parse import quote as url_quote
+from webob import exc
+
+__all__ = ['ConnectionPool']
+
+# Hop-by-hop headers, which apply to one connection and are not
+# passed on (lower case):
+hop_by_hop_headers = (
+    'connection', 'keep-alive', 'proxy-connection', 'te', 'trailer',
+    'transfer-encoding', 'upgrade',
+)
+
+class ConnectionPool(object):
+    """
+    A WSGI application that makes the exact request given in the
+    environment (like ``proxy_exact_request``: it connects to
+    ``SERVER_NAME:SERVER_PORT`` and sends the ``Host`` header from
+    ``HTTP_HOST``), reusing connections to the same server.
+
+    At most `max_per_host` requests to one server wait for a response
+    at a time (further requests wait for one of those places, for up
+    to `wait_timeout` seconds, and then get a ``503 Service
+    Unavailable``); None means no limit.  A request gives its place
+    up once the response headers have arrived, so a long download
+    doesn't keep other requests waiting.  At most `max_per_host` idle
+    connections are kept for each server, and they are closed after
+    `idle_timeout` seconds.  `timeout` is the socket timeout of the
+    connections (None for the default).  With `keep_alive` false
+    connections aren't reused at all.
+
+    A request that fails because the server closed a reused
+    connection is retried once on a new connection, if its method is
+    idempotent.
+
+    Response bodies up to `stream_threshold` bytes (by their
+    ``Content-Length``) are read at once; longer bodies, and those of
+    unknown length, are streamed in chunks of `chunk_size` bytes as
+    the application iterator is consumed.  The connection is held
+    until the iterator is closed.
+    """
+
+    idempotent_methods = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE')
+
+    def __init__(self, max_per_host=10, idle_timeout=30, timeout=None,
+                 wait_timeout=30, stream_threshold=65536, chunk_size=65536,
+                 keep_alive=True):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.wait_timeout = wait_timeout
+        self.stream_threshold = stream_threshold
+        self.chunk_size = chunk_size
+        self.keep_alive = keep_alive
+        self.lock = threading.Lock()
+        # (scheme, host, port) -> list of (connection, last_used):
+        self.idle = {}
+        self.limits = {}
+        self.created = 0
+        self.reused = 0
+
+    def __call__(self, environ, start_response):
+        scheme = environ['wsgi.url_scheme']
+        if scheme not in ('http', 'https'):
+            raise ValueError(
+                "Unknown scheme: %r" % scheme)
+        key = (scheme, environ['SERVER_NAME'], int(environ['SERVER_PORT']))
+        method = environ['REQUEST_METHOD']
+        headers = {}
+        for name, value in environ.items():
+            if name.startswith('HTTP_'):
+                name = name[5:].replace('_', '-').title()
+                if name.lower() not in hop_by_hop_headers:
+                    headers[name] = value
+        path = (url_quote(environ.get('SCRIPT_NAME', ''), encoding='latin1')
+                + url_quote(environ.get('PATH_INFO', ''), encoding='latin1'))
+        if not path.startswith('/'):
+            path = '/' + path
+        if environ.get('QUERY_STRING'):
+            path += '?' + environ['QUERY_STRING']
+        try:
+            content_length = int(environ.get('CONTENT_LENGTH', '0'))
+        except ValueError:
+            content_length = 0
+        if content_length:
+            body = environ['wsgi.input'].read(content_length)
+        else:
+            body = b''
+        headers['Content-Length'] = str(content_length)
+        if environ.get('CONTENT_TYPE'):
+            headers['Content-Type'] = environ['CONTENT_TYPE']
+        if not self.keep_alive:
+            headers['Connection'] = 'close'
+        limit = self.host_limit(key)
+        if limit is not None and not limit.acquire(timeout=self.wait_timeout):
+            resp = exc.HTTPServiceUnavailable(
+                "Too many requests to %s:%s already in progress"
+                % (environ['SERVER_NAME'], environ['SERVER_PORT']))
+            return resp(environ, start_response)
+        try:
+            conn, res = self.request(key, method, path, body, headers)
+        except socket.gaierror as e:
+            if e.args[0] != socket.EAI_NONAME:
+                raise
+            resp = exc.HTTPBadGateway(
+                "Name or service not known (bad domain name: %s)"
+                % environ['SERVER_NAME'])
+            return resp(environ, start_response)
+        finally:
+            # The body is read without holding the place:
+            if limit is not None:
+                limit.release()
+        app_iter = PooledResponseIter(self, key, conn, res)
+        if res.length is not None and res.length <= self.stream_threshold:
+            try:
+                body = b''.join(app_iter)
+            finally:
+                app_iter.close()
+            app_iter = [body]
+        status = '%s %s' % (res.status, res.reason)
+        headers_out = [(name, value) for name, value in res.msg.items()
+                       if name.lower() not in hop_by_hop_headers]
+        start_response(status, headers_out)
+        return app_iter
+
+    def request(self, key, method, path, body, headers):
+        """
+        Makes one request, returning ``(connection, response)`` once
+        the response headers have been read.
+        """
+        while True:
+            conn, reused = self.get_connection(key)
+            try:
+                conn.request(method, path, body, headers)
+                return conn, conn.getresponse()
+            except (ConnectionError, http.client.BadStatusLine):
+                conn.close()
+                if reused and method in self.idempotent_methods:
+                    # The server closed the idle connection; try a new one
+                    # (get_connection doesn't return the same one again):
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+
+    def host_limit(self, key):
+        """
+        The semaphore limiting the requests to one server (None if
+        there is no `max_per_host`)
+        """
+        if self.max_per_host is None:
+            return None
+        with self.lock:
+            limit = self.limits.get(key)
+            if limit is None:
+                limit = self.limits[key] = threading.BoundedSemaphore(self.max_per_host)
+            return limit
+
+    def get_connection(self, key):
+        """
+        Returns ``(connection, reused)``: an idle connection to the
+        server, or a new one.
+        """
+        now = time.time()
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while idle and self.keep_alive:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    self.reused += 1
+                    return conn, True
+                conn.close()
+            self.created += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            conn_class = http.client.HTTPSConnection
+        else:
+            conn_class = http.client.HTTPConnection
+        return conn_class(host, port, timeout=self.timeout), False
+
+    def release(self, key, conn):
+        """Returns a connection (with its response fully read) to the pool"""
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if self.keep_alive and (self.max_per_host is None
+                                    or len(idle) < self.max_per_host):
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def clear(self):
+        """Closes all the idle connections"""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn, last_used in conns:
+                conn.close()
+
+    def stats(self):
+        """
+        Returns a dictionary of the number of connections ``created``,
+        the number of times one was ``reused``, and the number
+        currently ``idle``
+        """
+        with self.lock:
+            idle = sum(len(conns) for conns in self.idle.values())
+        return dict(created=self.created, reused=self.reused, idle=idle)
+
+class PooledResponseIter(object):
+    """
+    The application iterator for a response from a `ConnectionPool`:
+    reads the body in chunks, and gives the connection back to the
+    pool when closed.
+    """
+
+    def __init__(self, pool, key, conn, res):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.res = res
+
+    def __iter__(self):
+        while True:
+            chunk = self.res.read(self.pool.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        if self.res.isclosed() and not self.res.will_close:
+            self.pool.release(self.key, conn)
+        else:
+            # Not read to the end, so the connection can't be reused:
+            conn.close()
+
+    def __del__(self):
+        # In case the response is dropped without being closed:
+        self.close()
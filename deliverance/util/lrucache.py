@@ -0,0 +1,85 @@
+"""A small thread-safe LRU cache with hit/miss counters"""
+
+import threading
+from collections import OrderedDict
+
+__all__ = ['LRUCache']
+
+_marker = object()
+
+class LRUCache(object):
+    """
+    A dictionary-like cache that holds at most `max_size` items,
+    discarding the least recently used item when it is full.
+
+    All operations take a lock, so one instance can be shared between
+    the threads of a server.  A `max_size` of 0 disables the cache
+    (nothing is ever stored).
+    """
+
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Return the cached value (marking it as recently used), or `default`"""
+        with self._lock:
+            value = self._data.get(key, _marker)
+            if value is _marker:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """Return the cached value without touching the counters or the order"""
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used item if necessary"""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove and return the value for `key`"""
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        """Remove all the items (the counters are kept)"""
+        with self._lock:
+            self._data.clear()
+
+    def values(self):
+        """A snapshot of the cached values, least recently used first"""
+        with self._lock:
+            return list(self._data.values())
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self):
+        """Returns a dictionary of ``size``, ``max_size``, ``hits`` and ``misses``"""
+        with self._lock:
+            return dict(size=len(self._data), max_size=self.max_size,
+                        hits=self.hits, misses=self.misses)
+
+    def __repr__(self):
+        return '<%s size=%s/%s hits=%s misses=%s>' % (
+            self.__class__.__name__, len(self), self.max_size,
+            self.hits, self.misses)
@@ -0,0 +1,151 @@
+"""
+Tells whether an HTML document built up by the rules would come out
+of lxml's HTML parser with the same structure, if it were serialized
+and parsed again.
+
+The parser repairs some nestings (a ``<div>`` opened inside a ``<p>``
+closes the paragraph, for instance).  Rather than keep a copy of the
+parser's rules, each pair of parent and child tags is tried on the
+parser once, and the answer remembered.
+"""
+
+import threading
+from lxml.etree import Comment
+from lxml.html import document_fromstring, tostring, defs
+
+__all__ = ['round_trips']
+
+_known_tags = frozenset(defs.tags)
+# All unknown tags are treated alike by the parser:
+_unknown_tag = 'x-unknown'
+# And comments (and processing instructions) as a tag of their own:
+_comment = '!--'
+# Where an element in the <head> is the only thing that is tried:
+_head_tags = ('base', 'link', 'meta', 'script', 'style', 'title')
+
+_results = {}
+_lock = threading.Lock()
+
+def _tag(el):
+    if not isinstance(el.tag, str):
+        return _comment
+    tag = el.tag.lower()
+    if tag in _known_tags:
+        return tag
+    return _unknown_tag
+
+def _make(parent, tag):
+    if tag == _comment:
+        return Comment('b')
+    return parent.makeelement(tag, {})
+
+def _probe(parent, child, empty=False, after=None):
+    """
+    True if `child` (a tag, `_comment`, or None for just text) inside `parent`
+    (a tag in the ``<body>``, or ``'body'``/``'head'``) survives a
+    round trip through the parser.  An `empty` child has no content,
+    only text after it, or the element `after` (the serializer leaves
+    out end tags that are optional, so what follows may end up inside
+    it).
+    """
+    doc = document_fromstring('<html><head></head><body></body></html>')
+    if parent in ('body', 'head'):
+        container = doc.find(parent)
+    else:
+        container = doc.body.makeelement(parent, {})
+        container.text = 'a'
+        doc.body.append(container)
+    if child is not None:
+        el = _make(container, child)
+        if not empty and child != _comment:
+            el.text = 'b'
+        if after is None and parent != 'head':
+            el.tail = 'c'
+        container.append(el)
+        if after is not None:
+            container.append(_make(container, after))
+    html = tostring(doc)
+    parsed = document_fromstring(html)
+    # (Markup in a <style> or <script> serializes the same, but is
+    # parsed as text:)
+    return (tostring(parsed) == html
+            and len(list(parsed.iter())) == len(list(doc.iter())))
+
+def _survives(parent, child, empty=False, after=None):
+    key = (parent, child, empty, after)
+    result = _results.get(key)
+    if result is None:
+        result = _probe(parent, child, empty, after)
+        with _lock:
+            _results[key] = result
+    return result
+
+def _has_text(text):
+    return bool(text and text.strip())
+
+def round_trips(doc):
+    """
+    True if serializing the document `doc` (an ``<html>`` element)
+    gives exactly what parsing that and serializing it again would
+    give; False if the parser might change the tree.
+
+    Empty text nodes (``el.text = ''``), which the parser never
+    makes and which keep the serializer from leaving out optional end
+    tags, are removed from a document that round trips, so that it
+    serializes as the parsed document would.
+    """
+    if not _check(doc):
+        return False
+    for el in doc.iter():
+        if el.text == '':
+            el.text = None
+        if el.tail == '':
+            el.tail = None
+    return True
+
+def _check(doc):
+    children = [el for el in doc if isinstance(el.tag, str)]
+    if [el.tag for el in children] not in (['head', 'body'], ['body'], ['head']):
+        return False
+    if _has_text(doc.text) or any(_has_text(el.tail) for el in doc):
+        return False
+    for section in children:
+        if section.tag == 'head':
+            if _has_text(section.text):
+                return False
+            for el in section:
+                if not isinstance(el.tag, str):
+                    continue
+                tag = _tag(el)
+                if (tag not in _head_tags or _has_text(el.tail)
+                    or len(el) or not _survives('head', tag)):
+                    return False
+            continue
+        for el in section.iter():
+            if el is section:
+                continue
+            if el.tag in ('html', 'head', 'body'):
+                return False
+            parent = el.getparent()
+            if parent is section:
+                parent_tag = 'body'
+            else:
+                parent_tag = _tag(parent)
+            tag = _tag(el)
+            if not _survives(parent_tag, tag):
+                return False
+            if tag == _comment:
+                continue
+            if len(el) == 0:
+                if not _survives(tag, None):
+                    return False
+                if not el.text:
+                    following = el.getnext()
+                    if el.tail:
+                        if not _survives(parent_tag, tag, empty=True):
+                            return False
+                    elif (following is not None
+                          and not _survives(parent_tag, tag, empty=True,
+                                            after=_tag(following))):
+                        return False
+    return True
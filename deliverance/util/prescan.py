@@ -0,0 +1,176 @@
+"""
+Scans an HTML document once, before it is parsed, for the things
+Deliverance looks at or fixes up in the raw markup: ``<meta
+http-equiv>`` headers, the charset declaration, the ``<title>`` and
+``<![CDATA[...]]>`` sections (see ``deliverance.util.cdata`` and
+``deliverance.util.charset``).
+"""
+
+import re
+from deliverance.util.cdata import SPECIAL_CHARACTERS
+from deliverance.util.charset import META_CHARSET_TAG
+
+__all__ = ['Prescan', 'prescan', 'prepare_document']
+
+# Everything but CDATA sections is only looked for in the <head>, so
+# the single pattern starts with the literal "<" (which the regex
+# engine searches for quickly) and the scan stops at </head>:
+_token_pattern = r'''<(?:
+    (?-i:!\[CDATA\[)(?P<cdata>.*?)(?-i:\]\]>)
+  | (?P<meta>meta\b[^>]*)>
+  | title>(?P<title>.*?)</title>
+  | (?P<head>head)(?:\s[^>]*)?>
+  | (?P<end_head>/head)\s*>
+)'''
+_cdata_pattern = r'<!\[CDATA\[(.*?)\]\]>'
+_http_equiv_pattern = r'http-equiv=(?:"([^"]*)"|([^\s>]*))'
+_content_pattern = r'content=(?:"([^"]*)"|([^\s>]*))'
+
+def _compile(pattern, flags):
+    """The pattern compiled for text and for bytes"""
+    return (re.compile(pattern, flags),
+            re.compile(pattern.encode('ascii'), flags))
+
+_token_re = _compile(_token_pattern, re.I | re.S | re.X)
+_cdata_re = _compile(_cdata_pattern, re.S)
+_http_equiv_re = _compile(_http_equiv_pattern, re.I | re.S)
+_content_re = _compile(_content_pattern, re.I | re.S)
+_charset_re = (META_CHARSET_TAG,
+               re.compile(META_CHARSET_TAG.pattern.encode('ascii'),
+                          META_CHARSET_TAG.flags & ~re.U))
+
+def _text(value):
+    """Header values found in a bytes document, as text"""
+    if isinstance(value, bytes):
+        return value.decode('latin1')
+    return value
+
+class Prescan(object):
+    """
+    What was found in one scan of `body` (text or bytes).  The
+    ``<head>`` is scanned for everything; the rest of the document
+    only for CDATA sections.
+
+    ``meta_headers``
+        ``[(header_name, header_value)]`` from the ``<meta
+        http-equiv="..." content="...">`` tags.
+    ``charset``
+        The charset of the first ``<meta>`` tag that declares one
+        (see ``deliverance.util.charset.META_CHARSET_TAG``), or None.
+    ``title``
+        The text of the ``<title>`` element, or None.
+    ``charset_tags``
+        The ``(start, end)`` positions of the ``<meta>`` tags that
+        declare a charset.
+    ``cdata``
+        The ``(start, end)`` positions of the CDATA sections.
+    ``head_tag``
+        The position of the end of the ``<head>`` tag, or None.
+    """
+
+    def __init__(self, body):
+        self.body = body
+        is_bytes = isinstance(body, bytes)
+        self.meta_headers = []
+        self.charset = None
+        self.title = None
+        self.charset_tags = []
+        self.cdata = []
+        self.head_tag = None
+        pos = len(body)
+        for match in _token_re[is_bytes].finditer(body):
+            if match.group('cdata') is not None:
+                self.cdata.append(match.span())
+            elif match.group('meta') is not None:
+                self.add_meta(match, is_bytes)
+            elif match.group('title') is not None:
+                if self.title is None:
+                    self.title = _text(match.group('title'))
+            elif match.group('head') is not None:
+                if self.head_tag is None:
+                    self.head_tag = match.end()
+            else:
+                pos = match.end()
+                break
+        if pos < len(body):
+            start = b'<![CDATA[' if is_bytes else '<![CDATA['
+            if body.find(start, pos) != -1:
+                for match in _cdata_re[is_bytes].finditer(body, pos):
+                    self.cdata.append(match.span())
+
+    def add_meta(self, match, is_bytes):
+        """Notes the headers and charset of a ``<meta>`` tag"""
+        tag = match.group()
+        charset_match = _charset_re[is_bytes].match(tag)
+        if charset_match is not None:
+            self.charset_tags.append(match.span())
+            if self.charset is None:
+                self.charset = _text(charset_match.group('charset'))
+        attrs = match.group('meta')
+        http_equiv_match = _http_equiv_re[is_bytes].search(attrs)
+        content_match = _content_re[is_bytes].search(attrs)
+        if not http_equiv_match or not content_match:
+            ## FIXME: log partial matches?
+            return
+        http_equiv = (http_equiv_match.group(1) or http_equiv_match.group(2) or '')
+        http_equiv = _text(http_equiv.strip())
+        content = _text(content_match.group(1) or content_match.group(2) or '')
+        if not http_equiv or not content:
+            ## FIXME: is empty content really meaningless?
+            return
+        self.meta_headers.append((http_equiv, content))
+
+    def prepare(self, escape_cdata=True, fix_meta_charset_position=True):
+        """
+        Returns the body ready to be parsed, with the CDATA sections
+        escaped (like ``deliverance.util.cdata.escape_cdata``) and the
+        first charset ``<meta>`` tag moved to the start of the
+        ``<head>`` (like
+        ``deliverance.util.charset.fix_meta_charset_position``), all
+        in one copy of the body.
+        """
+        body = self.body
+        is_bytes = isinstance(body, bytes)
+        # (start, end, replacement) edits, in the order of the body:
+        edits = []
+        if escape_cdata:
+            for start, end in self.cdata:
+                inner = body[start+len('<![CDATA['):end-len(']]>')]
+                for char, replacement in SPECIAL_CHARACTERS:
+                    if is_bytes:
+                        char, replacement = char.encode('ascii'), replacement.encode('ascii')
+                    inner = inner.replace(char, replacement)
+                if is_bytes:
+                    inner = b'__START_CDATA__' + inner + b'__END_CDATA__'
+                else:
+                    inner = '__START_CDATA__' + inner + '__END_CDATA__'
+                edits.append((start, end, inner))
+        if (fix_meta_charset_position and self.charset_tags
+            and self.head_tag is not None):
+            start, end = self.charset_tags[0]
+            edits.append((self.head_tag, self.head_tag, body[start:end]))
+            for start, end in self.charset_tags:
+                edits.append((start, end, body[:0]))
+        if not edits:
+            return body
+        edits.sort(key=lambda edit: edit[:2])
+        pieces = []
+        pos = 0
+        for start, end, replacement in edits:
+            pieces.append(body[pos:start])
+            pieces.append(replacement)
+            pos = end
+        pieces.append(body[pos:])
+        return body[:0].join(pieces)
+
+def prescan(body):
+    """Scans `body`, returning a `Prescan`"""
+    return Prescan(body)
+
+def prepare_document(body, escape_cdata=True, fix_meta_charset_position=True):
+    """
+    Scans and fixes up `body` before parsing (see `Prescan.prepare`)
+    """
+    if not escape_cdata and not fix_meta_charset_position:
+        return body
+    return Prescan(body).prepare(escape_cdata, fix_meta_charset_position)
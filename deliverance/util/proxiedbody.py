@@ -0,0 +1,148 @@
+"""
+The body of a proxied HTML page whose links are rewritten (``<response
+rewrite-links="1">``), handed from the proxy to the theming
+middleware so that the page can be parsed once, with the links
+rewritten in the parsed document.
+
+`Proxy.forward_request` puts the `ProxiedBody` in
+``environ['deliverance.proxied_body']`` as well as using it as the
+app_iter of the response.  The middleware only uses the document
+(see `attached_body`) if the response it gets still has that same
+app_iter, and nothing has read the body yet; any middleware between
+the two that looks at or replaces the body gets the rewritten bytes
+as usual, and the page is then parsed from those.
+"""
+
+from lxml.html import document_fromstring, tostring
+from deliverance.util.prescan import Prescan, prepare_document
+from deliverance.util.rewritelinks import is_ascii_compatible, rewrite_links_iter
+
+__all__ = ['ProxiedBody', 'attached_body', 'ENVIRON_KEY']
+
+ENVIRON_KEY = 'deliverance.proxied_body'
+
+class ProxiedBody(object):
+    """
+    The body of a proxied HTML response (the iterable `app_iter`),
+    with its links to be made absolute with `base_url` and passed to
+    `link_repl_func`.
+
+    Iterated (as an app_iter) the body streams through
+    `deliverance.util.rewritelinks.rewrite_links_iter`; only bodies in
+    charsets that it can't handle (UTF-16...) are parsed and
+    serialized.  `document` instead parses the body, rewriting the
+    links in the document.
+
+    ``dirty`` is true once the rewritten bytes have been handed out
+    (they may have been changed since), and the document should no
+    longer be used; see `attached_body`.
+    """
+
+    def __init__(self, app_iter, link_repl_func, base_url, charset=None):
+        self.app_iter = app_iter
+        self.link_repl_func = link_repl_func
+        self.base_url = base_url
+        self.charset = charset
+        # The upstream body, once read:
+        self.raw = None
+        # The rewritten body, once made:
+        self.body = None
+        self.dirty = False
+        # The rewrite_links_iter generator, while streaming:
+        self.stream = None
+        self.closed = False
+
+    def read_raw(self):
+        """Reads and returns the (not rewritten) upstream body"""
+        if self.raw is None:
+            assert not self.dirty, 'The body has already been streamed'
+            try:
+                self.raw = b''.join(self.app_iter)
+            finally:
+                self.close()
+        return self.raw
+
+    def __iter__(self):
+        if self.body is not None:
+            return iter([self.body])
+        if self.raw is None and not self.dirty and is_ascii_compatible(self.charset):
+            self.dirty = True
+            # (Without the app_iter's close, which is left to close():)
+            chunks = (chunk for chunk in self.app_iter)
+            self.stream = rewrite_links_iter(chunks, self.link_repl_func,
+                                             base_url=self.base_url)
+            return self.stream
+        return iter([self.get_body()])
+
+    def get_body(self):
+        """Returns the body with its links rewritten"""
+        if self.body is None:
+            raw = self.read_raw()
+            self.dirty = True
+            if is_ascii_compatible(self.charset):
+                self.body = b''.join(rewrite_links_iter(
+                    [raw], self.link_repl_func, base_url=self.base_url))
+            elif raw:
+                doc = document_fromstring(raw.decode(self.charset),
+                                          base_url=self.base_url)
+                doc.make_links_absolute()
+                doc.rewrite_links(self.link_repl_func)
+                self.body = tostring(doc, encoding=self.charset)
+            else:
+                self.body = raw
+        return self.body
+
+    def close(self):
+        """
+        Closes the upstream app_iter (and the stream over it), however
+        much of it has been read
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.stream is not None:
+            self.stream.close()
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+    def prescan(self):
+        """A `Prescan` of the upstream body (for its ``<meta>`` headers)"""
+        return Prescan(self.read_raw())
+
+    def is_empty(self):
+        """True if the body is empty"""
+        return not self.read_raw()
+
+    def document(self, url, charset):
+        """
+        Parses the body (decoded with `charset`) for theming, as
+        :meth:`deliverance.ruleset.RuleSet.apply_rules` would with
+        `url` as the base URL, and rewrites its links.  The document
+        belongs to the caller: if the body is still needed afterwards
+        (say the theming is aborted) it is made from the upstream body
+        as usual.
+        """
+        text = prepare_document(self.read_raw().decode(charset))
+        doc = document_fromstring(text, base_url=url)
+        doc.make_links_absolute(self.base_url)
+        doc.rewrite_links(self.link_repl_func)
+        return doc
+
+def attached_body(response):
+    """
+    The `ProxiedBody` of the response, if the proxy gave it one and
+    its body hasn't been read or replaced since; else None.
+    """
+    if response.request is not None:
+        environ = response.request.environ
+    else:
+        environ = response.environ
+    if not environ:
+        return None
+    body = environ.get(ENVIRON_KEY)
+    if body is None or body.dirty or response.app_iter is not body:
+        return None
+    if body.closed and body.raw is None:
+        # Closed before anything read it:
+        return None
+    return body
@@ -1,18 +1,135 @@
+import time
 import webob
 import chardet
+from deliverance.util.lrucache import LRUCache
+
+class CharsetGuesses(object):
+    """
+    Guesses the charset of response bodies that don't declare one.
+
+    Only the first `sample_size` bytes of a body are given to
+    ``chardet``, and the charset found is remembered for the upstream
+    host and path prefix (the first `prefix_segments` segments of the
+    path), so that other pages from the same place are decoded
+    without running detection again.  Guesses with less than
+    `min_confidence` aren't remembered, and a remembered charset that
+    can't decode a body is forgotten.
+
+    A `max_size` of 0 disables the memo (but detection still only
+    looks at the sample).
+    """
+
+    def __init__(self, max_size=200, sample_size=16384, prefix_segments=1,
+                 min_confidence=0.5):
+        self.charsets = LRUCache(max_size)
+        self.sample_size = sample_size
+        self.prefix_segments = prefix_segments
+        self.min_confidence = min_confidence
+
+    def log_description(self, log=None):
+        """The description shown in the log"""
+        return 'charset detection'
+
+    def key(self, request):
+        """The key for the host and path prefix of `request`, or None"""
+        if request is None:
+            return None
+        segments = [segment for segment in request.path_info.split('/') if segment]
+        prefix = '/' + '/'.join(segments[:self.prefix_segments])
+        return (request.host, prefix)
+
+    def detect(self, body, log=None):
+        """
+        Runs ``chardet`` on the start of `body`, returning ``(charset,
+        confidence)``
+        """
+        sample = body[:self.sample_size]
+        start = time.time()
+        guess = chardet.detect(sample)
+        if log is not None:
+            log.debug(self, 'Detected charset %s (confidence %s) from %s of %s bytes in %.1fms',
+                      guess['encoding'], guess['confidence'], len(sample), len(body),
+                      (time.time() - start) * 1000)
+        charset = guess['encoding']
+        if charset and charset.lower() == 'ascii':
+            # The rest of the body may not be ASCII; UTF-8 is a superset:
+            charset = 'utf-8'
+        return charset, guess['confidence'] or 0
+
+    def decode(self, request, body, errors='strict', log=None):
+        """
+        Decodes `body` (the body of a response to `request`) with the
+        remembered charset, or a detected one.  Returns ``(charset,
+        text)``.
+        """
+        key = self.key(request)
+        if key is not None:
+            charset = self.charsets.get(key)
+            if charset is not None:
+                try:
+                    text = body.decode(charset)
+                except (UnicodeDecodeError, LookupError):
+                    self.charsets.pop(key)
+                    if log is not None:
+                        log.debug(self, 'The charset %s remembered for %s%s did not decode the body',
+                                  charset, key[0], key[1])
+                else:
+                    if log is not None:
+                        log.debug(self, 'Using the charset %s remembered for %s%s',
+                                  charset, key[0], key[1])
+                    return charset, text
+        charset, confidence = self.detect(body, log)
+        if charset:
+            try:
+                text = body.decode(charset)
+            except (UnicodeDecodeError, LookupError):
+                pass
+            else:
+                if key is not None and confidence >= self.min_confidence:
+                    self.charsets.set(key, charset)
+                return charset, text
+        # The sample was misleading; look at the whole body:
+        guess = chardet.detect(body)
+        charset = guess['encoding'] or 'utf-8'
+        return charset, body.decode(charset, errors)
+
+    def clear(self):
+        """Forget all the charsets"""
+        self.charsets.clear()
+
+    def stats(self):
+        """Hit/miss counters and size, see `LRUCache.stats`"""
+        return self.charsets.stats()
+
+charset_guesses = CharsetGuesses()
 
 class Response(webob.Response):
     default_charset = None
     unicode_errors = 'replace'
+    # Set to None to detect charsets from the whole body, every time:
+    charset_guesses = charset_guesses
 
     def _unicode_body__get(self):
         """
         Get/set the unicode value of the body (using the charset of the Content-Type)
         """
-        if not self.charset:
-            guess = chardet.detect(self.body)
-            self.charset = guess['encoding']
+        request = self.request
+        log = None
+        if request is not None:
+            log = request.environ.get('deliverance.log')
         body = self.body
+        if not self.charset:
+            if self.charset_guesses is None:
+                guess = chardet.detect(body)
+                self.charset = guess['encoding']
+            else:
+                start = time.time()
+                self.charset, text = self.charset_guesses.decode(
+                    request, body, self.unicode_errors, log)
+                if log is not None:
+                    log.debug(self.charset_guesses, 'Found the charset and decoded %s bytes as %s in %.1fms',
+                              len(body), self.charset, (time.time() - start) * 1000)
+                return text
         return body.decode(self.charset, self.unicode_errors)
 
     def _unicode_body__set(self, value):
@@ -31,3 +148,11 @@ class Response(webob.Response):
 
 class Request(webob.Request):
     ResponseClass = Response
+
+    def send(self, application=None, catch_exc_info=False):
+        # The response keeps the request, for charset detection:
+        resp = super(Request, self).send(application, catch_exc_info)
+        resp.request = self
+        return resp
+
+    get_response = send
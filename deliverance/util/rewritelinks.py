@@ -0,0 +1,255 @@
+"""
+Rewrites the links of an HTML document as it streams past, without
+parsing it: only the values of link attributes (``href``, ``src``,
+``action``...), ``style`` attributes and ``<style>`` elements are
+changed, and everything else is passed on byte for byte.
+"""
+
+import re
+import urllib.parse
+from html import unescape
+from lxml.html.defs import link_attrs
+
+__all__ = ['LinkRewriter', 'rewrite_links_iter', 'is_ascii_compatible']
+
+_tag_re = re.compile(r'''<(/?)([a-zA-Z][^\s/>]*)((?:[^>"']|"[^"]*"|'[^']*')*)>''')
+_attr_re = re.compile(
+    r'''(\s)([^\s"'>/=]+)(\s*=\s*)(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
+_css_url_re = re.compile(r'''(url\(\s*)(["']?)([^"')]*)(\2\s*\))''', re.I)
+_css_import_re = re.compile(r'''(@import\s+)(["'])([^"']*)(\2)''', re.I)
+_entity_re = re.compile(r'&(?:#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);')
+_bare_amp_re = re.compile(r'&(?!#?[a-zA-Z0-9]+;)')
+
+# Elements whose content isn't markup:
+_raw_text_elements = ('script', 'style', 'textarea', 'title', 'xmp')
+_raw_end_res = dict(
+    (name, re.compile(r'</%s(?=[\s/>])' % name, re.I))
+    for name in _raw_text_elements)
+# The longest thing that has to be seen whole to decide what a "<" starts:
+_lookahead = len('<![CDATA[')
+
+def _unescape_value(value):
+    """
+    Decodes the character references in an attribute value that stand
+    for ASCII characters (like ``&amp;``); others are left as they are,
+    as the document may not be in a charset that can hold them.
+    """
+    if '&' not in value:
+        return value
+    def repl(match):
+        char = unescape(match.group())
+        if len(char) == 1 and ord(char) < 128:
+            return char
+        return match.group()
+    return _entity_re.sub(repl, value)
+
+def _escape_value(value, quote):
+    """Escapes an attribute value (the reverse of `_unescape_value`)"""
+    value = _bare_amp_re.sub('&amp;', value)
+    if quote == '"':
+        return value.replace('"', '&quot;')
+    return value.replace("'", '&#39;')
+
+def is_ascii_compatible(charset):
+    """
+    True if documents in `charset` (or None, for an unknown charset)
+    can be rewritten with `rewrite_links_iter`
+    """
+    if not charset:
+        return True
+    charset = charset.lower().replace('-', '').replace('_', '')
+    return not charset.startswith(('utf16', 'utf32', 'ucs2', 'ucs4'))
+
+class LinkRewriter(object):
+    """
+    Rewrites the links in an HTML document given in pieces to `feed`.
+
+    Each link is made absolute (with `base_url`, or the ``<base
+    href>`` of the document), then passed to `link_repl_func`, like
+    ``lxml.html``'s ``make_links_absolute`` and ``rewrite_links``.
+    Comments, CDATA sections and the content of ``<script>`` (and
+    other elements that can't contain tags) are left alone.
+
+    Only an unfinished tag (or ``<style>`` element) is held back
+    between pieces; a tag longer than `max_buffer` characters is
+    passed on unchanged.
+    """
+
+    def __init__(self, link_repl_func, base_url=None, max_buffer=65536):
+        self.link_repl_func = link_repl_func
+        self.base_url = base_url
+        self.max_buffer = max_buffer
+        self.buffer = ''
+        # While inside a comment or the like, the string that ends it:
+        self.skip_until = None
+        # While inside <script> etc, the name of the element:
+        self.raw_element = None
+
+    def feed(self, data):
+        """Takes the next piece of the document, returning the output so far"""
+        self.buffer += data
+        return self.process(final=False)
+
+    def close(self):
+        """Returns the rest of the output"""
+        return self.process(final=True)
+
+    def process(self, final):
+        buf = self.buffer
+        end = len(buf)
+        out = []
+        pos = 0
+        while pos < end:
+            if self.skip_until is not None:
+                found = buf.find(self.skip_until, pos)
+                if found == -1:
+                    # Keep what might be the start of the terminator:
+                    keep = end if final else max(pos, end - len(self.skip_until) + 1)
+                    out.append(buf[pos:keep])
+                    pos = keep
+                    break
+                found += len(self.skip_until)
+                out.append(buf[pos:found])
+                pos = found
+                self.skip_until = None
+            elif self.raw_element is not None:
+                match = _raw_end_res[self.raw_element].search(buf, pos)
+                if match is None and not final:
+                    if self.raw_element == 'style':
+                        if end - pos <= self.max_buffer:
+                            break
+                        # Rewrite up to the end of a CSS rule:
+                        cut = buf.rfind('}', pos, end) + 1
+                        if cut <= pos:
+                            cut = end
+                        out.append(self.rewrite_css(buf[pos:cut]))
+                        pos = cut
+                        break
+                    # Keep what might be the start of the end tag:
+                    keep = max(pos, end - len('</textarea'))
+                    out.append(buf[pos:keep])
+                    pos = keep
+                    break
+                content_end = end if match is None else match.start()
+                content = buf[pos:content_end]
+                if self.raw_element == 'style':
+                    content = self.rewrite_css(content)
+                out.append(content)
+                pos = content_end
+                self.raw_element = None
+            else:
+                start = buf.find('<', pos)
+                if start == -1:
+                    out.append(buf[pos:])
+                    pos = end
+                    break
+                out.append(buf[pos:start])
+                pos = start
+                if not final and end - pos < _lookahead:
+                    break
+                if buf.startswith('<!--', pos):
+                    self.skip_until = '-->'
+                    out.append('<!--')
+                    pos += 4
+                elif buf.startswith('<![CDATA[', pos):
+                    self.skip_until = ']]>'
+                    out.append('<![CDATA[')
+                    pos += 9
+                elif buf.startswith('<!', pos) or buf.startswith('<?', pos):
+                    self.skip_until = '>'
+                    out.append(buf[pos:pos+2])
+                    pos += 2
+                else:
+                    match = _tag_re.match(buf, pos)
+                    if match is None:
+                        if (not final and end - pos <= self.max_buffer
+                            and (buf[pos+1:pos+2].isalpha() or buf[pos+1:pos+2] == '/')):
+                            # Wait for the rest of the tag:
+                            break
+                        out.append('<')
+                        pos += 1
+                        continue
+                    out.append(self.rewrite_tag(match))
+                    pos = match.end()
+        self.buffer = buf[pos:]
+        return ''.join(out)
+
+    def rewrite_tag(self, match):
+        """Rewrites the links in one tag"""
+        closing, name, attrs = match.groups()
+        if closing or not attrs:
+            if not closing and name.lower() in _raw_text_elements:
+                self.raw_element = name.lower()
+            return match.group()
+        name = name.lower()
+        if name == 'base':
+            for attr in _attr_re.finditer(attrs):
+                if attr.group(2).lower() == 'href':
+                    value = attr.group(4) or attr.group(5) or attr.group(6) or ''
+                    self.base_url = urllib.parse.urljoin(
+                        self.base_url or '', _unescape_value(value).strip())
+        if name in _raw_text_elements and not attrs.rstrip().endswith('/'):
+            self.raw_element = name
+        new_attrs = _attr_re.sub(self.rewrite_attr, attrs)
+        if new_attrs == attrs:
+            return match.group()
+        return '<%s%s>' % (match.group(2), new_attrs)
+
+    def rewrite_attr(self, match):
+        """Rewrites the value of one attribute, if it has links"""
+        name = match.group(2).lower()
+        if name in link_attrs:
+            rewrite = self.rewrite_link
+        elif name == 'style':
+            rewrite = self.rewrite_css
+        else:
+            return match.group()
+        if match.group(4) is not None:
+            quote, value = '"', match.group(4)
+        elif match.group(5) is not None:
+            quote, value = "'", match.group(5)
+        else:
+            quote, value = '"', match.group(6)
+        text = _unescape_value(value)
+        new = rewrite(text)
+        if new == text:
+            return match.group()
+        return '%s%s%s%s%s%s' % (match.group(1), match.group(2), match.group(3),
+                                 quote, _escape_value(new, quote), quote)
+
+    def rewrite_link(self, link):
+        """Makes the link absolute, and passes it to `link_repl_func`"""
+        link = link.strip()
+        if self.base_url:
+            link = urllib.parse.urljoin(self.base_url, link)
+        return self.link_repl_func(link)
+
+    def rewrite_css(self, css):
+        """Rewrites the ``url()`` and ``@import`` links in CSS"""
+        def repl(match):
+            link = self.rewrite_link(match.group(3))
+            return match.group(1) + match.group(2) + link + match.group(4)
+        css = _css_url_re.sub(repl, css)
+        return _css_import_re.sub(repl, css)
+
+def rewrite_links_iter(app_iter, link_repl_func, base_url=None,
+                       max_buffer=65536):
+    """
+    Rewrites the links in a response body (an iterable of bytes in an
+    ASCII-compatible charset, see `is_ascii_compatible`) as it is
+    read, with a `LinkRewriter`.  Bytes that aren't part of a link
+    come out exactly as they went in.
+    """
+    rewriter = LinkRewriter(link_repl_func, base_url, max_buffer)
+    try:
+        for chunk in app_iter:
+            # latin1 maps each byte to one character and back:
+            output = rewriter.feed(chunk.decode('latin1'))
+            if output:
+                yield output.encode('latin1')
+        output = rewriter.close()
+        if output:
+            yield output.encode('latin1')
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
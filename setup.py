@@ -54,6 +54,9 @@ setup(name='Deliverance',
         "chardet",
         "simplejson",
         ],
+      extras_require={
+        "asgi": ["httpx>=0.20"],
+        },
       entry_points="""
       [console_scripts]
       deliverance-proxy = deliverance.proxycommand:main